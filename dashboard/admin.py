@@ -1,5 +1,5 @@
 from django.contrib import admin
-from .models import Device, DeviceLog, Firmware
+from .models import Device, DeviceLog, DeviceLogRollup, FleetCommand, Firmware
 
 @admin.register(Device)
 class DeviceAdmin(admin.ModelAdmin):
@@ -10,42 +10,32 @@ class DeviceAdmin(admin.ModelAdmin):
 
 @admin.register(Firmware)
 class FirmwareAdmin(admin.ModelAdmin):
-    list_display = ('version', 'is_active', 'created_at')
-    list_filter = ('is_active', 'created_at')
+    list_display = ('version', 'device_type', 'rollout_percent', 'is_active', 'package_state', 'created_at')
+    list_filter = ('is_active', 'device_type', 'created_at')
     search_fields = ('version', 'release_notes')
     ordering = ('-created_at',)
-    readonly_fields = ('created_at',)
+    readonly_fields = ('created_at', 'package_state', 'sha256', 'size')
     fieldsets = (
         (None, {
             'fields': ('version', 'is_active', 'release_notes')
         }),
+        ('Rollout', {
+            'fields': ('device_type', 'rollout_percent')
+        }),
         ('Firmware Files', {
-            'fields': ('firmware_file', 'firmware_folder')
+            'fields': ('firmware_file', 'firmware_folder', 'package_state', 'sha256', 'size'),
+            'description': 'Upload a firmware file, or a folder to be zipped in the background',
         }),
     )
 
-    def save_model(self, request, obj, form, change):
-        # If a folder was uploaded, create a zip file from it
-        if obj.firmware_folder and not obj.firmware_file:
-            fs = FileSystemStorage()
-            folder_path = fs.path(obj.firmware_folder.name)
-            zip_path = os.path.join(settings.MEDIA_ROOT, 'firmware/versions', f'v{obj.version}.zip')
-            
-            with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_DEFLATED) as zipf:
-                for root, dirs, files in os.walk(folder_path):
-                    for file in files:
-                        file_path = os.path.join(root, file)
-                        arcname = os.path.relpath(file_path, folder_path)
-                        zipf.write(file_path, arcname)
-            
-            # Save the zip file path to firmware_file
-            obj.firmware_file = fs.save(f'firmware/versions/v{obj.version}.zip', open(zip_path, 'rb'))
-            
-            # Delete the original folder
-            fs.delete(obj.firmware_folder.name)
-            obj.firmware_folder = None
-        
-        super().save_model(request, obj, form, change)
+    @admin.display(description='Packaging')
+    def package_state(self, obj):
+        """Progress of the background zip of an uploaded folder"""
+        if obj.package_status == 'packaging':
+            return f"Packaging ({obj.package_progress}%)"
+        if obj.package_status == 'failed':
+            return f"Failed: {obj.package_error}"
+        return obj.get_package_status_display() or '-'
 
 @admin.register(DeviceLog)
 class DeviceLogAdmin(admin.ModelAdmin):
@@ -55,6 +45,23 @@ class DeviceLogAdmin(admin.ModelAdmin):
     ordering = ('-timestamp',)
     readonly_fields = ('timestamp', 'created_at')
 
+@admin.register(DeviceLogRollup)
+class DeviceLogRollupAdmin(admin.ModelAdmin):
+    list_display = ('device', 'period', 'bucket_start', 'message_count', 'first_seen', 'last_seen')
+    list_filter = ('period',)
+    search_fields = ('device__name', 'device__device_id')
+    ordering = ('-bucket_start',)
+    readonly_fields = ('first_seen', 'last_seen', 'status_counts')
+
+@admin.register(FleetCommand)
+class FleetCommandAdmin(admin.ModelAdmin):
+    list_display = ('command', 'command_id', 'status', 'targets', 'sent', 'acked', 'failed', 'created_at')
+    list_filter = ('status', 'command')
+    search_fields = ('command_id', 'command')
+    ordering = ('-created_at',)
+    readonly_fields = ('command_id', 'command', 'payload', 'selector', 'qos', 'status', 'targets',
+                       'sent', 'acked', 'failed', 'created_at', 'finished_at')
+
 admin.site.site_header = 'Device Dashboard'
 admin.site.site_title = 'Device Dashboard'
 admin.site.index_title = 'Device Management'
@@ -1,5 +1,40 @@
+import os
+import sys
+
 from django.apps import AppConfig
+from django.conf import settings
+from django.db.backends.signals import connection_created
+
+
+def web_services_enabled():
+    """Whether this process should start the web background services.
+
+    ``WEB_SERVICES = 'auto'`` starts them in WSGI/ASGI servers and in
+    ``runserver``, but not in other management commands (``test``,
+    ``migrate``, ``run_consumer``...) or Celery workers.
+    """
+    setting = getattr(settings, 'WEB_SERVICES', 'auto')
+    if setting != 'auto':
+        return bool(setting)
+    program = os.path.basename(sys.argv[0]) if sys.argv else ''
+    if program in ('manage.py', 'django-admin', 'django-admin.py'):
+        if sys.argv[1:2] != ['runserver']:
+            return False
+        # The autoreloader's parent process only watches files
+        return os.environ.get('RUN_MAIN') == 'true' or '--noreload' in sys.argv
+    return program != 'celery'
+
 
 class DashboardConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'dashboard'
+
+    def ready(self):
+        # Connect signal handlers
+        from . import signals  # noqa: F401
+        from .database import configure_connection
+        connection_created.connect(configure_connection, dispatch_uid='dashboard.sqlite_pragmas')
+
+        if web_services_enabled():
+            from .views import start_web_services
+            start_web_services()
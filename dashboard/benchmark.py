@@ -0,0 +1,123 @@
+"""Ingestion write benchmark (``manage.py benchmark_ingestion``).
+
+Feeds synthetic messages through :func:`~dashboard.ingestion.persist_batch`
+and the heartbeat writer at a fixed offered rate against the configured
+database, the way the consumer's flusher does. Run it once on SQLite and once
+on PostgreSQL (``POSTGRES_DB=...``) to compare the storage backends.
+
+``capacity`` is messages per second of database time, i.e. the highest rate
+the backend could sustain; ``kept_up`` is whether it covers the offered rate.
+
+:func:`benchmark_import` times ``import_logs`` on a generated NDJSON file
+against the :data:`IMPORT_TARGET_RATE` of 100k rows per second.
+"""
+import json
+import os
+import tempfile
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import connection
+from django.utils import timezone
+
+from .heartbeat import heartbeat_writer
+from .importer import LogImporter
+from .ingestion import persist_batch
+from .models import Device, ImportCheckpoint
+from .registry import device_registry
+from .storage import storage
+
+BENCH_DEVICE_TYPE = 'BENCH'
+# Rows per second a bulk import should reach
+IMPORT_TARGET_RATE = 100000
+
+
+def _percentile(values, fraction):
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def benchmark_ingestion(rate, duration=5, devices=1000, batch_size=None):
+    """Offer ``rate`` msgs/s for ``duration`` seconds from ``devices`` devices"""
+    batch_size = batch_size or getattr(settings, 'INGEST_BATCH_SIZE', 500)
+    device_registry.ensure_warm()
+    batch_times = []
+    heartbeat_time = 0.0
+    sent = 0
+    started = time.monotonic()
+    for second in range(duration):
+        # Messages for each second "arrive" at its start, as a backlog would
+        delay = started + second - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        now = timezone.now()
+        records = [
+            {
+                'device_id': f'{BENCH_DEVICE_TYPE}{n % devices}',
+                'device_type': BENCH_DEVICE_TYPE,
+                'status': 'online',
+                'data': f'reading {sent + n}',
+                'timestamp': now + timedelta(microseconds=n),
+            }
+            for n in range(rate)
+        ]
+        for start in range(0, rate, batch_size):
+            batch_started = time.perf_counter()
+            persist_batch(records[start:start + batch_size])
+            batch_times.append(time.perf_counter() - batch_started)
+        flush_started = time.perf_counter()
+        heartbeat_writer.flush()
+        heartbeat_time += time.perf_counter() - flush_started
+        sent += rate
+
+    busy = sum(batch_times) + heartbeat_time
+    capacity = sent / busy if busy else 0
+    return {
+        'database': connection.vendor,
+        'storage': storage.name,
+        'offered_rate': rate,
+        'messages': sent,
+        'batch_size': batch_size,
+        'db_seconds': round(busy, 3),
+        'capacity': round(capacity),
+        'kept_up': capacity >= rate,
+        'batch_ms_avg': round(sum(batch_times) / len(batch_times) * 1000, 3) if batch_times else 0,
+        'batch_ms_p99': round(_percentile(batch_times, 0.99) * 1000, 3),
+        'heartbeat_ms_avg': round(heartbeat_time / duration * 1000, 3) if duration else 0,
+    }
+
+
+def benchmark_import(rows, devices=1000, batch_size=None):
+    """Import ``rows`` generated log rows for ``devices`` devices from an NDJSON file"""
+    start = timezone.now() - timedelta(days=1)
+    handle, path = tempfile.mkstemp(suffix='.ndjson')
+    try:
+        with os.fdopen(handle, 'w') as output:
+            for n in range(rows):
+                output.write(json.dumps({
+                    'device_id': f'{BENCH_DEVICE_TYPE}{n % devices}',
+                    'timestamp': (start + timedelta(milliseconds=n)).isoformat(),
+                    'data': {'reading': n},
+                }) + '\n')
+        result = LogImporter(path, batch_size=batch_size, device_type=BENCH_DEVICE_TYPE).run()
+        ImportCheckpoint.objects.filter(source=result['source']).delete()
+    finally:
+        os.remove(path)
+    return {
+        'database': connection.vendor,
+        'storage': storage.name,
+        'rows': result['imported'],
+        'seconds': result['seconds'],
+        'rows_per_second': result['rows_per_second'] or 0,
+        'target': IMPORT_TARGET_RATE,
+        'met_target': (result['rows_per_second'] or 0) >= IMPORT_TARGET_RATE,
+    }
+
+
+def remove_benchmark_devices():
+    """Delete the benchmark's devices and, through the cascade, their logs"""
+    deleted, _ = Device.objects.filter(device_type=BENCH_DEVICE_TYPE).delete()
+    return deleted
@@ -0,0 +1,241 @@
+"""Event bridge between consumer workers and web processes.
+
+Ingestion runs in the consumer workers (``manage.py run_consumer``), but SSE
+streams, the status API and the recent messages list are served by web
+processes. In each worker, :class:`EventForwarder` collects the events
+published on the worker's event hub, plus the latest heartbeat per device.
+Every ``EVENT_FORWARD_INTERVAL`` seconds it publishes them as one JSON
+batch to ``dashboard/events/<shard>``, with the worker's pipeline stats
+attached every ``CONSUMER_STATS_INTERVAL`` seconds.
+
+In each web process, :class:`EventBridge` subscribes to
+``dashboard/events/#`` (never to device topics) and applies each batch:
+
+* heartbeats and status events update the device registry, and devices the
+  process hasn't seen yet are loaded in one query
+* messages go into the recent messages list
+* replies to device queries resolve their pending request, and
+  acknowledgements of fleet commands go to the fleet dispatcher
+* every event is republished on the local event hub for SSE clients
+
+Web processes also broadcast on ``dashboard/events/web``: a ``firmware``
+event tells every process to reload its firmware manifest (``manifest.py``).
+
+Events are best-effort (QoS 0). A web process that misses a batch catches up
+on the next heartbeat, and SSE clients that fall behind reload their state.
+"""
+import json
+import threading
+import time
+from datetime import datetime
+
+from django.conf import settings
+from django.db import close_old_connections
+
+from .events import event_hub
+from .fleet import fleet_dispatcher
+from .heartbeat import heartbeat_writer
+from .manifest import firmware_manifest
+from .mqtt import create_client, publish_json
+from .pending import pending_requests
+from .recent import recent_messages
+from .registry import device_registry
+
+EVENTS_TOPIC = 'dashboard/events'
+WEB_SHARD = 'web'
+MAX_BATCH_EVENTS = 500
+
+
+class EventForwarder:
+    """Consumer side: batches hub events and heartbeats onto the broker"""
+
+    def __init__(self, shard, interval=0.2, stats_interval=5.0):
+        self.shard = shard
+        self.interval = interval
+        self.stats_interval = stats_interval
+        self.client = None
+        self.stats_source = None
+        self._events = []
+        self._heartbeats = {}
+        self._lock = threading.Lock()
+        self._thread = None
+        self._last_stats = 0.0
+
+        self._forwarded = 0
+        self._batches = 0
+        self._dropped = 0
+
+    @classmethod
+    def from_settings(cls, shard):
+        return cls(
+            shard,
+            interval=getattr(settings, 'EVENT_FORWARD_INTERVAL', 0.2),
+            stats_interval=getattr(settings, 'CONSUMER_STATS_INTERVAL', 5.0),
+        )
+
+    def attach(self, client, stats_source=None):
+        """Start forwarding this process's events through ``client``"""
+        self.client = client
+        self.stats_source = stats_source
+        event_hub.add_listener(self._on_event)
+        heartbeat_writer.add_listener(self._on_heartbeat)
+
+    def _on_event(self, event):
+        with self._lock:
+            self._events.append({'type': event.type, 'data': event.data})
+
+    def _on_heartbeat(self, device_id, last_seen, status):
+        with self._lock:
+            self._heartbeats[device_id] = (last_seen.isoformat(), status)
+
+    def flush(self):
+        """Publish everything collected since the last flush"""
+        with self._lock:
+            events, self._events = self._events, []
+            heartbeats, self._heartbeats = self._heartbeats, {}
+        payload = {'shard': self.shard, 'heartbeats': heartbeats, 'events': events[:MAX_BATCH_EVENTS]}
+        now = time.monotonic()
+        if self.stats_source is not None and now - self._last_stats >= self.stats_interval:
+            self._last_stats = now
+            payload['stats'] = self.stats_source()
+
+        batches = [payload] + [
+            {'shard': self.shard, 'events': events[start:start + MAX_BATCH_EVENTS]}
+            for start in range(MAX_BATCH_EVENTS, len(events), MAX_BATCH_EVENTS)
+        ]
+        for batch in batches:
+            if not (batch['events'] or batch.get('heartbeats') or 'stats' in batch):
+                continue
+            if publish_json(self.client, f"{EVENTS_TOPIC}/{self.shard}", batch):
+                with self._lock:
+                    self._batches += 1
+                    self._forwarded += len(batch['events'])
+            else:
+                with self._lock:
+                    self._dropped += len(batch['events'])
+
+    def start(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._thread = threading.Thread(target=self._run, name='event-forwarder', daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.flush()
+            except Exception as e:
+                print(f"❌ Failed to forward events: {e}")
+
+    def stats(self):
+        with self._lock:
+            return {
+                'pending_events': len(self._events),
+                'pending_heartbeats': len(self._heartbeats),
+                'forwarded': self._forwarded,
+                'batches': self._batches,
+                'dropped': self._dropped,
+            }
+
+
+class EventBridge:
+    """Web side: applies forwarded batches to this process's caches and hub"""
+
+    def __init__(self):
+        self.client = None
+        self._consumers = {}
+        self._lock = threading.Lock()
+
+        self._batches = 0
+        self._events = 0
+        self._heartbeats = 0
+        self._errors = 0
+
+    def start(self):
+        """Connect and subscribe to the events topic (idempotent); returns the client"""
+        if self.client is None:
+            self.client = create_client(
+                'dashboard', subscriptions=[(f"{EVENTS_TOPIC}/#", 0)], on_message=self._on_message
+            )
+        return self.client
+
+    def _on_message(self, client, userdata, msg):
+        try:
+            close_old_connections()
+            self.apply(json.loads(msg.payload))
+        except Exception as e:
+            with self._lock:
+                self._errors += 1
+            print(f"❌ Failed to apply forwarded events: {e}")
+
+    def apply(self, batch):
+        heartbeats = batch.get('heartbeats') or {}
+        events = batch.get('events') or []
+        unknown = {device_id for device_id in heartbeats if device_registry.get(device_id) is None}
+        unknown.update(
+            event['data']['device_id'] for event in events
+            if event['type'] == 'status' and device_registry.get(event['data']['device_id']) is None
+        )
+        if unknown:
+            device_registry.load(unknown)
+
+        for device_id, (last_seen, status) in heartbeats.items():
+            last_seen = datetime.fromisoformat(last_seen)
+            state = device_registry.get(device_id)
+            if state is not None and (state.last_seen is None or last_seen > state.last_seen):
+                device_registry.update(device_id, last_seen=last_seen, status=status)
+
+        for event in events:
+            data = event['data']
+            if event['type'] == 'firmware':
+                # Control event for web processes, not for SSE clients
+                firmware_manifest.invalidate()
+                continue
+            if event['type'] == 'status':
+                fields = {'status': data['status']}
+                if data.get('last_seen'):
+                    fields['last_seen'] = datetime.fromisoformat(data['last_seen'])
+                device_registry.update(data['device_id'], **fields)
+            elif event['type'] == 'message':
+                recent_messages.remember(
+                    data['device_id'], data.get('device_type'), data['data'], data['timestamp']
+                )
+            elif event['type'] == 'ack':
+                if not pending_requests.resolve(
+                    data['command_id'], data['device_id'], data['data'], data['timestamp']
+                ):
+                    fleet_dispatcher.ack(data['command_id'], data['device_id'], data['data'], data['timestamp'])
+            event_hub.publish(event['type'], data)
+
+        with self._lock:
+            self._batches += 1
+            self._events += len(events)
+            self._heartbeats += len(heartbeats)
+            if 'stats' in batch:
+                self._consumers[batch['shard']] = dict(batch['stats'], received_at=time.time())
+
+    def broadcast(self, event_type, data):
+        """Send an event to every web process (including this one)"""
+        return publish_json(
+            self.client, f"{EVENTS_TOPIC}/{WEB_SHARD}",
+            {'shard': WEB_SHARD, 'events': [{'type': event_type, 'data': data}]},
+        )
+
+    def stats(self):
+        with self._lock:
+            return {
+                'connected': self.client is not None and self.client.is_connected(),
+                'batches': self._batches,
+                'events': self._events,
+                'heartbeats': self._heartbeats,
+                'errors': self._errors,
+            }
+
+    def consumer_stats(self):
+        """The latest stats each consumer worker reported"""
+        with self._lock:
+            return {str(shard): stats for shard, stats in sorted(self._consumers.items())}
+
+
+event_bridge = EventBridge()
@@ -0,0 +1,268 @@
+"""Sharded MQTT consumer workers (``manage.py run_consumer``).
+
+Web processes never subscribe to device topics. Ingestion runs in N consumer
+processes, each owning one shard:
+
+* ``hash`` (default) - every worker subscribes to ``devices/#`` and keeps only
+  the devices with ``crc32(device_id) % N == shard``. This works with any
+  broker, and each device is always handled by the same worker. Each worker
+  still receives (and JSON-decodes) the full stream.
+* ``shared`` - workers join the shared subscription
+  ``$share/<MQTT_SHARE_GROUP>/devices/#`` and the broker splits the stream
+  between them. Per-device ordering then depends on the broker's dispatch
+  strategy. Use a topic- or client-hash strategy (e.g. EMQX ``hash_topic``)
+  with devices publishing on ``devices/<type>/<device_id>``. Round-robin
+  dispatch (the Mosquitto default) can reorder a device's messages.
+
+Within a worker, messages leave the decode stage (:mod:`dashboard.decoding`)
+in the order paho received them. They are appended to the worker's WAL (or
+queue) and applied in append order, so a device's messages are persisted
+in the order its worker received them. Each worker
+runs its own WAL (``INGEST_WAL_DIR/shard-<n>``), heartbeat writer and
+presence tracker, scoped to its shard. Shard 0 also runs the periodic
+status reconciliation sweep. Events reach the web processes through
+:mod:`dashboard.bridge`.
+"""
+import multiprocessing
+import signal
+import threading
+import time
+import zlib
+
+from django.conf import settings
+from django.db import close_old_connections, connections
+from django.utils import timezone
+
+from .bridge import EventForwarder
+from .database import db_writer
+from .decoding import RESPONSE_TOPIC, decoder_from_settings, to_record
+from .events import event_hub
+from .heartbeat import heartbeat_writer
+from .ingestion import ingest_queue
+from .mqtt import create_client
+from .presence import presence_tracker
+from .recent import recent_messages
+from .registry import device_registry
+from .sweeper import sweep_device_status
+from .timing import StageTimer
+from .wal import WriteAheadLog
+
+MODE_HASH = 'hash'
+MODE_SHARED = 'shared'
+
+
+def shard_for(device_id, shards):
+    """Stable shard of a device, the same in every process and across restarts"""
+    return zlib.crc32(device_id.encode()) % shards
+
+
+class ConsumerWorker:
+    """One shard of the consumer: subscribe, buffer durably, persist"""
+
+    def __init__(self, shard=0, shards=1, mode=MODE_HASH):
+        if mode not in (MODE_HASH, MODE_SHARED):
+            raise ValueError(f"Unknown consumer mode: {mode}")
+        self.shard = shard
+        self.shards = shards
+        self.mode = mode
+        self.wal = WriteAheadLog.from_settings(f'shard-{shard}')
+        self.forwarder = EventForwarder.from_settings(shard)
+        self.decoder = decoder_from_settings(self.handle_decoded)
+        self.receive_timer = StageTimer()
+        self.append_timer = StageTimer()
+        self.client = None
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+
+        self._received = 0
+        self._accepted = 0
+        self._skipped = 0
+        self._rejected = 0
+
+    def owns(self, device_id):
+        return self.shards == 1 or shard_for(device_id, self.shards) == self.shard
+
+    def subscriptions(self):
+        topics = [getattr(settings, 'MQTT_TOPIC', 'devices/#'), RESPONSE_TOPIC]
+        if self.mode == MODE_SHARED:
+            group = getattr(settings, 'MQTT_SHARE_GROUP', 'dashboard')
+            topics = [f"$share/{group}/{topic}" for topic in topics]
+        return [(topic, 1) for topic in topics]
+
+    def on_message(self, client, userdata, msg):
+        # Runs on paho's network thread: hand the payload to the decode stage
+        # (inline or a process pool) and return quickly
+        started = time.perf_counter()
+        try:
+            self.decoder.submit(msg.topic, msg.payload, timezone.now())
+        except Exception as e:
+            print(f"❌ Error in on_message: {e}")
+        self.receive_timer.add(time.perf_counter() - started)
+
+    def handle_decoded(self, decoded, received_at):
+        """Persistence stage entry: append a decoded message to the WAL (or queue)"""
+        started = time.perf_counter()
+        with self._lock:
+            self._received += 1
+            if decoded is None:
+                self._rejected += 1
+                return
+            if self.mode == MODE_HASH and not self.owns(decoded[0]):
+                self._skipped += 1
+                return
+            self._accepted += 1
+
+        record = to_record(decoded, received_at)
+        if self.wal.is_open:
+            self.wal.append(record)
+        else:
+            ingest_queue.put(record)
+        self.append_timer.add(time.perf_counter() - started)
+
+        if decoded[4]:
+            message = recent_messages.remember(
+                record['device_id'], record['device_type'], record['data'], record['timestamp']
+            )
+            if message is not None:
+                event_hub.publish('message', message)
+        if decoded[5]:
+            # Fleet command acknowledgement, matched by the web process that sent it
+            event_hub.publish('ack', {
+                'device_id': record['device_id'],
+                'command_id': decoded[5],
+                'data': record['data'],
+                'timestamp': record['timestamp'].isoformat(),
+            })
+
+    def _run_sweeps(self):
+        """Periodic reconciliation for devices no tracker knows about"""
+        interval = getattr(settings, 'STATUS_SWEEP_INTERVAL', 300)
+        while not self._stop.wait(interval):
+            try:
+                close_old_connections()
+                changed = db_writer.run(sweep_device_status)
+                if changed['idle'] or changed['offline']:
+                    print(f"🕒 Status sweep: {len(changed['idle'])} idle, {len(changed['offline'])} offline")
+            except Exception as e:
+                print(f"❌ Status sweep failed: {e}")
+
+    def start(self):
+        """Replay the WAL, start the pipeline threads, then subscribe"""
+        device_registry.ensure_warm()
+        heartbeat_writer.start()
+        presence_tracker.owns = self.owns
+        presence_tracker.start()
+        recent_messages.start_writer()
+        if self.shard == 0:
+            threading.Thread(target=self._run_sweeps, name='status-sweep', daemon=True).start()
+
+        if getattr(settings, 'INGEST_WAL_ENABLED', True) and self.wal.open():
+            self.wal.replay_pending()
+            self.wal.start()
+        else:
+            print(f"⚠️ Shard {self.shard} is buffering in memory only (WAL disabled or locked)")
+            ingest_queue.start()
+
+        self.decoder.start()
+        self.client = create_client(
+            f"consumer{self.shard}", subscriptions=self.subscriptions(),
+            on_message=self.on_message, status_topic=f"dashboard/status/consumer-{self.shard}",
+        )
+        self.forwarder.attach(self.client, self.stats)
+        self.forwarder.start()
+
+    def stop(self):
+        """Unsubscribe and make everything buffered durable"""
+        self._stop.set()
+        if self.client is not None:
+            self.client.disconnect()
+            self.client.loop_stop()
+        self.decoder.stop()
+        if self.wal.is_open:
+            self.wal.sync()
+        else:
+            ingest_queue.flush()
+        heartbeat_writer.flush()
+        self.forwarder.flush()
+
+    def run(self):
+        """Run until SIGTERM/SIGINT"""
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            signal.signal(signum, lambda *args: self._stop.set())
+        self.start()
+        print(f"🚀 Consumer shard {self.shard}/{self.shards} running ({self.mode})")
+        self._stop.wait()
+        self.stop()
+        print(f"👋 Consumer shard {self.shard} stopped")
+
+    def stats(self):
+        with self._lock:
+            consumer = {
+                'shard': self.shard,
+                'shards': self.shards,
+                'mode': self.mode,
+                'connected': self.client is not None and self.client.is_connected(),
+                'received': self._received,
+                'accepted': self._accepted,
+                'skipped_other_shards': self._skipped,
+                'rejected': self._rejected,
+            }
+        return {
+            'consumer': consumer,
+            # Where the time goes, in pipeline order
+            'stages': {
+                'receive': self.receive_timer.stats(),
+                'decode': self.decoder.stats(),
+                'append': self.append_timer.stats(),
+                'persist': (self.wal if self.wal.is_open else ingest_queue).persist_timer.stats(),
+            },
+            'ingestion': ingest_queue.stats(),
+            'wal': self.wal.stats(),
+            'heartbeats': heartbeat_writer.stats(),
+            'presence': presence_tracker.stats(),
+            'recent_messages': recent_messages.stats(),
+            'db_writer': db_writer.stats(),
+            'forwarder': self.forwarder.stats(),
+        }
+
+
+def run_worker(shard, shards, mode):
+    """Process entry point for one shard"""
+    import django
+    django.setup()
+    ConsumerWorker(shard, shards, mode).run()
+
+
+def run_consumers(workers, mode=MODE_HASH):
+    """Run ``workers`` shard processes and restart any that exit unexpectedly"""
+    if workers == 1:
+        ConsumerWorker(0, 1, mode).run()
+        return
+
+    methods = multiprocessing.get_all_start_methods()
+    context = multiprocessing.get_context('fork' if 'fork' in methods else 'spawn')
+    # Children must not share the parent's database connections
+    connections.close_all()
+
+    def spawn(shard):
+        process = context.Process(
+            target=run_worker, args=(shard, workers, mode), name=f'consumer-{shard}', daemon=False
+        )
+        process.start()
+        return process
+
+    stopping = threading.Event()
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(signum, lambda *args: stopping.set())
+
+    processes = {shard: spawn(shard) for shard in range(workers)}
+    while not stopping.wait(1.0):
+        for shard, process in processes.items():
+            if not process.is_alive():
+                print(f"❌ Consumer shard {shard} exited with {process.exitcode}, restarting")
+                processes[shard] = spawn(shard)
+
+    for process in processes.values():
+        process.terminate()
+    for process in processes.values():
+        process.join(timeout=30)
@@ -0,0 +1,111 @@
+"""SQLite tuning: connection PRAGMAs and a single background writer thread.
+
+Every new SQLite connection gets ``SQLITE_PRAGMAS`` (WAL journal,
+``synchronous=NORMAL``, a busy timeout, mmap and a larger page cache). In WAL
+mode, readers never block writers and writers never block readers.
+
+SQLite still allows only one writer at a time. Background writers each used
+to commit from their own thread, so they contended for the write lock and
+hit "database is locked" under load. These are ingestion batches, heartbeat
+flushes, presence transitions, status sweeps and recent message flushes.
+Now they all go through :data:`db_writer`: one thread that runs their
+(already batched) transactions one after another on a single connection.
+
+``DATABASE_WRITER = 'auto'`` enables the writer thread on SQLite only.
+Other databases handle concurrent writers themselves, so there callers
+run their writes directly.
+"""
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+from django.conf import settings
+from django.db import close_old_connections, connections
+
+from .timing import StageTimer
+
+DEFAULT_PRAGMAS = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'busy_timeout': 5000,
+    'mmap_size': 256 * 1024 * 1024,
+    'cache_size': -64 * 1024,
+}
+
+
+def configure_connection(sender, connection, **kwargs):
+    """``connection_created`` handler applying ``SQLITE_PRAGMAS``"""
+    if connection.vendor != 'sqlite':
+        return
+    with connection.cursor() as cursor:
+        for name, value in getattr(settings, 'SQLITE_PRAGMAS', DEFAULT_PRAGMAS).items():
+            cursor.execute(f"PRAGMA {name} = {value}")
+
+
+class DatabaseWriter:
+    """Runs submitted write jobs one at a time on a dedicated thread"""
+
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self._jobs = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+        self.write_timer = StageTimer()
+        self.wait_timer = StageTimer()
+        self._failed = 0
+
+    @classmethod
+    def from_settings(cls):
+        mode = getattr(settings, 'DATABASE_WRITER', 'auto')
+        if mode == 'auto':
+            return cls(enabled=connections['default'].vendor == 'sqlite')
+        return cls(enabled=bool(mode))
+
+    def run(self, func, *args, **kwargs):
+        """Run ``func(*args, **kwargs)`` on the writer thread and return its result"""
+        if not self.enabled or threading.current_thread() is self._thread:
+            # Disabled, or a job calling another writer: run it in place
+            return func(*args, **kwargs)
+        self.start()
+        future = Future()
+        self._jobs.put((func, args, kwargs, future, time.perf_counter()))
+        return future.result()
+
+    def start(self):
+        """Start the writer thread (idempotent)"""
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._thread = threading.Thread(target=self._run, name='db-writer', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            func, args, kwargs, future, queued_at = self._jobs.get()
+            started = time.perf_counter()
+            self.wait_timer.add(started - queued_at)
+            try:
+                close_old_connections()
+                result = func(*args, **kwargs)
+            except BaseException as e:
+                with self._lock:
+                    self._failed += 1
+                future.set_exception(e)
+            else:
+                future.set_result(result)
+            self.write_timer.add(time.perf_counter() - started)
+
+    def stats(self):
+        with self._lock:
+            failed = self._failed
+        return {
+            'enabled': self.enabled,
+            'queued': self._jobs.qsize(),
+            'failed': failed,
+            'wait': self.wait_timer.stats(),
+            'write': self.write_timer.stats(),
+        }
+
+
+db_writer = DatabaseWriter.from_settings()
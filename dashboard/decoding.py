@@ -0,0 +1,308 @@
+"""Decode stage between paho's network thread and the persistence stage.
+
+Decoding turns ``(topic, payload)`` into a compact, validated tuple
+``(device_id, device_type, status, data, is_recent, command_id)``, or None
+for messages that are dropped. It runs either:
+
+* ``inline`` (default) - on the network thread. This is the cheapest option
+  for small deployments.
+* ``pool`` - in a process pool of ``DECODE_WORKERS``. The network thread
+  only appends raw payloads to a batch. Batches go to the pool once they
+  reach ``DECODE_BATCH_SIZE`` or after ``DECODE_FLUSH_INTERVAL``, and their
+  results are emitted in submission order, so per-device ordering holds. At
+  most ``DECODE_MAX_INFLIGHT`` batches are in flight. After that, the
+  network thread waits (backpressure). If the pool breaks, the affected
+  batch is decoded inline.
+
+JSON is parsed with ``orjson`` when it is installed and ``json`` otherwise.
+The receive timestamp is taken on the network thread before decoding, so
+it doesn't depend on how long a message waited for a decoder.
+"""
+import json
+import multiprocessing
+import threading
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+from django.conf import settings
+
+from .timing import StageTimer
+
+try:
+    import orjson
+except ImportError:  # optional: pip install orjson
+    orjson = None
+
+MODE_INLINE = 'inline'
+MODE_POOL = 'pool'
+
+# Devices answer queries and fleet commands here
+RESPONSE_TOPIC = 'check/response'
+
+# Column sizes of Device.device_id, device_type and name ("<type> - <id>"). Kept
+# here because pool workers decode without loading Django's models
+DEVICE_ID_MAX_LENGTH = 50
+DEVICE_TYPE_MAX_LENGTH = 50
+DEVICE_NAME_MAX_LENGTH = 100
+
+JSON_LIBRARY = 'orjson' if orjson is not None else 'json'
+# orjson.JSONDecodeError and json.JSONDecodeError both subclass ValueError
+json_loads = orjson.loads if orjson is not None else json.loads
+
+
+def decode(topic, payload):
+    """Validate one inbound device message.
+
+    Returns ``(device_id, device_type, status, data, is_recent, command_id)``,
+    or None for messages that should be ignored. ``is_recent`` marks messages
+    from ``devices/<type>/<id>`` topics, the only ones shown as recent
+    messages. ``command_id`` is the ``command-id`` a device echoes on
+    ``check/response`` to acknowledge a fleet command (see ``fleet.py``).
+    """
+    # Skip processing if payload is empty
+    if not payload:
+        return None
+
+    try:
+        # Decode JSON message
+        message_data = json_loads(payload)
+    except (ValueError, UnicodeDecodeError) as e:
+        print(f"❌ Failed to decode JSON on {topic}: {e}")
+        return None
+    if not isinstance(message_data, dict):
+        print(f"❌ Unexpected payload on {topic}: {message_data}")
+        return None
+
+    # Extract device type from topic (devices/<type>[/<device_id>])
+    device_type = None
+    topic_parts = topic.split('/')
+    if topic_parts[0] == 'devices' and len(topic_parts) >= 2 and topic_parts[1].strip():
+        device_type = topic_parts[1].strip()
+        if len(device_type) > DEVICE_TYPE_MAX_LENGTH:
+            print(f"❌ Device type too long on {topic}")
+            return None
+
+    # Extract and validate device-id
+    device_id = str(message_data.get('device-id') or '').strip()
+    if not device_id or not device_id.isalnum():
+        print(f"❌ Invalid or missing device-id on {topic}: {device_id!r}")
+        return None
+    if (len(device_id) > DEVICE_ID_MAX_LENGTH
+            or len(f"{device_type or 'unknown'} - {device_id}") > DEVICE_NAME_MAX_LENGTH):
+        print(f"❌ Device-id too long on {topic}: {device_id[:DEVICE_ID_MAX_LENGTH]!r}...")
+        return None
+
+    message_content = str(message_data.get('message', '')).lower().strip()
+    command_id = message_data.get('command-id') if topic == RESPONSE_TOPIC else None
+    return (
+        device_id,
+        device_type,
+        # 'idle' is reported explicitly, any other message means online
+        'idle' if message_content == 'idle' else 'online',
+        message_content,
+        len(topic_parts) >= 3 and device_type is not None,
+        str(command_id) if command_id else None,
+    )
+
+
+def decode_batch(items):
+    """Pool entry point: decode ``[(topic, payload), ...]``; returns the results
+    and the time spent decoding"""
+    started = time.perf_counter()
+    results = [decode(topic, payload) for topic, payload in items]
+    return results, time.perf_counter() - started
+
+
+def to_record(decoded, timestamp):
+    """Expand a decoded tuple into an ingestion record"""
+    device_id, device_type, status, data = decoded[:4]
+    return {
+        'device_id': device_id,
+        'device_type': device_type,
+        'status': status,
+        'data': data,
+        'timestamp': timestamp,
+    }
+
+
+class InlineDecoder:
+    """Decodes on the calling (network) thread"""
+
+    mode = MODE_INLINE
+
+    def __init__(self, emit):
+        self.emit = emit
+        self.decode_timer = StageTimer()
+
+    def submit(self, topic, payload, received_at):
+        started = time.perf_counter()
+        decoded = decode(topic, payload)
+        self.decode_timer.add(time.perf_counter() - started)
+        self.emit(decoded, received_at)
+
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+    def stats(self):
+        return {
+            'mode': self.mode,
+            'json': JSON_LIBRARY,
+            'decode': self.decode_timer.stats(),
+        }
+
+
+class PoolDecoder:
+    """Decodes batches in a process pool and emits results in order"""
+
+    mode = MODE_POOL
+
+    def __init__(self, emit, workers=2, batch_size=200, flush_interval=0.005, max_inflight=8):
+        self.emit = emit
+        self.workers = workers
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_inflight = max_inflight
+
+        self._pending = []
+        self._inflight = deque()
+        self._lock = threading.Lock()
+        self._dispatch_lock = threading.Lock()
+        self._ready = threading.Condition(self._lock)
+        self._slots = threading.BoundedSemaphore(max_inflight)
+        self._executor = None
+        self._threads = []
+
+        self.decode_timer = StageTimer()
+        self.handoff_timer = StageTimer()
+        self._batches = 0
+        self._fallbacks = 0
+        self._backpressure_waits = 0
+
+    def submit(self, topic, payload, received_at):
+        with self._lock:
+            self._pending.append((topic, payload, received_at))
+            full = len(self._pending) >= self.batch_size
+        if full:
+            self._dispatch()
+
+    def _dispatch(self):
+        """Send the pending messages to the pool as one batch"""
+        # Taking the batch and queueing its future happen under one lock so
+        # batches are collected in the order their messages arrived
+        with self._dispatch_lock:
+            with self._lock:
+                batch, self._pending = self._pending, []
+            if not batch:
+                return
+            if not self._slots.acquire(blocking=False):
+                with self._lock:
+                    self._backpressure_waits += 1
+                self._slots.acquire()
+            try:
+                future = self._executor.submit(
+                    decode_batch, [(topic, payload) for topic, payload, _ in batch]
+                )
+            except Exception:
+                future = None
+            with self._lock:
+                self._inflight.append((future, batch))
+                self._batches += 1
+                self._ready.notify()
+
+    def _run_flusher(self):
+        while True:
+            time.sleep(self.flush_interval)
+            self._dispatch()
+
+    def _run_collector(self):
+        while True:
+            with self._lock:
+                self._ready.wait_for(lambda: self._inflight)
+                future, batch = self._inflight.popleft()
+            try:
+                self._collect(future, batch)
+            finally:
+                self._slots.release()
+
+    def _collect(self, future, batch):
+        try:
+            if future is None:
+                raise RuntimeError('decode pool unavailable')
+            results, elapsed = future.result()
+        except Exception as e:
+            # Broken pool or worker crash: keep the messages, decode here
+            with self._lock:
+                self._fallbacks += 1
+            print(f"❌ Decode pool failed, decoding {len(batch)} messages inline: {e}")
+            results, elapsed = decode_batch([(topic, payload) for topic, payload, _ in batch])
+        self.decode_timer.add(elapsed, len(batch))
+        self.handoff_timer.add(time.time() - batch[0][2].timestamp(), len(batch))
+        for decoded, (_, _, received_at) in zip(results, batch):
+            try:
+                self.emit(decoded, received_at)
+            except Exception as e:
+                print(f"❌ Failed to hand off decoded message: {e}")
+
+    def start(self):
+        """Start the pool and its dispatcher threads (idempotent)"""
+        if self._executor is not None:
+            return
+        # spawn: the consumer process already runs threads, which fork would copy mid-state
+        self._executor = ProcessPoolExecutor(
+            max_workers=self.workers, mp_context=multiprocessing.get_context('spawn')
+        )
+        # Start the workers now rather than on the first batch
+        for _ in range(self.workers):
+            self._executor.submit(decode_batch, [])
+        self._threads = [
+            threading.Thread(target=self._run_flusher, name='decode-flusher', daemon=True),
+            threading.Thread(target=self._run_collector, name='decode-collector', daemon=True),
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    def stop(self):
+        """Dispatch what is pending and wait until every batch is emitted"""
+        self._dispatch()
+        # Every slot is free once the collector has emitted the last batch
+        for _ in range(self.max_inflight):
+            self._slots.acquire(timeout=30)
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+
+    def stats(self):
+        with self._lock:
+            pool = {
+                'workers': self.workers,
+                'pending': len(self._pending),
+                'inflight_batches': len(self._inflight),
+                'batches': self._batches,
+                'fallbacks': self._fallbacks,
+                'backpressure_waits': self._backpressure_waits,
+            }
+        return {
+            'mode': self.mode,
+            'json': JSON_LIBRARY,
+            'pool': pool,
+            'decode': self.decode_timer.stats(),
+            'handoff': self.handoff_timer.stats(),
+        }
+
+
+def decoder_from_settings(emit):
+    mode = getattr(settings, 'DECODE_MODE', MODE_INLINE)
+    if mode == MODE_INLINE:
+        return InlineDecoder(emit)
+    if mode == MODE_POOL:
+        return PoolDecoder(
+            emit,
+            workers=getattr(settings, 'DECODE_WORKERS', 2),
+            batch_size=getattr(settings, 'DECODE_BATCH_SIZE', 200),
+            flush_interval=getattr(settings, 'DECODE_FLUSH_INTERVAL', 0.005),
+            max_inflight=getattr(settings, 'DECODE_MAX_INFLIGHT', 8),
+        )
+    raise ValueError(f"Unknown decode mode: {mode}")
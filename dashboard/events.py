@@ -0,0 +1,165 @@
+"""In-process pub/sub hub for pushing live deltas to dashboard clients.
+
+Ingestion, the presence tracker, the sweeper and ``Device`` signals publish
+small events to :data:`event_hub`:
+
+* ``status``  - ``{device_id, status, last_seen}`` when a device changes status
+* ``log``     - ``{device_id, data, timestamp}`` for every new ``DeviceLog`` row
+* ``message`` - a new entry in the recent messages list
+
+Every event gets an increasing id and the last ``EVENT_HISTORY`` events are
+kept, so a client that reconnects with ``Last-Event-ID`` gets what it missed.
+If its id has already fallen out of the history, it gets a ``reset`` event and
+should reload its state. Each subscriber has a bounded queue. A subscriber
+that falls ``EVENT_SUBSCRIBER_QUEUE`` events behind is disconnected instead of
+being buffered without limit, and can then resume from its last event id.
+"""
+import json
+import threading
+import time
+from collections import deque
+
+from django.conf import settings
+
+
+class Event:
+    __slots__ = ('id', 'type', 'data', 'device_id')
+
+    def __init__(self, event_id, event_type, data):
+        self.id = event_id
+        self.type = event_type
+        self.data = data
+        self.device_id = data.get('device_id')
+
+    def encode(self):
+        """Server-Sent Events wire format"""
+        return f"id: {self.id}\nevent: {self.type}\ndata: {json.dumps(self.data)}\n\n"
+
+
+class Subscription:
+    def __init__(self, hub, maxsize, device_id=None):
+        self.hub = hub
+        self.device_id = device_id
+        self.maxsize = maxsize
+        self.overflowed = False
+        self._events = deque()
+        self._ready = threading.Condition()
+
+    def wants(self, event):
+        return self.device_id is None or event.device_id in (None, self.device_id)
+
+    def deliver(self, event):
+        """Queue an event; returns False once the subscriber is too far behind"""
+        with self._ready:
+            if len(self._events) >= self.maxsize:
+                self.overflowed = True
+                self._events.clear()
+                self._ready.notify()
+                return False
+            self._events.append(event)
+            self._ready.notify()
+            return True
+
+    def get(self, timeout):
+        """Return the queued events, waiting up to ``timeout`` for the first one"""
+        with self._ready:
+            if not self._events and not self.overflowed:
+                self._ready.wait(timeout)
+            events = list(self._events)
+            self._events.clear()
+            return events
+
+    def close(self):
+        self.hub.unsubscribe(self)
+
+
+class EventHub:
+    def __init__(self, history=1000, subscriber_queue=500):
+        self.subscriber_queue = subscriber_queue
+        self._history = deque(maxlen=history)
+        self._subscribers = set()
+        self._listeners = []
+        self._lock = threading.Lock()
+        # Millisecond-based start so ids keep increasing across restarts
+        self._next_id = int(time.time() * 1000)
+
+        self._published = 0
+        self._disconnected = 0
+
+    @classmethod
+    def from_settings(cls):
+        return cls(
+            history=getattr(settings, 'EVENT_HISTORY', 1000),
+            subscriber_queue=getattr(settings, 'EVENT_SUBSCRIBER_QUEUE', 500),
+        )
+
+    def publish(self, event_type, data):
+        with self._lock:
+            self._next_id += 1
+            event = Event(self._next_id, event_type, data)
+            self._history.append(event)
+            self._published += 1
+            subscribers = list(self._subscribers)
+        for listener in self._listeners:
+            listener(event)
+        for subscription in subscribers:
+            if subscription.wants(event) and not subscription.deliver(event):
+                self.unsubscribe(subscription)
+                with self._lock:
+                    self._disconnected += 1
+        return event
+
+    def add_listener(self, listener):
+        """Call ``listener(event)`` for every published event, on the publishing thread"""
+        self._listeners.append(listener)
+
+    @property
+    def last_event_id(self):
+        with self._lock:
+            return self._next_id
+
+    def publish_status(self, status, device_ids, last_seen=None):
+        for device_id in device_ids:
+            self.publish('status', {
+                'device_id': device_id,
+                'status': status,
+                'last_seen': last_seen.isoformat() if last_seen else None,
+            })
+
+    def subscribe(self, last_event_id=None, device_id=None):
+        """Register a subscriber and return it with the events it missed.
+
+        The missed events are ``None`` when ``last_event_id`` is older than the
+        retained history; the client then has to reload its state.
+        """
+        subscription = Subscription(self, self.subscriber_queue, device_id)
+        with self._lock:
+            self._subscribers.add(subscription)
+            if last_event_id is None:
+                return subscription, []
+            oldest = self._history[0].id if self._history else self._next_id + 1
+            if last_event_id < oldest - 1 or last_event_id > self._next_id:
+                # Fell out of the history, or an id from before a restart
+                return subscription, None
+            missed = [
+                event for event in self._history
+                if event.id > last_event_id and subscription.wants(event)
+            ]
+            return subscription, missed
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            self._subscribers.discard(subscription)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'subscribers': len(self._subscribers),
+                'published': self._published,
+                'history': len(self._history),
+                'last_event_id': self._next_id,
+                'slow_consumers_disconnected': self._disconnected,
+            }
+
+
+event_hub = EventHub.from_settings()
@@ -0,0 +1,147 @@
+"""Streaming export of ``DeviceLog`` history as NDJSON or CSV.
+
+Used by ``/api/logs/export/`` and ``manage.py export_logs``. Rows are read
+with ``.values_list().iterator(chunk_size=...)`` (a server-side cursor on
+PostgreSQL) and rendered one chunk at a time, optionally gzipped on the fly.
+Memory use doesn't depend on the number of rows, and the first bytes go out
+as soon as the first chunk is read.
+
+Exports for a device set run one device at a time, in timestamp order,
+through ``devicelog_device_ts_idx``. Fleet-wide exports are ordered by
+timestamp through ``devicelog_ts_idx``. Neither needs a sort.
+
+``data`` is selected as its stored JSON text, so NDJSON rows embed it
+without decoding and re-encoding every payload. Only packed payloads
+(``LOG_PAYLOAD_ENCODING``) are decoded and rendered as JSON.
+"""
+import csv
+import io
+import json
+import zlib
+
+from django.conf import settings
+from django.db.models import TextField
+from django.db.models.functions import Cast
+
+from .models import Device, DeviceLog
+from .payloads import unpack_payload
+from .registry import device_registry
+
+FORMAT_NDJSON = 'ndjson'
+FORMAT_CSV = 'csv'
+CONTENT_TYPES = {
+    FORMAT_NDJSON: 'application/x-ndjson',
+    FORMAT_CSV: 'text/csv',
+}
+CSV_HEADER = ('device_id', 'timestamp', 'data')
+# ``data`` as stored (JSON text), skipping JSONField's decoding
+RAW_DATA = Cast('data', output_field=TextField())
+
+
+def raw_payload(data, packed):
+    """JSON text of a payload from its raw ``data`` and ``data_packed`` columns"""
+    if data is not None:
+        return data
+    # Both NULL: a row saved with data=None in JSON mode
+    return json.dumps(unpack_payload(packed)) if packed is not None else 'null'
+
+
+class LogExport:
+    """One export: which rows, in which format; iterate it for the bytes"""
+
+    def __init__(self, devices=None, since=None, until=None, format=FORMAT_NDJSON,
+                 gzip=False, chunk_size=None, compress_level=6):
+        if format not in CONTENT_TYPES:
+            raise ValueError(f"Unknown export format: {format}")
+        # ``DeviceState`` objects, or None for every device
+        self.devices = devices
+        self.since = since
+        self.until = until
+        self.format = format
+        self.gzip = gzip
+        self.chunk_size = chunk_size or getattr(settings, 'EXPORT_CHUNK_SIZE', 2000)
+        self.compress_level = compress_level
+        self.rows = 0
+
+    @property
+    def content_type(self):
+        return 'application/gzip' if self.gzip else CONTENT_TYPES[self.format]
+
+    @property
+    def filename(self):
+        return f"device-logs.{self.format}" + ('.gz' if self.gzip else '')
+
+    def _filter(self, logs):
+        if self.since:
+            logs = logs.filter(timestamp__gte=self.since)
+        if self.until:
+            logs = logs.filter(timestamp__lt=self.until)
+        return logs
+
+    def iter_rows(self):
+        """Yield ``(device_id, timestamp, raw JSON data)`` in chunks from the database"""
+        if self.devices is not None:
+            for state in self.devices:
+                logs = self._filter(DeviceLog.objects.filter(device_id=state.pk))
+                rows = logs.order_by('timestamp', 'id').values_list('timestamp', RAW_DATA, 'data_packed')
+                for timestamp, data, packed in rows.iterator(chunk_size=self.chunk_size):
+                    yield state.device_id, timestamp, raw_payload(data, packed)
+            return
+
+        # Map pks from the registry instead of joining Device for every row
+        device_ids = {state.pk: state.device_id for state in device_registry.all()}
+        logs = self._filter(DeviceLog.objects.all())
+        rows = logs.order_by('timestamp').values_list('device_id', 'timestamp', RAW_DATA, 'data_packed')
+        for pk, timestamp, data, packed in rows.iterator(chunk_size=self.chunk_size):
+            device_id = device_ids.get(pk)
+            if device_id is None:
+                # Created after the registry was read
+                device_id = device_ids[pk] = Device.objects.filter(pk=pk).values_list(
+                    'device_id', flat=True
+                ).first()
+            yield device_id, timestamp, raw_payload(data, packed)
+
+    def iter_text(self):
+        """Yield the rendered export, one chunk of rows per string"""
+        buffer = io.StringIO()
+        if self.format == FORMAT_CSV:
+            writer = csv.writer(buffer)
+            writer.writerow(CSV_HEADER)
+
+            def write(device_id, timestamp, data):
+                # Plain strings are written as-is, anything else as JSON
+                writer.writerow((
+                    device_id, timestamp.isoformat(),
+                    json.loads(data) if data.startswith('"') else data
+                ))
+        else:
+            def write(device_id, timestamp, data):
+                buffer.write(f'{{"device_id": {json.dumps(device_id)}, '
+                             f'"timestamp": "{timestamp.isoformat()}", "data": {data}}}\n')
+
+        pending = 0
+        for row in self.iter_rows():
+            write(*row)
+            self.rows += 1
+            pending += 1
+            if pending >= self.chunk_size:
+                yield buffer.getvalue()
+                buffer.seek(0)
+                buffer.truncate()
+                pending = 0
+        if buffer.tell():
+            yield buffer.getvalue()
+
+    def __iter__(self):
+        """Yield the export as bytes, gzipped if requested"""
+        if not self.gzip:
+            for text in self.iter_text():
+                yield text.encode()
+            return
+        # wbits=31: gzip container, so the output is a regular .gz file
+        compressor = zlib.compressobj(self.compress_level, zlib.DEFLATED, 31)
+        for text in self.iter_text():
+            # Sync-flush every chunk so clients receive it now, not when
+            # zlib's window fills up
+            yield compressor.compress(text.encode()) + compressor.flush(zlib.Z_SYNC_FLUSH)
+        yield compressor.flush()
@@ -0,0 +1,232 @@
+"""Content-addressed firmware storage, downloads and delta patches.
+
+Firmware images are stored once per content, as ``firmware/blobs/<aa>/<sha256>``
+in the default storage. ``/api/firmware/`` reports each image's SHA-256 and
+size, and ``/api/firmware/blobs/<sha256>/`` serves it. Blobs never change,
+so that endpoint answers ``If-None-Match`` with 304, supports ``Range`` (and
+``If-Range``) for resumed downloads, and marks responses immutable. Files go
+out through ``FileResponse``, which the WSGI server can send with
+``sendfile()``. With ``FIRMWARE_SENDFILE_HEADER`` set, nginx
+(``X-Accel-Redirect``) or Apache (``X-Sendfile``) serves the file and Django
+only checks the digest.
+
+When ``bsdiff4`` is installed (``pip install bsdiff4``), saving a new
+firmware version builds a binary patch from the previous version on a
+background thread. Devices on that version ask for it with
+``/api/firmware/?from=<version>``.
+"""
+import hashlib
+import os
+import re
+import threading
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.db import close_old_connections, transaction
+
+try:
+    import bsdiff4
+except ImportError:  # optional dependency
+    bsdiff4 = None
+
+BLOB_DIR = 'firmware/blobs'
+HASH_CHUNK = 1024 * 1024
+DIGEST_RE = re.compile(r'^[0-9a-f]{64}$')
+RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+PATCH_ALGORITHM = 'bsdiff4'
+
+
+def blob_name(digest):
+    return f"{BLOB_DIR}/{digest[:2]}/{digest}"
+
+
+def hash_file(fileobj):
+    """SHA-256 hex digest and size of a file, read in chunks"""
+    sha = hashlib.sha256()
+    size = 0
+    for chunk in iter(lambda: fileobj.read(HASH_CHUNK), b''):
+        sha.update(chunk)
+        size += len(chunk)
+    return sha.hexdigest(), size
+
+
+def store_blob(storage, name, move=True):
+    """Store the file ``name`` as a blob; returns ``(blob name, digest, size)``.
+
+    With ``move`` the original is renamed into place (or deleted when the
+    same content is already stored); otherwise it is copied.
+    """
+    with storage.open(name, 'rb') as f:
+        digest, size = hash_file(f)
+    target = blob_name(digest)
+    if name == target:
+        return target, digest, size
+    if storage.exists(target):
+        if move:
+            storage.delete(name)
+        return target, digest, size
+    try:
+        source, destination = storage.path(name), storage.path(target)
+    except NotImplementedError:
+        # Remote storage: copy through the storage API
+        with storage.open(name, 'rb') as f:
+            storage.save(target, f)
+        if move:
+            storage.delete(name)
+        return target, digest, size
+    os.makedirs(os.path.dirname(destination), exist_ok=True)
+    if move:
+        os.replace(source, destination)
+    else:
+        with storage.open(name, 'rb') as f:
+            storage.save(target, f)
+    return target, digest, size
+
+
+def content_address(firmware):
+    """Move a saved firmware's file into the blob store and record its digest"""
+    from .models import Firmware
+
+    storage = firmware.firmware_file.storage
+    if not storage.exists(firmware.firmware_file.name):
+        return
+    name, digest, size = store_blob(storage, firmware.firmware_file.name)
+    firmware.firmware_file.name = name
+    firmware.sha256 = digest
+    firmware.size = size
+    Firmware.objects.filter(pk=firmware.pk).update(firmware_file=name, sha256=digest, size=size)
+    # The update bypasses post_save, so reload the manifest again
+    from .signals import firmware_changed
+    transaction.on_commit(firmware_changed)
+    # The builder thread reads the row on its own connection
+    transaction.on_commit(lambda: patch_builder.submit(firmware.pk))
+
+
+def parse_range(header, size):
+    """``(start, end)`` (inclusive) of a single ``bytes=`` range.
+
+    Returns None when there is no usable range (the whole file is sent) and
+    raises ValueError when the range can't be satisfied.
+    """
+    match = RANGE_RE.match(header.strip()) if header else None
+    if match is None:
+        # Absent, malformed or multiple ranges: send the whole file
+        return None
+    first, last = match.groups()
+    if not first:
+        if not last:
+            return None
+        # Suffix range: the last N bytes
+        length = int(last)
+        if length == 0 or size == 0:
+            raise ValueError('Empty suffix range')
+        return max(size - length, 0), size - 1
+    start = int(first)
+    if last and int(last) < start:
+        # Invalid (RFC 7233, 2.1): ignored like any other malformed range
+        return None
+    if start >= size:
+        raise ValueError('Range not satisfiable')
+    return start, min(int(last), size - 1) if last else size - 1
+
+
+class RangeFile:
+    """File-like view of ``length`` bytes of ``file`` starting at ``start``.
+
+    Keeps ``fileno()`` so a WSGI server can still ``sendfile()`` it: servers
+    such as gunicorn send from the current offset for Content-Length bytes.
+    """
+
+    def __init__(self, file, start, length):
+        self.file = file
+        self.remaining = length
+        file.seek(start)
+
+    def read(self, size=-1):
+        if size is None or size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.file.read(size)
+        self.remaining -= len(data)
+        return data
+
+    def fileno(self):
+        return self.file.fileno()
+
+    def seek(self, *args):
+        return self.file.seek(*args)
+
+    def tell(self):
+        return self.file.tell()
+
+    def close(self):
+        self.file.close()
+
+
+class PatchBuilder:
+    """Builds delta patches to new firmware versions on a background thread"""
+
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self._warned = False
+
+    @classmethod
+    def from_settings(cls):
+        return cls(enabled=getattr(settings, 'FIRMWARE_DELTA_PATCHES', True))
+
+    def submit(self, firmware_pk):
+        if not self.enabled:
+            return
+        if bsdiff4 is None:
+            if not self._warned:
+                self._warned = True
+                print("⚠️ bsdiff4 is not installed; firmware delta patches are disabled")
+            return
+        threading.Thread(
+            target=self._run, args=(firmware_pk,), name='firmware-patch', daemon=True
+        ).start()
+
+    def _run(self, firmware_pk):
+        try:
+            close_old_connections()
+            # One patch at a time: bsdiff holds both images in memory
+            with self._lock:
+                patch = self.build(firmware_pk)
+            if patch is not None:
+                print(f"📦 Built firmware patch {patch}")
+        except Exception as e:
+            print(f"❌ Failed to build firmware patch: {e}")
+        finally:
+            close_old_connections()
+
+    def build(self, firmware_pk):
+        """Build the patch from the previous version to ``firmware_pk``"""
+        from .models import Firmware, FirmwarePatch
+
+        target = Firmware.objects.get(pk=firmware_pk)
+        # Devices of the target's type run either its type's or generic firmware
+        source = Firmware.objects.filter(
+            created_at__lt=target.created_at, sha256__gt='',
+            device_type__in={'', target.device_type},
+        ).exclude(pk=target.pk).order_by('-created_at').first()
+        if source is None or source.sha256 == target.sha256:
+            return None
+        if FirmwarePatch.objects.filter(source=source, target=target).exists():
+            return None
+        with source.firmware_file.open('rb') as f:
+            old = f.read()
+        with target.firmware_file.open('rb') as f:
+            new = f.read()
+        data = bsdiff4.diff(old, new)
+        digest = hashlib.sha256(data).hexdigest()
+        storage = target.firmware_file.storage
+        name = blob_name(digest)
+        if not storage.exists(name):
+            storage.save(name, ContentFile(data))
+        return FirmwarePatch.objects.create(
+            source=source, target=target, algorithm=PATCH_ALGORITHM,
+            sha256=digest, size=len(data),
+        )
+
+
+patch_builder = PatchBuilder.from_settings()
@@ -0,0 +1,406 @@
+"""Fleet commands: one API call sends a command to a selection of devices.
+
+``POST /api/commands/`` selects devices from the device registry by
+``device_type``, ``status`` and/or ``device_ids`` (listed devices this
+process hasn't seen yet cost one query), and queues a :class:`CommandRun` on
+:data:`fleet_dispatcher`. One dispatcher thread per web process publishes
+every command's messages in batches of ``FLEET_COMMAND_BATCH_SIZE``,
+round-robin across running commands, paced to ``FLEET_COMMAND_RATE``
+messages per second in total. With QoS 1 or 2 each batch waits for the
+broker's acknowledgements before the next one, so at most one batch is ever
+in flight.
+
+Each device gets its own message on ``FLEET_COMMAND_TOPIC`` (by default
+``check/<device_id>``)::
+
+    {"device-id": "BMF12", "message": "ping", "command-id": "<id>", ...payload}
+
+and acknowledges by echoing ``command-id`` on ``check/response``. The
+consumer worker that owns the device turns that into an ``ack`` event, and
+the event bridge hands it to the dispatcher in every web process; the one
+that sent the command counts it. ``update`` commands carry each device's
+firmware from the manifest (``manifest.py``), so pushing an update to a
+rollout cohort is one call.
+
+Each acknowledgement records the device's round-trip time, from the publish
+to the moment the consumer received the reply (see ``pending.py``).
+
+A command is ``complete`` when every device has acknowledged, or
+``timed_out`` ``FLEET_COMMAND_ACK_TIMEOUT`` seconds after its last message
+was sent. Progress is kept in memory by the sending process and copied to
+its ``FleetCommand`` row about once a second for the other processes.
+"""
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from datetime import datetime
+
+from django.conf import settings
+from django.db import close_old_connections
+from django.utils import timezone
+
+from .manifest import firmware_manifest
+from .models import FleetCommand
+from .mqtt import publish_many
+from .pending import round_trip_ms
+from .registry import device_registry
+
+FIRMWARE_COMMAND = 'update'
+STATUSES = ('online', 'idle', 'offline')
+
+STATUS_DISPATCHING = 'dispatching'
+STATUS_WAITING = 'waiting'
+STATUS_COMPLETE = 'complete'
+STATUS_TIMED_OUT = 'timed_out'
+
+SAVE_INTERVAL = 1.0
+
+
+class InvalidCommand(ValueError):
+    """Raised for malformed selectors, commands or options"""
+
+
+def select_devices(device_type=None, status=None, device_ids=None):
+    """Registry states matching every given criterion, ordered by device_id"""
+    if not (device_type or status or device_ids):
+        raise InvalidCommand('Select devices by device_type, status and/or device_ids')
+    if status and status not in STATUSES:
+        raise InvalidCommand(f"status must be one of {', '.join(STATUSES)}")
+    if device_ids is not None:
+        states = device_registry.get_many(device_ids).values()
+    else:
+        states = device_registry.all()
+    return sorted(
+        (
+            state for state in states
+            if (not device_type or state.device_type == device_type)
+            and (not status or (state.status or 'offline') == status)
+        ),
+        key=lambda state: state.device_id,
+    )
+
+
+class CommandRun:
+    """Dispatch and acknowledgement state of one fleet command"""
+
+    def __init__(self, command_id, command, payload, qos, targets, base_url=''):
+        self.command_id = command_id
+        self.command = command
+        self.payload = payload
+        self.qos = qos
+        self.base_url = base_url
+        # device_id -> device_type, in dispatch order
+        self.targets = OrderedDict((state.device_id, state.device_type) for state in targets)
+        self.status = STATUS_DISPATCHING if self.targets else STATUS_COMPLETE
+        self.started_at = time.time()
+        self.finished_at = None if self.targets else self.started_at
+        self.last_sent_at = None
+
+        self._queue = list(self.targets)
+        self._next = 0
+        # device_id -> epoch seconds it was sent at
+        self.sent = {}
+        # device_id -> (response, received at, round trip in ms)
+        self.acked = {}
+        self.failed = {}
+        self.changed = True
+
+    def next_batch(self, size):
+        batch = self._queue[self._next:self._next + size]
+        self._next += len(batch)
+        return batch
+
+    @property
+    def dispatched(self):
+        return self._next >= len(self._queue)
+
+    def message(self, device_id, topic_template):
+        """``(topic, message)`` for one device, or None when it has nothing to send"""
+        device_type = self.targets[device_id]
+        message = dict(self.payload, **{
+            'device-id': device_id,
+            'message': self.command,
+            'command-id': self.command_id,
+        })
+        if self.command == FIRMWARE_COMMAND:
+            firmware = firmware_manifest.resolve(device_type, device_id)
+            if firmware is None:
+                return None
+            message.update({
+                'version': firmware.version,
+                'url': self.base_url.rstrip('/') + firmware.path,
+                'sha256': firmware.sha256,
+                'size': firmware.size,
+            })
+        return topic_template.format(device_id=device_id, device_type=device_type or ''), message
+
+    def ack(self, device_id, data, timestamp):
+        if device_id not in self.sent or device_id in self.acked:
+            return False
+        self.acked[device_id] = (data, timestamp, round_trip_ms(self.sent[device_id], timestamp))
+        self.changed = True
+        if len(self.acked) == len(self.sent) and self.dispatched:
+            self.finish(STATUS_COMPLETE)
+        return True
+
+    def finish(self, status):
+        if self.finished_at is None:
+            self.status = status
+            self.finished_at = time.time()
+            self.changed = True
+
+    def progress(self):
+        done = len(self.acked) + len(self.failed)
+        rtts = sorted(rtt for _, _, rtt in self.acked.values())
+        return {
+            'command_id': self.command_id,
+            'command': self.command,
+            'status': self.status,
+            'targets': len(self.targets),
+            'sent': len(self.sent),
+            'acked': len(self.acked),
+            'failed': len(self.failed),
+            'pending': len(self.targets) - done,
+            'progress': round(done / len(self.targets), 4) if self.targets else 1.0,
+            'elapsed_seconds': round((self.finished_at or time.time()) - self.started_at, 3),
+            'rtt_ms_p50': rtts[len(rtts) // 2] if rtts else None,
+            'rtt_ms_p95': rtts[min(len(rtts) - 1, len(rtts) * 95 // 100)] if rtts else None,
+            'rtt_ms_max': rtts[-1] if rtts else None,
+        }
+
+    def details(self):
+        """Per-device outcome: acknowledgements, failures and devices still pending"""
+        return {
+            'acked_devices': {
+                device_id: {'data': data, 'timestamp': timestamp, 'rtt_ms': rtt}
+                for device_id, (data, timestamp, rtt) in self.acked.items()
+            },
+            'failed_devices': dict(self.failed),
+            'pending_devices': [
+                device_id for device_id in self.targets
+                if device_id not in self.acked and device_id not in self.failed
+            ],
+        }
+
+
+class FleetDispatcher:
+    """Sends fleet commands from one thread, rate limited across commands"""
+
+    def __init__(self, topic='check/{device_id}', rate=500, batch_size=100, qos=1,
+                 ack_timeout=60.0, publish_timeout=10.0, history=100):
+        self.topic = topic
+        self.rate = rate
+        self.batch_size = batch_size
+        self.qos = qos
+        self.ack_timeout = ack_timeout
+        self.publish_timeout = publish_timeout
+        self.history = history
+        self.client = None
+        self._runs = OrderedDict()
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = None
+        self._next_send = 0.0
+
+        self._published = 0
+        self._failed = 0
+        self._acks = 0
+        self._unmatched_acks = 0
+
+    @classmethod
+    def from_settings(cls):
+        return cls(
+            topic=getattr(settings, 'FLEET_COMMAND_TOPIC', 'check/{device_id}'),
+            rate=getattr(settings, 'FLEET_COMMAND_RATE', 500),
+            batch_size=getattr(settings, 'FLEET_COMMAND_BATCH_SIZE', 100),
+            qos=getattr(settings, 'FLEET_COMMAND_QOS', 1),
+            ack_timeout=getattr(settings, 'FLEET_COMMAND_ACK_TIMEOUT', 60),
+            publish_timeout=getattr(settings, 'FLEET_COMMAND_PUBLISH_TIMEOUT', 10),
+            history=getattr(settings, 'FLEET_COMMAND_HISTORY', 100),
+        )
+
+    def submit(self, client, command, selector, payload=None, qos=None, base_url=''):
+        """Select the devices, record the command and queue it; returns its run"""
+        command = str(command or '').strip()
+        if not command:
+            raise InvalidCommand('command is required')
+        if len(command) > 50:
+            raise InvalidCommand('command is too long')
+        if payload is not None and not isinstance(payload, dict):
+            raise InvalidCommand('payload must be an object')
+        qos = self.qos if qos is None else qos
+        if qos not in (0, 1, 2):
+            raise InvalidCommand('qos must be 0, 1 or 2')
+        device_ids = selector.get('device_ids')
+        if isinstance(device_ids, str):
+            device_ids = [device_id.strip() for device_id in device_ids.split(',') if device_id.strip()]
+        selector = {
+            'device_type': selector.get('device_type') or None,
+            'status': selector.get('status') or None,
+            'device_ids': device_ids or None,
+        }
+        targets = select_devices(**selector)
+
+        run = CommandRun(uuid.uuid4().hex, command, payload or {}, qos, targets, base_url)
+        FleetCommand.objects.create(
+            command_id=run.command_id, command=command, payload=run.payload,
+            selector={key: value for key, value in selector.items() if value},
+            qos=qos, status=run.status, targets=len(run.targets),
+            finished_at=timezone.now() if run.finished_at else None,
+        )
+        run.changed = False
+        self.client = client
+        with self._lock:
+            self._runs[run.command_id] = run
+            while len(self._runs) > self.history:
+                oldest = next(iter(self._runs))
+                if self._runs[oldest].finished_at is None:
+                    break
+                del self._runs[oldest]
+        self.start()
+        self._wakeup.set()
+        return run
+
+    def progress(self, command_id, details=False):
+        """Progress of a command sent by this process, or None"""
+        with self._lock:
+            run = self._runs.get(command_id)
+            if run is None:
+                return None
+            response = run.progress()
+            if details:
+                response.update(run.details())
+            return response
+
+    def ack(self, command_id, device_id, data=None, timestamp=None):
+        """Count an acknowledgement; ignored unless this process sent the command"""
+        with self._lock:
+            run = self._runs.get(command_id)
+            if run is None:
+                self._unmatched_acks += 1
+                return False
+            matched = run.ack(device_id, data, timestamp)
+            if matched:
+                self._acks += 1
+        return matched
+
+    def start(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._thread = threading.Thread(target=self._run, name='fleet-dispatch', daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        last_save = 0.0
+        while True:
+            try:
+                sent = self.dispatch_round()
+                now = time.monotonic()
+                if now - last_save >= SAVE_INTERVAL:
+                    last_save = now
+                    self.expire()
+                    self.save_progress()
+                if not sent:
+                    self._wakeup.wait(SAVE_INTERVAL)
+                    self._wakeup.clear()
+            except Exception as e:
+                print(f"❌ Fleet dispatch failed: {e}")
+                time.sleep(SAVE_INTERVAL)
+
+    def dispatch_round(self):
+        """Send one batch of every command still dispatching; returns messages sent"""
+        with self._lock:
+            runs = [run for run in self._runs.values() if run.status == STATUS_DISPATCHING]
+        total = 0
+        for run in runs:
+            with self._lock:
+                batch = run.next_batch(self.batch_size)
+            messages = []
+            skipped = []
+            for device_id in batch:
+                message = run.message(device_id, self.topic)
+                if message is None:
+                    skipped.append(device_id)
+                else:
+                    messages.append((device_id, message))
+
+            # Pace the batch to the dispatcher's rate
+            delay = self._next_send - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            self._next_send = max(self._next_send, time.monotonic()) + len(messages) / self.rate
+            with self._lock:
+                # Counted as sent up front: a device may answer before the
+                # broker has acknowledged the rest of the batch
+                sent_at = time.time()
+                run.sent.update((device_id, sent_at) for device_id, _ in messages)
+            failed = set(publish_many(
+                self.client, [message for _, message in messages], run.qos, self.publish_timeout
+            ))
+
+            with self._lock:
+                for device_id in skipped:
+                    run.failed[device_id] = 'no firmware offered'
+                for index in failed:
+                    device_id = messages[index][0]
+                    run.sent.pop(device_id, None)
+                    run.acked.pop(device_id, None)
+                    run.failed[device_id] = 'publish failed'
+                self._published += len(messages) - len(failed)
+                self._failed += len(failed)
+                run.last_sent_at = time.monotonic()
+                run.changed = True
+                if run.dispatched:
+                    if len(run.acked) == len(run.sent):
+                        run.finish(STATUS_COMPLETE)
+                    else:
+                        run.status = STATUS_WAITING
+            total += len(messages)
+        return total
+
+    def expire(self):
+        """Time out commands whose acknowledgements are overdue"""
+        now = time.monotonic()
+        with self._lock:
+            for run in self._runs.values():
+                if run.status == STATUS_WAITING and now - run.last_sent_at >= self.ack_timeout:
+                    run.finish(STATUS_TIMED_OUT)
+
+    def save_progress(self):
+        """Copy changed commands' progress to their ``FleetCommand`` rows"""
+        with self._lock:
+            changed = [run for run in self._runs.values() if run.changed]
+            updates = []
+            for run in changed:
+                run.changed = False
+                updates.append((run.command_id, {
+                    'status': run.status,
+                    'sent': len(run.sent),
+                    'acked': len(run.acked),
+                    'failed': len(run.failed),
+                    'finished_at': (
+                        datetime.fromtimestamp(run.finished_at, timezone.utc)
+                        if run.finished_at else None
+                    ),
+                }))
+        if not updates:
+            return
+        close_old_connections()
+        for command_id, fields in updates:
+            FleetCommand.objects.filter(command_id=command_id).update(**fields)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'running': sum(1 for run in self._runs.values() if run.finished_at is None),
+                'published': self._published,
+                'failed': self._failed,
+                'acks': self._acks,
+                'unmatched_acks': self._unmatched_acks,
+                'rate': self.rate,
+                'batch_size': self.batch_size,
+            }
+
+
+fleet_dispatcher = FleetDispatcher.from_settings()
@@ -0,0 +1,132 @@
+"""Coalesced ``last_seen``/``status`` writer for device heartbeats.
+
+Heartbeats only move ``last_seen`` forward, so there is no point in a
+validated ``Device.save()`` per message. :data:`heartbeat_writer` keeps the
+newest ``last_seen`` and status per device in memory and writes all of them
+every ``HEARTBEAT_FLUSH_INTERVAL`` seconds with a single ``UPDATE ... CASE``
+statement per chunk of devices (``UPDATE ... FROM (VALUES ...)`` on
+PostgreSQL, see storage.py). Only values newer than what is stored are
+applied, so ``last_seen`` never moves backwards even if messages arrive out
+of order or from several processes.
+"""
+import threading
+import time
+
+from django.conf import settings
+from django.db import close_old_connections, transaction
+
+from .database import db_writer
+from .registry import device_registry
+from .storage import storage
+from .versions import next_fleet_version
+
+
+class HeartbeatWriter:
+    """Keeps the latest heartbeat per device and flushes them periodically"""
+
+    def __init__(self, flush_interval=5.0):
+        self.flush_interval = flush_interval
+        self._pending = {}
+        self._listeners = []
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._thread = None
+
+        self._recorded = 0
+        self._flushes = 0
+        self._rows_written = 0
+        self._last_flush_size = 0
+        self._last_flush_latency = 0.0
+        self._failed_flushes = 0
+
+    @classmethod
+    def from_settings(cls):
+        return cls(flush_interval=getattr(settings, 'HEARTBEAT_FLUSH_INTERVAL', 5.0))
+
+    def record(self, pk, device_id, last_seen, status):
+        """Remember a heartbeat; older heartbeats than the pending one are ignored"""
+        with self._lock:
+            self._recorded += 1
+            current = self._pending.get(pk)
+            if current is None or last_seen > current[1]:
+                self._pending[pk] = (device_id, last_seen, status)
+        # The registry serves the status API, so it reflects heartbeats immediately
+        state = device_registry.get(device_id)
+        if state is not None and (state.last_seen is None or last_seen > state.last_seen):
+            device_registry.update(device_id, last_seen=last_seen, status=status)
+        for listener in self._listeners:
+            listener(device_id, last_seen, status)
+
+    def add_listener(self, listener):
+        """Call ``listener(device_id, last_seen, status)`` for every heartbeat"""
+        self._listeners.append(listener)
+
+    def flush(self):
+        """Write every pending heartbeat; returns the number of rows updated"""
+        with self._flush_lock:
+            with self._lock:
+                pending, self._pending = self._pending, {}
+            if not pending:
+                return 0
+
+            started = time.monotonic()
+            updated = 0
+            items = list(pending.items())
+            try:
+                chunk = storage.heartbeat_chunk
+                for start in range(0, len(items), chunk):
+                    updated += db_writer.run(self._write, items[start:start + chunk])
+            except Exception:
+                # Put back what we could not write unless something newer arrived
+                with self._lock:
+                    self._failed_flushes += 1
+                    for pk, heartbeat in items:
+                        current = self._pending.get(pk)
+                        if current is None or heartbeat[1] > current[1]:
+                            self._pending[pk] = heartbeat
+                raise
+
+            latency = time.monotonic() - started
+            with self._lock:
+                self._flushes += 1
+                self._rows_written += updated
+                self._last_flush_size = len(items)
+                self._last_flush_latency = latency
+            return updated
+
+    def _write(self, items):
+        """One set-based UPDATE for a chunk of (pk, (device_id, last_seen, status))"""
+        with transaction.atomic():
+            return storage.update_heartbeats(items, next_fleet_version())
+
+    def start(self):
+        """Start the periodic flush thread (idempotent)"""
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._thread = threading.Thread(target=self._run, name='heartbeat-writer', daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.flush_interval)
+            try:
+                close_old_connections()
+                self.flush()
+            except Exception as e:
+                print(f"❌ Failed to flush heartbeats: {e}")
+
+    def stats(self):
+        with self._lock:
+            return {
+                'pending': len(self._pending),
+                'flush_interval': self.flush_interval,
+                'recorded': self._recorded,
+                'flushes': self._flushes,
+                'rows_written': self._rows_written,
+                'failed_flushes': self._failed_flushes,
+                'last_flush_size': self._last_flush_size,
+                'last_flush_latency_ms': round(self._last_flush_latency * 1000, 3),
+            }
+
+
+heartbeat_writer = HeartbeatWriter.from_settings()
@@ -0,0 +1,325 @@
+"""Bulk import of device logs from NDJSON or CSV files (``manage.py import_logs``).
+
+For backfills from gateways that were offline and migrations from other
+systems. Files are streamed (gzip is detected from the magic bytes), so
+memory use doesn't depend on the file size. Each record needs a
+``device_id`` (or ``device-id``), a ``timestamp`` (ISO 8601 or epoch
+seconds) and ``data``. ``device_type`` is optional and used when a device
+is auto-created. Files written by ``manage.py export_logs`` import as-is.
+
+Device ids are resolved through an in-memory map built from the device
+registry. Unknown devices are created in bulk with the batch that first
+mentions them. Rows are inserted in batches of ``IMPORT_BATCH_SIZE`` through
+:data:`~dashboard.storage.storage` (``COPY`` on PostgreSQL), and each batch
+is its own transaction. That transaction also
+saves the file's :class:`ImportCheckpoint`, so an interrupted import
+resumes right after the last committed batch without duplicating rows.
+"""
+import csv
+import gzip
+import json
+import os
+import queue
+import threading
+import time
+from datetime import datetime, timezone as dt_timezone
+from operator import itemgetter
+
+from django.conf import settings
+from django.db import transaction
+
+from .decoding import (
+    DEVICE_ID_MAX_LENGTH, DEVICE_NAME_MAX_LENGTH, DEVICE_TYPE_MAX_LENGTH, json_loads,
+)
+from .export import FORMAT_CSV, FORMAT_NDJSON
+from .models import Device, ImportCheckpoint
+from .payloads import payload_codec
+from .registry import DeviceState, device_registry
+from .storage import storage, timestamp_adapter
+from .versions import next_fleet_version
+
+GZIP_MAGIC = b'\x1f\x8b'
+SUFFIX_FORMATS = {
+    '.csv': FORMAT_CSV,
+    '.ndjson': FORMAT_NDJSON,
+    '.jsonl': FORMAT_NDJSON,
+    '.json': FORMAT_NDJSON,
+}
+
+
+class InvalidRecord(ValueError):
+    """Raised for records that can't be imported; they are counted and skipped"""
+
+
+def detect_format(path):
+    name = path[:-3] if path.endswith('.gz') else path
+    try:
+        return SUFFIX_FORMATS[os.path.splitext(name)[1].lower()]
+    except KeyError:
+        raise ValueError(f"Can't tell the format of {path}, pass it explicitly")
+
+
+def parse_timestamp(value):
+    """ISO 8601 string or epoch seconds -> aware datetime (naive means UTC)"""
+    if isinstance(value, str):
+        try:
+            parsed = datetime.fromisoformat(value)
+        except ValueError:
+            try:
+                value = float(value)
+            except ValueError:
+                raise InvalidRecord(f"Invalid timestamp: {value!r}")
+        else:
+            return parsed if parsed.tzinfo else parsed.replace(tzinfo=dt_timezone.utc)
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return datetime.fromtimestamp(value, tz=dt_timezone.utc)
+    raise InvalidRecord(f"Invalid timestamp: {value!r}")
+
+
+def prefetch(iterable, depth=2):
+    """Iterate ``iterable`` on a background thread, up to ``depth`` items ahead.
+
+    SQLite and psycopg2 release the GIL while executing, so parsing the next
+    batch overlaps with inserting the current one.
+    """
+    items = queue.Queue(maxsize=depth)
+    stop = threading.Event()
+    done = object()
+
+    def produce():
+        try:
+            for item in iterable:
+                while not stop.is_set():
+                    try:
+                        items.put((item, None), timeout=0.5)
+                        break
+                    except queue.Full:
+                        pass
+                if stop.is_set():
+                    return
+            items.put((done, None))
+        except Exception as e:
+            items.put((done, e))
+
+    threading.Thread(target=produce, name='import-reader', daemon=True).start()
+    try:
+        while True:
+            item, error = items.get()
+            if error is not None:
+                raise error
+            if item is done:
+                return
+            yield item
+    finally:
+        stop.set()
+
+
+class LogImporter:
+    """Imports one file; :meth:`run` returns the import stats"""
+
+    def __init__(self, path, format=None, batch_size=None, create_devices=True,
+                 device_type='unknown', resume=True):
+        self.path = path
+        self.source = os.path.abspath(path)
+        self.format = format or detect_format(path)
+        if self.format not in (FORMAT_CSV, FORMAT_NDJSON):
+            raise ValueError(f"Unknown import format: {self.format}")
+        if not os.path.isfile(path):
+            raise FileNotFoundError(f"No such file: {path}")
+        if len(device_type) > DEVICE_TYPE_MAX_LENGTH:
+            raise ValueError(f"device_type is longer than {DEVICE_TYPE_MAX_LENGTH} characters")
+        self.batch_size = batch_size or getattr(settings, 'IMPORT_BATCH_SIZE', 10000)
+        self.create_devices = create_devices
+        self.device_type = device_type
+        self.resume = resume
+
+        self.compressed = False
+        self.offset = 0
+        self.device_ids = {}
+        self.imported = 0
+        self.skipped = 0
+        self.created_devices = []
+        self.batches = 0
+
+    def _lines(self, handle):
+        """Yield raw lines, keeping ``offset`` just past the last one yielded"""
+        for line in handle:
+            self.offset += len(line)
+            yield line
+
+    def _records(self, handle, checkpoint):
+        """Yield ``(device_id, device_type, timestamp, data)``, or None for records
+        that are skipped, one per record after the checkpoint"""
+        header = None
+        if self.format == FORMAT_CSV:
+            header = next(csv.reader([handle.readline().decode('utf-8-sig')]), None)
+            self.offset = handle.tell() if not self.compressed else 0
+        if checkpoint.position and not self.compressed:
+            # Uncompressed files resume with a seek...
+            handle.seek(checkpoint.offset)
+            self.offset = checkpoint.offset
+        lines = self._lines(handle)
+
+        if self.format == FORMAT_CSV:
+            rows = csv.DictReader((line.decode('utf-8') for line in lines), fieldnames=header)
+        else:
+            rows = (self._load_json(line) for line in lines)
+
+        resume_at = checkpoint.position if self.compressed else 0
+        for position, row in enumerate(rows, 1):
+            if position <= resume_at:
+                # ...gzip files by skipping what was already imported
+                continue
+            if row is None:
+                # Blank line: advances the checkpoint, but isn't counted
+                yield None
+                continue
+            try:
+                yield self._parse(row)
+            except InvalidRecord as e:
+                self.skipped += 1
+                if self.skipped <= 10:
+                    print(f"⚠️ Skipping a record in {self.path}: {e}")
+                yield None
+
+    @staticmethod
+    def _load_json(line):
+        if not line.strip():
+            return None
+        try:
+            return json_loads(line)
+        except ValueError as e:
+            return InvalidRecord(f"Invalid JSON: {e}")
+
+    def _parse(self, row):
+        if isinstance(row, InvalidRecord):
+            raise row
+        if not isinstance(row, dict):
+            raise InvalidRecord(f"Not a record: {row!r}")
+        device_id = str(row.get('device_id') or row.get('device-id') or '').strip()
+        if not device_id.isalnum():
+            raise InvalidRecord(f"Invalid device_id: {device_id!r}")
+        # Same limits as live messages (see decoding.py): the Device columns
+        device_type = str(row.get('device_type') or '').strip() or None
+        if len(device_id) > DEVICE_ID_MAX_LENGTH:
+            raise InvalidRecord(f"device_id too long: {device_id[:DEVICE_ID_MAX_LENGTH]!r}...")
+        if device_type is not None and len(device_type) > DEVICE_TYPE_MAX_LENGTH:
+            raise InvalidRecord(f"device_type too long: {device_type[:DEVICE_TYPE_MAX_LENGTH]!r}...")
+        if len(f"{device_type or self.device_type} - {device_id}") > DEVICE_NAME_MAX_LENGTH:
+            raise InvalidRecord(f"device_id too long for a device name: {device_id!r}")
+        if 'data' in row:
+            data = row['data']
+        elif 'message' in row:
+            data = row['message']
+        else:
+            raise InvalidRecord('Missing data')
+        if self.format == FORMAT_CSV and isinstance(data, str) and data[:1] in ('{', '['):
+            # Structured payloads are written as JSON by export_logs
+            try:
+                data = json.loads(data)
+            except ValueError:
+                pass
+        return device_id, device_type, parse_timestamp(row.get('timestamp')), data
+
+    def _resolve(self, batch):
+        """Map the batch's device_ids to pks, creating unknown devices"""
+        missing = {}
+        for device_id, device_type, timestamp, _, _ in batch:
+            if device_id not in self.device_ids and device_id not in missing:
+                missing[device_id] = (device_type or self.device_type, timestamp)
+        if not missing or not self.create_devices:
+            return
+        version = next_fleet_version()
+        Device.objects.bulk_create([
+            Device(
+                device_id=device_id, device_type=device_type, status='offline',
+                last_seen=timestamp, name=f"{device_type} - {device_id}", version=version,
+            )
+            for device_id, (device_type, timestamp) in missing.items()
+        ], ignore_conflicts=True)
+        for device in Device.objects.filter(device_id__in=list(missing)).only(
+            'id', 'device_id', 'name', 'device_type', 'status', 'last_seen'
+        ):
+            self.device_ids[device.device_id] = device.pk
+            self.created_devices.append(DeviceState.from_device(device))
+
+    def _batches(self, handle, checkpoint, adapt):
+        """Yield ``(records, consumed, offset)`` batches with the values
+        already prepared for ``storage.insert_logs()`` (runs on the reader thread)"""
+        batch = []
+        consumed = 0
+        for record in self._records(handle, checkpoint):
+            consumed += 1
+            if record is None:
+                continue
+            device_id, device_type, timestamp, data = record
+            batch.append((device_id, device_type, timestamp, adapt(timestamp), payload_codec.prepare(data)))
+            if len(batch) >= self.batch_size:
+                yield batch, consumed, self.offset
+                batch = []
+                consumed = 0
+        yield batch, consumed, self.offset
+
+    def _commit(self, batch, consumed, offset, checkpoint, completed=False):
+        with transaction.atomic():
+            self._resolve(batch)
+            logs = []
+            for device_id, _, _, timestamp, payload in batch:
+                pk = self.device_ids.get(device_id)
+                if pk is None:
+                    self.skipped += 1
+                    continue
+                logs.append((pk, timestamp, *payload))
+            # In (device, timestamp) order the inserts walk
+            # devicelog_device_ts_idx instead of hopping around it
+            logs.sort(key=itemgetter(0, 1))
+            storage.insert_logs(logs)
+
+            checkpoint.position += consumed
+            checkpoint.offset = offset
+            checkpoint.rows_imported += len(logs)
+            checkpoint.completed = completed
+            checkpoint.save()
+        self.imported += len(logs)
+        self.batches += 1
+
+    def run(self, progress=None):
+        """Import the file; ``progress(importer)`` is called after every batch"""
+        checkpoint, _ = ImportCheckpoint.objects.get_or_create(source=self.source)
+        if not self.resume:
+            checkpoint.position = checkpoint.offset = checkpoint.rows_imported = 0
+            checkpoint.completed = False
+        started = time.monotonic()
+        if checkpoint.completed:
+            return self.stats(checkpoint, started)
+
+        self.device_ids = {state.device_id: state.pk for state in device_registry.all()}
+        with open(self.path, 'rb') as raw:
+            self.compressed = raw.read(2) == GZIP_MAGIC
+            raw.seek(0)
+            handle = gzip.GzipFile(fileobj=raw) if self.compressed else raw
+            batches = prefetch(self._batches(handle, checkpoint, timestamp_adapter()))
+            for batch, consumed, offset in batches:
+                self._commit(batch, consumed, offset, checkpoint)
+                if progress is not None:
+                    progress(self)
+        checkpoint.completed = True
+        checkpoint.save()
+
+        for state in self.created_devices:
+            device_registry.put(state)
+        return self.stats(checkpoint, started)
+
+    def stats(self, checkpoint, started):
+        elapsed = time.monotonic() - started
+        return {
+            'source': self.source,
+            'imported': self.imported,
+            'skipped': self.skipped,
+            'created_devices': len(self.created_devices),
+            'batches': self.batches,
+            'total_imported': checkpoint.rows_imported,
+            'completed': checkpoint.completed,
+            'seconds': round(elapsed, 3),
+            'rows_per_second': round(self.imported / elapsed) if elapsed else None,
+        }
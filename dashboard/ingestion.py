@@ -0,0 +1,320 @@
+"""Write-behind ingestion pipeline for inbound MQTT messages.
+
+``on_message`` runs on paho's network thread, so it only validates the payload
+and puts a small record on :data:`ingest_queue`. A flusher thread drains the
+queue whenever a batch fills up or the flush interval elapses, and writes the
+whole batch with a few set-based queries instead of several per message.
+Device ``last_seen``/``status`` updates go through the heartbeat writer.
+
+A record is a plain dict::
+
+    {
+        'device_id': 'ESP123',
+        'device_type': 'ESP',      # None when the topic does not carry a type
+        'status': 'online',
+        'data': 'online',
+        'timestamp': <aware datetime>,
+    }
+"""
+import threading
+import time
+from collections import deque
+
+from django.conf import settings
+from django.db import close_old_connections, transaction
+
+from .database import db_writer
+from .models import Device, DeviceLog
+from .events import event_hub
+from .heartbeat import heartbeat_writer
+from .payloads import payload_codec
+from .presence import presence_tracker
+from .registry import DeviceState, device_registry
+from .storage import storage, timestamp_adapter
+from .timing import StageTimer
+from .versions import next_fleet_version
+
+BACKPRESSURE_DROP_OLDEST = 'drop_oldest'
+BACKPRESSURE_BLOCK = 'block'
+
+# SQLite refuses statements with more than 999 bound parameters
+LOG_LOOKUP_CHUNK = 400
+
+
+class IngestionQueue:
+    """Bounded in-process queue with a background flusher"""
+
+    def __init__(self, maxsize=10000, batch_size=500, flush_interval=1.0,
+                 backpressure=BACKPRESSURE_DROP_OLDEST, block_timeout=5.0):
+        if backpressure not in (BACKPRESSURE_DROP_OLDEST, BACKPRESSURE_BLOCK):
+            raise ValueError(f"Unknown backpressure policy: {backpressure}")
+        self.maxsize = maxsize
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.backpressure = backpressure
+        self.block_timeout = block_timeout
+
+        self._items = deque()
+        self._lock = threading.Lock()
+        self._not_empty = threading.Condition(self._lock)
+        self._not_full = threading.Condition(self._lock)
+        self._thread = None
+
+        self.persist_timer = StageTimer()
+        self._enqueued = 0
+        self._dropped = 0
+        self._blocked = 0
+        self._flushed = 0
+        self._batches = 0
+        self._failed_batches = 0
+        self._last_batch_size = 0
+        self._last_flush_latency = 0.0
+        self._max_flush_latency = 0.0
+        self._total_flush_time = 0.0
+
+    @classmethod
+    def from_settings(cls):
+        return cls(
+            maxsize=getattr(settings, 'INGEST_QUEUE_MAXSIZE', 10000),
+            batch_size=getattr(settings, 'INGEST_BATCH_SIZE', 500),
+            flush_interval=getattr(settings, 'INGEST_FLUSH_INTERVAL', 1.0),
+            backpressure=getattr(settings, 'INGEST_BACKPRESSURE', BACKPRESSURE_DROP_OLDEST),
+            block_timeout=getattr(settings, 'INGEST_BLOCK_TIMEOUT', 5.0),
+        )
+
+    def put(self, record):
+        """Enqueue a record, applying the backpressure policy when full.
+
+        Returns False if a record had to be dropped to make room (or, with the
+        ``block`` policy, if the queue stayed full for ``block_timeout``).
+        """
+        with self._lock:
+            accepted = True
+            if len(self._items) >= self.maxsize:
+                if self.backpressure == BACKPRESSURE_BLOCK:
+                    self._blocked += 1
+                    self._not_full.wait_for(
+                        lambda: len(self._items) < self.maxsize,
+                        timeout=self.block_timeout
+                    )
+                    if len(self._items) >= self.maxsize:
+                        self._dropped += 1
+                        return False
+                else:
+                    self._items.popleft()
+                    self._dropped += 1
+                    accepted = False
+            self._items.append(record)
+            self._enqueued += 1
+            if len(self._items) >= self.batch_size:
+                self._not_empty.notify()
+            return accepted
+
+    def get_batch(self, timeout=None):
+        """Wait until a full batch is queued or ``timeout`` elapses, then take it"""
+        timeout = self.flush_interval if timeout is None else timeout
+        deadline = time.monotonic() + timeout
+        with self._lock:
+            while len(self._items) < self.batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._not_empty.wait(remaining)
+            count = min(len(self._items), self.batch_size)
+            batch = [self._items.popleft() for _ in range(count)]
+            if batch:
+                self._not_full.notify_all()
+            return batch
+
+    def flush(self):
+        """Drain and persist everything currently queued"""
+        while True:
+            batch = self.get_batch(timeout=0)
+            if not batch:
+                return
+            self._persist(batch)
+
+    def start(self):
+        """Start the flusher thread (idempotent)"""
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._thread = threading.Thread(target=self._run, name='ingest-flusher', daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            batch = self.get_batch()
+            if batch:
+                self._persist(batch)
+
+    def _persist(self, batch):
+        started = time.monotonic()
+        try:
+            close_old_connections()
+            db_writer.run(persist_batch, batch)
+        except Exception as e:
+            with self._lock:
+                self._failed_batches += 1
+            print(f"❌ Failed to persist batch of {len(batch)} messages: {e}")
+            return
+        latency = time.monotonic() - started
+        self.persist_timer.add(latency, len(batch))
+        with self._lock:
+            self._batches += 1
+            self._flushed += len(batch)
+            self._last_batch_size = len(batch)
+            self._last_flush_latency = latency
+            self._max_flush_latency = max(self._max_flush_latency, latency)
+            self._total_flush_time += latency
+
+    def stats(self):
+        with self._lock:
+            return {
+                'queue_depth': len(self._items),
+                'queue_maxsize': self.maxsize,
+                'backpressure': self.backpressure,
+                'enqueued': self._enqueued,
+                'dropped': self._dropped,
+                'blocked': self._blocked,  # puts that had to wait for room
+                'flushed': self._flushed,
+                'batches': self._batches,
+                'failed_batches': self._failed_batches,
+                'last_batch_size': self._last_batch_size,
+                'avg_batch_size': self._flushed / self._batches if self._batches else 0,
+                'last_flush_latency_ms': round(self._last_flush_latency * 1000, 3),
+                'max_flush_latency_ms': round(self._max_flush_latency * 1000, 3),
+                'avg_flush_latency_ms': round(
+                    self._total_flush_time / self._batches * 1000, 3
+                ) if self._batches else 0,
+            }
+
+
+def persist_batch(records):
+    """Write a batch of ingestion records to ``Device`` and ``DeviceLog``.
+
+    Devices are resolved through the device registry, so only devices seen for
+    the first time cost a query. Unknown devices are bulk-created, log entries
+    are bulk-inserted and ``last_seen``/``status`` are handed to the heartbeat
+    writer, which coalesces them across batches. A log entry is skipped when the device already has one
+    with the same data, matching the old ``get_or_create`` behaviour.
+    """
+    if not records:
+        return
+
+    # Newest record per device decides its status and last_seen
+    latest = {}
+    for record in records:
+        current = latest.get(record['device_id'])
+        if current is None or record['timestamp'] >= current['timestamp']:
+            latest[record['device_id']] = record
+
+    states = {}
+    missing = []
+    for device_id in latest:
+        state = device_registry.get(device_id)
+        if state is None:
+            missing.append(device_id)
+        else:
+            states[device_id] = state
+
+    with transaction.atomic():
+        created = {}
+        if missing:
+            version = next_fleet_version()
+            Device.objects.bulk_create([
+                Device(
+                    device_id=device_id,
+                    device_type=latest[device_id]['device_type'] or 'unknown',
+                    status=latest[device_id]['status'],
+                    last_seen=latest[device_id]['timestamp'],
+                    name=f"{latest[device_id]['device_type'] or 'unknown'} - {device_id}",
+                    version=version,
+                )
+                for device_id in missing
+            ], ignore_conflicts=True)
+            # SQLite does not return primary keys from bulk inserts; this also
+            # picks up devices another process created concurrently
+            for device in Device.objects.filter(device_id__in=missing).only(
+                'id', 'device_id', 'name', 'device_type', 'status', 'last_seen'
+            ):
+                created[device.device_id] = DeviceState.from_device(device)
+
+        type_changed = []
+        for device_id, state in states.items():
+            record = latest[device_id]
+            if record['device_type'] and record['device_type'] != state.device_type:
+                type_changed.append(Device(pk=state.pk, device_type=record['device_type']))
+        if type_changed:
+            Device.objects.bulk_update(type_changed, ['device_type'])
+
+        # One log row per distinct (device, data) in the batch, skipping
+        # payloads the registry already knows are logged for that device
+        known = {**states, **created}
+        pending = {}
+        for record in records:
+            state = known.get(record['device_id'])
+            if state is None or record['data'] in state.recent_data:
+                continue
+            pending.setdefault((state.pk, record['data']), record['timestamp'])
+
+        # Existing rows are found by payload hash through devicelog_device_hash_idx
+        keys = list(pending)
+        payloads = {key: payload_codec.prepare(key[1]) for key in keys}
+        by_hash = {(pk, payloads[pk, data][2]): (pk, data) for pk, data in keys}
+        hashed = list(by_hash)
+        for start in range(0, len(hashed), LOG_LOOKUP_CHUNK):
+            chunk = hashed[start:start + LOG_LOOKUP_CHUNK]
+            existing = DeviceLog.objects.filter(
+                device_id__in={pk for pk, _ in chunk},
+                data_hash__in={data_hash for _, data_hash in chunk},
+            ).order_by().values_list('device_id', 'data_hash')
+            for key in existing:
+                if key in by_hash:
+                    pending.pop(by_hash[key], None)
+
+        # COPY on PostgreSQL, one executemany elsewhere (see storage.py)
+        adapt = timestamp_adapter()
+        storage.insert_logs([
+            (pk, adapt(timestamp), *payloads[pk, data])
+            for (pk, data), timestamp in pending.items()
+        ])
+
+    # Only touch the registry once the batch is committed
+    for state in created.values():
+        device_registry.put(state)
+    by_pk = {state.pk: state for state in known.values()}
+    # Status changes are pushed to live clients; compare before the heartbeat
+    # writer updates the cached state
+    status_changed = [
+        device_id for device_id, state in states.items()
+        if state.status != latest[device_id]['status']
+        and (state.last_seen is None or latest[device_id]['timestamp'] > state.last_seen)
+    ] + list(created)
+
+    # last_seen/status are coalesced across batches by the heartbeat writer
+    for device_id, state in states.items():
+        record = latest[device_id]
+        heartbeat_writer.record(state.pk, device_id, record['timestamp'], record['status'])
+    for device_id, state in known.items():
+        record = latest[device_id]
+        presence_tracker.touch(
+            device_id, record['device_type'] or state.device_type,
+            record['timestamp'], record['status']
+        )
+    for device in type_changed:
+        device_registry.update(by_pk[device.pk].device_id, device_type=device.device_type)
+    for pk, data in keys:
+        by_pk[pk].remember_data(data)
+
+    for device_id in status_changed:
+        record = latest[device_id]
+        event_hub.publish_status(record['status'], [device_id], record['timestamp'])
+    for (pk, data), timestamp in pending.items():
+        event_hub.publish('log', {
+            'device_id': by_pk[pk].device_id,
+            'data': data,
+            'timestamp': timestamp.isoformat(),
+        })
+
+
+ingest_queue = IngestionQueue.from_settings()
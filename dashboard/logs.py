@@ -0,0 +1,101 @@
+"""Keyset pagination over ``DeviceLog`` for the log API and log page.
+
+Pages are ordered newest first on ``(timestamp, id)``. A cursor is the
+``(timestamp, id)`` of a row, encoded as ``"<epoch microseconds>_<id>"``.
+``before`` walks back into older entries, and ``after`` returns only entries
+newer than the cursor, which lets the log page fetch just what is new. Rows
+come out of ``.values()``, so no model instances are built; packed payloads
+are decoded into ``data``.
+"""
+from datetime import datetime, timedelta, timezone as dt_timezone
+
+from django.db.models import Q
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from .models import DeviceLog
+from .payloads import load_payload
+
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+PAGE_FIELDS = ('id', 'timestamp', 'data', 'data_packed')
+
+EPOCH = datetime(1970, 1, 1, tzinfo=dt_timezone.utc)
+
+
+class InvalidQuery(ValueError):
+    """Raised for malformed cursors, time windows or limits"""
+
+
+def encode_cursor(timestamp, log_id):
+    return f"{(timestamp - EPOCH) // timedelta(microseconds=1)}_{log_id}"
+
+
+def decode_cursor(cursor):
+    try:
+        micros, log_id = cursor.split('_')
+        return EPOCH + timedelta(microseconds=int(micros)), int(log_id)
+    except (AttributeError, ValueError, OverflowError):
+        raise InvalidQuery(f"Invalid cursor: {cursor!r}")
+
+
+def parse_time(value, name):
+    """Parse an ISO 8601 query parameter; naive values are taken as UTC"""
+    if not value:
+        return None
+    parsed = parse_datetime(value.replace(' ', '+'))
+    if parsed is None:
+        raise InvalidQuery(f"Invalid {name}: {value!r}")
+    if timezone.is_naive(parsed):
+        parsed = timezone.make_aware(parsed, dt_timezone.utc)
+    return parsed
+
+
+def parse_limit(value, default=DEFAULT_PAGE_SIZE, maximum=MAX_PAGE_SIZE):
+    if not value:
+        return default
+    try:
+        limit = int(value)
+    except ValueError:
+        raise InvalidQuery(f"Invalid limit: {value!r}")
+    if limit < 1:
+        raise InvalidQuery('limit must be positive')
+    return min(limit, maximum)
+
+
+def log_page(device_pk, limit=DEFAULT_PAGE_SIZE, before=None, after=None, since=None, until=None):
+    """Return one page of a device's logs, newest first.
+
+    ``before``/``after`` are cursors, ``since``/``until`` bound the timestamp
+    (inclusive/exclusive). The result holds the rows plus cursors for the
+    oldest and newest row returned, so the caller can page in both directions.
+    """
+    logs = DeviceLog.objects.filter(device_id=device_pk)
+    if since:
+        logs = logs.filter(timestamp__gte=since)
+    if until:
+        logs = logs.filter(timestamp__lt=until)
+
+    if after:
+        timestamp, log_id = decode_cursor(after)
+        logs = logs.filter(Q(timestamp__gt=timestamp) | Q(timestamp=timestamp, id__gt=log_id))
+        # Oldest first so that a burst larger than ``limit`` is not skipped
+        rows = list(logs.order_by('timestamp', 'id').values(*PAGE_FIELDS)[:limit + 1])
+        has_more = len(rows) > limit
+        rows = rows[:limit][::-1]
+    else:
+        if before:
+            timestamp, log_id = decode_cursor(before)
+            logs = logs.filter(Q(timestamp__lt=timestamp) | Q(timestamp=timestamp, id__lt=log_id))
+        rows = list(logs.order_by('-timestamp', '-id').values(*PAGE_FIELDS)[:limit + 1])
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+
+    for row in rows:
+        row['data'] = load_payload(row['data'], row.pop('data_packed'))
+    return {
+        'logs': rows,
+        'has_more': has_more,
+        'newest_cursor': encode_cursor(rows[0]['timestamp'], rows[0]['id']) if rows else after,
+        'oldest_cursor': encode_cursor(rows[-1]['timestamp'], rows[-1]['id']) if rows else before,
+    }
@@ -0,0 +1,52 @@
+from django.core.management.base import BaseCommand
+from dashboard.benchmark import benchmark_import, benchmark_ingestion, remove_benchmark_devices
+
+class Command(BaseCommand):
+    help = 'Measure ingestion write throughput on the configured database at fixed message rates'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--rates', type=int, nargs='+', default=[1000, 10000, 50000],
+            help='Offered rates in messages per second'
+        )
+        parser.add_argument('--duration', type=int, default=5, help='Seconds per rate')
+        parser.add_argument('--devices', type=int, default=1000, help='Distinct devices sending')
+        parser.add_argument(
+            '--batch-size', type=int, default=None,
+            help='Messages per persisted batch (default: INGEST_BATCH_SIZE)'
+        )
+        parser.add_argument(
+            '--import-rows', type=int, default=0,
+            help='Also time import_logs on a generated file of this many rows'
+        )
+        parser.add_argument(
+            '--keep', action='store_true',
+            help='Keep the BENCH devices and their logs afterwards'
+        )
+
+    def handle(self, *args, **options):
+        try:
+            for rate in options['rates']:
+                result = benchmark_ingestion(
+                    rate, duration=options['duration'], devices=options['devices'],
+                    batch_size=options['batch_size'],
+                )
+                style = self.style.SUCCESS if result['kept_up'] else self.style.WARNING
+                self.stdout.write(style(
+                    f"{result['database']}/{result['storage']} @ {rate} msgs/s: "
+                    f"capacity {result['capacity']} msgs/s, "
+                    f"batch avg {result['batch_ms_avg']} ms / p99 {result['batch_ms_p99']} ms "
+                    f"({result['batch_size']} msgs), heartbeat flush avg {result['heartbeat_ms_avg']} ms"
+                    + ('' if result['kept_up'] else ' -- falling behind')
+                ))
+            if options['import_rows']:
+                result = benchmark_import(options['import_rows'], devices=options['devices'])
+                style = self.style.SUCCESS if result['met_target'] else self.style.WARNING
+                self.stdout.write(style(
+                    f"{result['database']}/{result['storage']} import of {result['rows']} rows: "
+                    f"{result['rows_per_second']} rows/s in {result['seconds']}s "
+                    f"(target {result['target']} rows/s)"
+                ))
+        finally:
+            if not options['keep']:
+                remove_benchmark_devices()
@@ -0,0 +1,61 @@
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+from dashboard.export import CONTENT_TYPES, FORMAT_NDJSON, LogExport
+from dashboard.logs import InvalidQuery, parse_time
+from dashboard.registry import device_registry
+
+class Command(BaseCommand):
+    help = 'Stream device logs to a file or stdout as NDJSON or CSV'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--device', action='append', default=[],
+            help='device_id to export; repeat for several (default: all devices)'
+        )
+        parser.add_argument('--device-type', help='Only export devices of this type')
+        parser.add_argument('--since', help='Oldest timestamp to export (ISO 8601)')
+        parser.add_argument('--until', help='Export entries before this timestamp (ISO 8601)')
+        parser.add_argument('--format', choices=sorted(CONTENT_TYPES), default=FORMAT_NDJSON)
+        parser.add_argument('--gzip', action='store_true', help='Compress the output with gzip')
+        parser.add_argument('--chunk-size', type=int, default=None, help='Rows fetched per query chunk')
+        parser.add_argument('--output', '-o', help='File to write (default: stdout)')
+
+    def handle(self, *args, **options):
+        devices = None
+        if options['device']:
+            devices = []
+            for device_id in options['device']:
+                state = device_registry.get(device_id)
+                if state is None:
+                    raise CommandError(f'Device not found: {device_id}')
+                devices.append(state)
+        if options['device_type']:
+            devices = [
+                state for state in (devices if devices is not None else device_registry.all())
+                if state.device_type == options['device_type']
+            ]
+        try:
+            export = LogExport(
+                devices=devices,
+                since=parse_time(options['since'], 'since'),
+                until=parse_time(options['until'], 'until'),
+                format=options['format'],
+                gzip=options['gzip'],
+                chunk_size=options['chunk_size'],
+            )
+        except InvalidQuery as e:
+            raise CommandError(str(e))
+
+        output = open(options['output'], 'wb') if options['output'] else sys.stdout.buffer
+        try:
+            for chunk in export:
+                output.write(chunk)
+        finally:
+            if options['output']:
+                output.close()
+            else:
+                output.flush()
+        # Progress goes to stderr so stdout stays a clean export
+        if options['verbosity'] > 0:
+            self.stderr.write(self.style.SUCCESS(f'Exported {export.rows} log entries'))
@@ -0,0 +1,55 @@
+from django.core.management.base import BaseCommand, CommandError
+from dashboard.export import FORMAT_CSV, FORMAT_NDJSON
+from dashboard.importer import LogImporter
+
+class Command(BaseCommand):
+    help = 'Import device logs from NDJSON or CSV files (optionally gzipped), resumably'
+
+    def add_arguments(self, parser):
+        parser.add_argument('paths', nargs='+', help='Files to import')
+        parser.add_argument(
+            '--format', choices=[FORMAT_NDJSON, FORMAT_CSV], default=None,
+            help='File format (default: from the file name)'
+        )
+        parser.add_argument(
+            '--batch-size', type=int, default=None,
+            help='Rows per transaction (default: IMPORT_BATCH_SIZE)'
+        )
+        parser.add_argument(
+            '--no-create-devices', action='store_true',
+            help='Skip rows for unknown devices instead of creating them'
+        )
+        parser.add_argument(
+            '--device-type', default='unknown',
+            help='device_type of auto-created devices when the file has none'
+        )
+        parser.add_argument(
+            '--restart', action='store_true',
+            help='Ignore saved progress and import each file from the start'
+        )
+
+    def handle(self, *args, **options):
+        def progress(importer):
+            if options['verbosity'] > 1:
+                self.stdout.write(f'{importer.path}: {importer.imported} rows imported')
+
+        for path in options['paths']:
+            try:
+                importer = LogImporter(
+                    path,
+                    format=options['format'],
+                    batch_size=options['batch_size'],
+                    create_devices=not options['no_create_devices'],
+                    device_type=options['device_type'],
+                    resume=not options['restart'],
+                )
+                result = importer.run(progress)
+            except (OSError, ValueError) as e:
+                raise CommandError(f'{path}: {e}')
+            self.stdout.write(
+                self.style.SUCCESS(
+                    f"{path}: imported {result['imported']} row(s) in {result['seconds']}s "
+                    f"({result['rows_per_second'] or 0} rows/s), skipped {result['skipped']}, "
+                    f"created {result['created_devices']} device(s)"
+                )
+            )
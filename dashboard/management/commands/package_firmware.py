@@ -0,0 +1,43 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Q
+from dashboard.models import Firmware
+from dashboard.packaging import FirmwarePackager, STATUS_READY
+
+class Command(BaseCommand):
+    help = 'Zip uploaded firmware folders that are still waiting for (or failed) packaging'
+
+    def add_arguments(self, parser):
+        parser.add_argument('versions', nargs='*', help='Firmware versions to package (default: all unpackaged)')
+        parser.add_argument('--level', type=int, default=None, help='Compression level 0-9 (default: FIRMWARE_ZIP_LEVEL)')
+        parser.add_argument(
+            '--workers', type=int, default=None,
+            help='Compression threads (default: FIRMWARE_PACKAGE_WORKERS or one per core)'
+        )
+
+    def handle(self, *args, **options):
+        packager = FirmwarePackager.from_settings()
+        if options['level'] is not None:
+            packager.level = options['level']
+        if options['workers']:
+            packager.workers = options['workers']
+
+        firmware = Firmware.objects.exclude(Q(firmware_folder='') | Q(firmware_folder__isnull=True))
+        firmware = firmware.exclude(package_status=STATUS_READY)
+        if options['versions']:
+            firmware = firmware.filter(version__in=options['versions'])
+        pks = list(firmware.values_list('pk', flat=True))
+        if options['versions'] and not pks:
+            raise CommandError('No unpackaged firmware with those versions')
+
+        for pk in pks:
+            try:
+                packaged = packager.package(pk)
+            except Exception as e:
+                self.stderr.write(self.style.ERROR(f'Failed to package firmware {pk}: {e}'))
+                continue
+            self.stdout.write(self.style.SUCCESS(
+                f'Packaged {packaged} ({packaged.size} bytes, sha256 {packaged.sha256})'
+            ))
+        stats = packager.stats()
+        self.stdout.write(f"{stats['packaged']} packaged, {stats['failed']} failed"
+                          + (f", {stats['mb_per_second']} MB/s" if stats['mb_per_second'] else ''))
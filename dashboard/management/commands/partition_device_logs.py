@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from dashboard.retention import convert_to_partitioned
+
+class Command(BaseCommand):
+    help = 'Convert the device log table to daily range partitions (PostgreSQL only)'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--days-ahead', type=int, default=7,
+            help='Daily partitions to create in advance'
+        )
+
+    def handle(self, *args, **options):
+        if connection.vendor != 'postgresql':
+            raise CommandError(
+                f'Partitioning requires PostgreSQL, not {connection.vendor}; '
+                f'prune_device_logs deletes expired days in chunks instead'
+            )
+        if convert_to_partitioned(days_ahead=options['days_ahead']):
+            self.stdout.write(self.style.SUCCESS('Device logs are now partitioned by day'))
+        else:
+            self.stdout.write('Device logs are already partitioned')
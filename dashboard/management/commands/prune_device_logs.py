@@ -0,0 +1,32 @@
+from django.core.management.base import BaseCommand
+from dashboard.retention import prune_device_logs
+
+class Command(BaseCommand):
+    help = 'Roll up complete days of device logs and drop raw logs past retention'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--retention-days', type=int, default=None,
+            help='Days of raw logs to keep (default: LOG_RETENTION_DAYS)'
+        )
+        parser.add_argument(
+            '--days-ahead', type=int, default=7,
+            help='Daily partitions to create in advance on PostgreSQL'
+        )
+
+    def handle(self, *args, **options):
+        result = prune_device_logs(
+            retention_days=options['retention_days'], days_ahead=options['days_ahead']
+        )
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"Rolled up {len(result['rolled_up_days'])} day(s), "
+                f"dropped {len(result['dropped_days'])} expired day(s)"
+            )
+        )
+        if options['verbosity'] > 1:
+            for day, deleted in result['dropped_days'].items():
+                how = 'dropped partition' if deleted is None else f'deleted {deleted} row(s)'
+                self.stdout.write(f'{day}: {how}')
+            for name in result['created_partitions']:
+                self.stdout.write(f'Created partition {name}')
@@ -0,0 +1,28 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from dashboard.consumer import MODE_HASH, MODE_SHARED, run_consumers
+
+class Command(BaseCommand):
+    help = 'Consume device messages from MQTT with N sharded worker processes'
+    # The consumer never serves requests; skip the URL checks that import views
+    requires_system_checks = []
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--workers', type=int, default=getattr(settings, 'CONSUMER_WORKERS', 1),
+            help='Number of worker processes (shards)'
+        )
+        parser.add_argument(
+            '--mode', choices=[MODE_HASH, MODE_SHARED],
+            default=getattr(settings, 'CONSUMER_MODE', MODE_HASH),
+            help='hash: every worker subscribes and keeps its devices; '
+                 'shared: the broker splits a $share subscription'
+        )
+
+    def handle(self, *args, **options):
+        if options['workers'] < 1:
+            raise CommandError('--workers must be at least 1')
+        self.stdout.write(
+            self.style.SUCCESS(f"Starting {options['workers']} consumer worker(s) in {options['mode']} mode")
+        )
+        run_consumers(options['workers'], options['mode'])
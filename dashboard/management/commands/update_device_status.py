@@ -1,23 +1,19 @@
 from django.core.management.base import BaseCommand
-from django.utils import timezone
-from dashboard.models import Device
-from datetime import timedelta
+from dashboard.database import db_writer
+from dashboard.sweeper import sweep_device_status
 
 class Command(BaseCommand):
-    help = 'Update device status to offline if no message received in last 2 minutes'
+    help = 'Move devices online -> idle -> offline when they have stopped reporting'
 
     def handle(self, *args, **options):
-        # Get devices that haven't received a message in the last 2 minutes
-        two_minutes_ago = timezone.now() - timedelta(minutes=2)
-        devices = Device.objects.filter(
-            status=True,
-            last_seen__lt=two_minutes_ago
-        )
-
-        # Update their status to offline
-        for device in devices:
-            device.status = False
-            device.save()
-            self.stdout.write(
-                self.style.SUCCESS(f'Set device {device.device_id} to offline')
+        changed = db_writer.run(sweep_device_status)
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"Set {len(changed['idle'])} device(s) to idle and "
+                f"{len(changed['offline'])} device(s) to offline"
             )
+        )
+        if options['verbosity'] > 1:
+            for status, device_ids in changed.items():
+                for device_id in device_ids:
+                    self.stdout.write(f'Set device {device_id} to {status}')
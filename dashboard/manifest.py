@@ -0,0 +1,171 @@
+"""In-memory firmware manifest served by ``/api/firmware/``.
+
+Devices poll for firmware at boot, so a fleet restarting at once would send
+one ``Firmware`` query per device. Instead each process keeps a manifest of
+the active versions, loaded with two queries (firmware and patches) and
+served from memory. It is invalidated when a ``Firmware`` or
+``FirmwarePatch`` row is saved or deleted (see ``signals.py``): locally on
+commit, and in other web processes through the event bridge. Every
+``FIRMWARE_MANIFEST_TTL`` seconds it is reloaded anyway, in case such an
+event was missed. Reloads are single-flight: concurrent requests wait for
+one query instead of each running their own.
+
+Each version targets one ``device_type`` (empty for all types) and a
+``rollout_percent``. A device's cohort is a stable hash of its device_id
+into 0-99, and it is offered the newest version whose rollout covers its
+cohort. Raising a version from 5% to 50% to 100% keeps the first 5% in
+the rollout and adds devices to it.
+"""
+import hashlib
+import threading
+import time
+
+from django.conf import settings
+from django.core.files.storage import default_storage
+from django.urls import reverse
+
+from .models import Firmware, FirmwarePatch
+
+
+def rollout_bucket(device_id):
+    """Stable cohort of a device, 0-99"""
+    digest = hashlib.blake2b(str(device_id).encode(), digest_size=8).digest()
+    return int.from_bytes(digest, 'big') % 100
+
+
+class ManifestEntry:
+    """One active firmware version as served to devices"""
+
+    __slots__ = ('pk', 'version', 'device_type', 'rollout_percent', 'path', 'sha256', 'size', 'patches')
+
+    def __init__(self, pk, version, device_type, rollout_percent, path, sha256, size):
+        self.pk = pk
+        self.version = version
+        self.device_type = device_type
+        self.rollout_percent = rollout_percent
+        self.path = path
+        self.sha256 = sha256
+        self.size = size
+        # from version -> patch fields
+        self.patches = {}
+
+    def offered_to(self, device_id):
+        if self.rollout_percent >= 100:
+            return True
+        if device_id is None:
+            return False
+        return rollout_bucket(device_id) < self.rollout_percent
+
+
+class FirmwareManifest:
+    """Active firmware per device_type, cached until invalidated"""
+
+    def __init__(self, ttl=300):
+        self.ttl = ttl
+        self._by_type = {}
+        self._generic = []
+        self._loaded_at = None
+        self._generation = 0
+        self._lock = threading.Lock()
+        self._load_lock = threading.Lock()
+
+        self._hits = 0
+        self._loads = 0
+        self._invalidations = 0
+
+    @classmethod
+    def from_settings(cls):
+        return cls(ttl=getattr(settings, 'FIRMWARE_MANIFEST_TTL', 300))
+
+    def load(self):
+        """(Re)load the manifest: one query for firmware, one for patches"""
+        with self._lock:
+            generation = self._generation
+        entries = []
+        rows = Firmware.objects.filter(is_active=True).order_by('-created_at').values_list(
+            'pk', 'version', 'device_type', 'rollout_percent', 'firmware_file', 'sha256', 'size'
+        )
+        for pk, version, device_type, percent, name, sha256, size in rows:
+            if sha256:
+                path = reverse('download_firmware', args=[sha256])
+            elif name:
+                path = default_storage.url(name)
+            else:
+                continue
+            entries.append(ManifestEntry(pk, version, device_type, percent, path, sha256 or None, size))
+
+        by_pk = {entry.pk: entry for entry in entries}
+        patches = FirmwarePatch.objects.filter(target_id__in=list(by_pk)).values_list(
+            'target_id', 'source__version', 'algorithm', 'sha256', 'size'
+        )
+        for target_id, from_version, algorithm, sha256, size in patches:
+            by_pk[target_id].patches[from_version] = {
+                'from': from_version,
+                'algorithm': algorithm,
+                'path': reverse('download_firmware', args=[sha256]),
+                'sha256': sha256,
+                'size': size,
+            }
+
+        # Each type's list includes the generic versions, newest first
+        generic = [entry for entry in entries if not entry.device_type]
+        by_type = {}
+        for entry in entries:
+            if entry.device_type and entry.device_type not in by_type:
+                by_type[entry.device_type] = [
+                    other for other in entries if other.device_type in ('', entry.device_type)
+                ]
+        with self._lock:
+            self._by_type = by_type
+            self._generic = generic
+            self._loads += 1
+            # An invalidation during the load leaves the manifest stale
+            if generation == self._generation:
+                self._loaded_at = time.monotonic()
+        return len(entries)
+
+    def _fresh(self):
+        return self._loaded_at is not None and time.monotonic() - self._loaded_at < self.ttl
+
+    def ensure_loaded(self):
+        with self._lock:
+            if self._fresh():
+                return
+        with self._load_lock:
+            with self._lock:
+                if self._fresh():
+                    return
+            self.load()
+
+    def invalidate(self):
+        """Drop the manifest; the next request reloads it"""
+        with self._lock:
+            self._generation += 1
+            self._loaded_at = None
+            self._invalidations += 1
+
+    def resolve(self, device_type=None, device_id=None):
+        """The newest version offered to a device, or None"""
+        self.ensure_loaded()
+        with self._lock:
+            self._hits += 1
+            entries = self._by_type.get(device_type, self._generic) if device_type else self._generic
+        for entry in entries:
+            if entry.offered_to(device_id):
+                return entry
+        return None
+
+    def stats(self):
+        with self._lock:
+            return {
+                'device_types': len(self._by_type),
+                'versions': len({entry.pk for entries in self._by_type.values() for entry in entries}
+                                | {entry.pk for entry in self._generic}),
+                'age_seconds': round(time.monotonic() - self._loaded_at, 1) if self._loaded_at else None,
+                'requests': self._hits,
+                'loads': self._loads,
+                'invalidations': self._invalidations,
+            }
+
+
+firmware_manifest = FirmwareManifest.from_settings()
@@ -0,0 +1,31 @@
+# Generated by Django 3.2.25 on 2026-10-18 16:01
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dashboard', '0008_alter_device_status'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='devicelog',
+            name='device',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, to='dashboard.device'),
+        ),
+        migrations.AddIndex(
+            model_name='device',
+            index=models.Index(fields=['status', 'last_seen'], name='device_status_seen_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='devicelog',
+            index=models.Index(fields=['device', 'timestamp', 'id'], name='devicelog_device_ts_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='firmware',
+            index=models.Index(condition=models.Q(('is_active', True)), fields=['created_at'], name='firmware_active_created_idx'),
+        ),
+    ]
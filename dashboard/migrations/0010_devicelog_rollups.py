@@ -0,0 +1,46 @@
+# Generated by Django 3.2.25 on 2026-10-18 16:04
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dashboard', '0009_hot_query_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DeviceLogRollup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('period', models.CharField(choices=[('hour', 'Hour'), ('day', 'Day')], max_length=4)),
+                ('bucket_start', models.DateTimeField()),
+                ('message_count', models.PositiveIntegerField(default=0)),
+                ('first_seen', models.DateTimeField()),
+                ('last_seen', models.DateTimeField()),
+                ('status_counts', models.JSONField(default=dict)),
+            ],
+            options={
+                'ordering': ['-bucket_start'],
+            },
+        ),
+        migrations.AddIndex(
+            model_name='devicelog',
+            index=models.Index(fields=['timestamp'], name='devicelog_ts_idx'),
+        ),
+        migrations.AddField(
+            model_name='devicelogrollup',
+            name='device',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, to='dashboard.device'),
+        ),
+        migrations.AddIndex(
+            model_name='devicelogrollup',
+            index=models.Index(fields=['bucket_start'], name='devicelog_rollup_bucket_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='devicelogrollup',
+            constraint=models.UniqueConstraint(fields=('device', 'period', 'bucket_start'), name='unique_devicelog_rollup'),
+        ),
+    ]
@@ -0,0 +1,24 @@
+# Generated by Django 3.2.25 on 2026-10-18 16:15
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dashboard', '0010_devicelog_rollups'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RecentMessage',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('key', models.CharField(max_length=40, unique=True)),
+                ('device_id', models.CharField(max_length=100)),
+                ('device_type', models.CharField(blank=True, max_length=50, null=True)),
+                ('data', models.TextField()),
+                ('timestamp', models.DateTimeField()),
+            ],
+        ),
+    ]
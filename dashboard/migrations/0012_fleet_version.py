@@ -0,0 +1,35 @@
+# Generated by Django 3.2.25 on 2026-10-18 16:19
+
+from django.db import migrations, models
+
+
+def create_fleet_version(apps, schema_editor):
+    FleetVersion = apps.get_model('dashboard', 'FleetVersion')
+    FleetVersion.objects.get_or_create(pk=1)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dashboard', '0011_recent_messages'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FleetVersion',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('version', models.BigIntegerField(default=0)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='device',
+            name='version',
+            field=models.BigIntegerField(default=0),
+        ),
+        migrations.AddIndex(
+            model_name='device',
+            index=models.Index(fields=['version'], name='device_version_idx'),
+        ),
+        migrations.RunPython(create_fleet_version, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,63 @@
+# Generated by Django 3.2.25 on 2026-10-18 16:39
+
+import hashlib
+import json
+
+from django.db import migrations, models
+
+BACKFILL_CHUNK = 10000
+
+
+# Frozen copy of dashboard.payloads.payload_hash as of this migration, so
+# later changes to the app code can't change what it computes
+def payload_hash(data):
+    canonical = json.dumps(data, sort_keys=True, separators=(',', ':'), ensure_ascii=False)
+    digest = hashlib.blake2b(canonical.encode(), digest_size=8).digest()
+    return int.from_bytes(digest, 'big', signed=True)
+
+
+def backfill_data_hash(apps, schema_editor):
+    DeviceLog = apps.get_model('dashboard', 'DeviceLog')
+    connection = schema_editor.connection
+    quote = connection.ops.quote_name
+    sql = f"UPDATE {quote(DeviceLog._meta.db_table)} SET {quote('data_hash')} = %s WHERE {quote('id')} = %s"
+    rows = DeviceLog.objects.order_by().values_list('pk', 'data').iterator(chunk_size=BACKFILL_CHUNK)
+    chunk = []
+    with connection.cursor() as cursor:
+        for pk, data in rows:
+            chunk.append((payload_hash(data), pk))
+            if len(chunk) >= BACKFILL_CHUNK:
+                cursor.executemany(sql, chunk)
+                chunk = []
+        if chunk:
+            cursor.executemany(sql, chunk)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dashboard', '0013_import_checkpoints'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='devicelog',
+            name='data_hash',
+            field=models.BigIntegerField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='devicelog',
+            name='data_packed',
+            field=models.BinaryField(blank=True, null=True),
+        ),
+        migrations.AlterField(
+            model_name='devicelog',
+            name='data',
+            field=models.JSONField(null=True),
+        ),
+        migrations.RunPython(backfill_data_hash, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='devicelog',
+            index=models.Index(fields=['device', 'data_hash'], name='devicelog_device_hash_idx'),
+        ),
+    ]
@@ -0,0 +1,74 @@
+# Generated by Django 3.2.25 on 2026-10-18 16:42
+
+import hashlib
+
+from django.core.files.storage import default_storage
+from django.db import migrations, models
+import django.db.models.deletion
+
+HASH_CHUNK = 1024 * 1024
+
+
+# Frozen copy of dashboard.firmware's blob layout as of this migration
+def store_blob(storage, name):
+    """Copy the file ``name`` to ``firmware/blobs/<ab>/<sha256>``; returns
+    ``(blob name, digest, size)``"""
+    sha = hashlib.sha256()
+    size = 0
+    with storage.open(name, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK), b''):
+            sha.update(chunk)
+            size += len(chunk)
+    digest = sha.hexdigest()
+    target = f"firmware/blobs/{digest[:2]}/{digest}"
+    if name != target and not storage.exists(target):
+        with storage.open(name, 'rb') as f:
+            storage.save(target, f)
+    return target, digest, size
+
+
+def content_address_firmware(apps, schema_editor):
+    """Copy existing firmware files into the blob store (originals are kept)"""
+    Firmware = apps.get_model('dashboard', 'Firmware')
+    for firmware in Firmware.objects.exclude(firmware_file=''):
+        if not default_storage.exists(firmware.firmware_file.name):
+            continue
+        name, digest, size = store_blob(default_storage, firmware.firmware_file.name)
+        Firmware.objects.filter(pk=firmware.pk).update(firmware_file=name, sha256=digest, size=size)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dashboard', '0014_devicelog_payload_encoding'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='firmware',
+            name='sha256',
+            field=models.CharField(blank=True, db_index=True, default='', editable=False, max_length=64),
+        ),
+        migrations.AddField(
+            model_name='firmware',
+            name='size',
+            field=models.BigIntegerField(blank=True, editable=False, null=True),
+        ),
+        migrations.CreateModel(
+            name='FirmwarePatch',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('algorithm', models.CharField(max_length=20)),
+                ('sha256', models.CharField(max_length=64)),
+                ('size', models.BigIntegerField()),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('source', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='patches_from', to='dashboard.firmware')),
+                ('target', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='patches_to', to='dashboard.firmware')),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='firmwarepatch',
+            constraint=models.UniqueConstraint(fields=('source', 'target'), name='unique_firmware_patch'),
+        ),
+        migrations.RunPython(content_address_firmware, migrations.RunPython.noop),
+    ]
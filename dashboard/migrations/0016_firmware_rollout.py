@@ -0,0 +1,24 @@
+# Generated by Django 3.2.25 on 2026-10-18 16:45
+
+import django.core.validators
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dashboard', '0015_firmware_blobs'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='firmware',
+            name='device_type',
+            field=models.CharField(blank=True, default='', help_text='Device type this firmware is for; leave empty for all types', max_length=50),
+        ),
+        migrations.AddField(
+            model_name='firmware',
+            name='rollout_percent',
+            field=models.PositiveSmallIntegerField(default=100, help_text='Share of devices offered this version, e.g. 5, then 50, then 100', validators=[django.core.validators.MinValueValidator(0), django.core.validators.MaxValueValidator(100)]),
+        ),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 3.2.25 on 2026-10-18 16:48
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dashboard', '0016_firmware_rollout'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='firmware',
+            name='package_error',
+            field=models.TextField(blank=True, default='', editable=False),
+        ),
+        migrations.AddField(
+            model_name='firmware',
+            name='package_progress',
+            field=models.PositiveSmallIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='firmware',
+            name='package_status',
+            field=models.CharField(blank=True, choices=[('pending', 'Pending'), ('packaging', 'Packaging'), ('ready', 'Ready'), ('failed', 'Failed')], default='', editable=False, max_length=20),
+        ),
+        migrations.AlterField(
+            model_name='firmware',
+            name='firmware_file',
+            field=models.FileField(blank=True, upload_to='firmware/versions/'),
+        ),
+    ]
@@ -0,0 +1,34 @@
+# Generated by Django 3.2.25 on 2026-10-18 16:51
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dashboard', '0017_firmware_packaging'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FleetCommand',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('command_id', models.CharField(max_length=32, unique=True)),
+                ('command', models.CharField(max_length=50)),
+                ('payload', models.JSONField(blank=True, default=dict)),
+                ('selector', models.JSONField(default=dict)),
+                ('qos', models.PositiveSmallIntegerField(default=1)),
+                ('status', models.CharField(choices=[('dispatching', 'Dispatching'), ('waiting', 'Waiting for acknowledgements'), ('complete', 'Complete'), ('timed_out', 'Timed out')], default='dispatching', max_length=20)),
+                ('targets', models.PositiveIntegerField(default=0)),
+                ('sent', models.PositiveIntegerField(default=0)),
+                ('acked', models.PositiveIntegerField(default=0)),
+                ('failed', models.PositiveIntegerField(default=0)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('finished_at', models.DateTimeField(blank=True, null=True)),
+            ],
+            options={
+                'ordering': ['-created_at'],
+            },
+        ),
+    ]
@@ -0,0 +1,34 @@
+# Generated by Django 3.2.25 on 2026-10-18 17:03
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dashboard', '0018_fleet_commands'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DeviceQuery',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('correlation_id', models.CharField(max_length=32, unique=True)),
+                ('device_id', models.CharField(max_length=50)),
+                ('status', models.CharField(choices=[('pending', 'Pending'), ('answered', 'Answered'), ('timed_out', 'Timed out')], default='pending', max_length=20)),
+                ('response', models.JSONField(blank=True, null=True)),
+                ('rtt_ms', models.FloatField(blank=True, null=True)),
+                ('sent_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('finished_at', models.DateTimeField(blank=True, null=True)),
+            ],
+            options={
+                'ordering': ['-sent_at'],
+            },
+        ),
+        migrations.AddIndex(
+            model_name='devicequery',
+            index=models.Index(fields=['sent_at'], name='devicequery_sent_idx'),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 3.2.25 on 2026-10-18 17:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dashboard', '0019_device_queries'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RollupMark',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateTimeField(unique=True)),
+                ('log_count', models.BigIntegerField(default=0)),
+                ('max_log_id', models.BigIntegerField(null=True)),
+                ('rolled_up_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+    ]
@@ -1,6 +1,9 @@
-from django.db import models
+from django.db import models, transaction
 from django.utils import timezone
 from django.core.exceptions import ValidationError
+from django.core.validators import MaxValueValidator, MinValueValidator
+
+from .payloads import payload_codec, payload_hash, unpack_payload
 
 class Device(models.Model):
     name = models.CharField(max_length=100)
@@ -26,6 +29,8 @@ class Device(models.Model):
     )
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
+    # Fleet version of the last change to status, last_seen or name (see versions.py)
+    version = models.BigIntegerField(default=0)
 
     def clean(self):
         """Validate device_id format"""
@@ -46,58 +51,87 @@ class Device(models.Model):
 
     def save(self, *args, **kwargs):
         """Clean and validate before saving"""
+        from .versions import next_fleet_version
+
         self.full_clean()
-        super().save(*args, **kwargs)
+        with transaction.atomic():
+            self.version = next_fleet_version()
+            if kwargs.get('update_fields') is not None:
+                kwargs['update_fields'] = {*kwargs['update_fields'], 'version'}
+            super().save(*args, **kwargs)
 
     def __str__(self):
         return f"{self.device_type} - {self.device_id}"
 
     class Meta:
         ordering = ['-updated_at']
+        indexes = [
+            # Status sweeps and presence transitions filter on both
+            models.Index(fields=['status', 'last_seen'], name='device_status_seen_idx'),
+            # Delta polls of /api/devices/status/ (?since=<version>)
+            models.Index(fields=['version'], name='device_version_idx'),
+        ]
         constraints = [
             models.UniqueConstraint(fields=['device_id'], name='unique_device_id'),
             models.UniqueConstraint(fields=['device_type', 'device_id'], name='unique_device_type_id')
         ]
 
-from django.core.files.storage import FileSystemStorage
-from django.conf import settings
-import os
-import zipfile
-
 class Firmware(models.Model):
     version = models.CharField(max_length=50)
-    firmware_file = models.FileField(upload_to='firmware/versions/')
+    firmware_file = models.FileField(upload_to='firmware/versions/', blank=True)
     firmware_folder = models.FileField(upload_to='firmware/folders/', null=True, blank=True)
     release_notes = models.TextField(blank=True, null=True)
     created_at = models.DateTimeField(auto_now_add=True)
     is_active = models.BooleanField(default=True)
+    # Content address of firmware_file (see firmware.py)
+    sha256 = models.CharField(max_length=64, blank=True, default='', editable=False, db_index=True)
+    size = models.BigIntegerField(null=True, blank=True, editable=False)
+    # Which devices are offered this version (see manifest.py)
+    device_type = models.CharField(
+        max_length=50, blank=True, default='',
+        help_text='Device type this firmware is for; leave empty for all types'
+    )
+    rollout_percent = models.PositiveSmallIntegerField(
+        default=100, validators=[MinValueValidator(0), MaxValueValidator(100)],
+        help_text='Share of devices offered this version, e.g. 5, then 50, then 100'
+    )
+    # Background packaging of firmware_folder (see packaging.py)
+    package_status = models.CharField(
+        max_length=20, blank=True, default='', editable=False,
+        choices=[('pending', 'Pending'), ('packaging', 'Packaging'), ('ready', 'Ready'), ('failed', 'Failed')]
+    )
+    package_progress = models.PositiveSmallIntegerField(default=0, editable=False)
+    package_error = models.TextField(blank=True, default='', editable=False)
     
     def __str__(self):
         return f"v{self.version}"
 
+    def clean(self):
+        if not self.firmware_file and not self.firmware_folder:
+            raise ValidationError({
+                'firmware_file': 'Upload a firmware file or a folder to package'
+            })
+
     def save(self, *args, **kwargs):
-        # If a folder is uploaded, create a zip file from it
-        if self.firmware_folder and not self.firmware_file:
-            fs = FileSystemStorage()
-            folder_path = fs.path(self.firmware_folder.name)
-            zip_path = os.path.join(settings.MEDIA_ROOT, f'firmware/versions/v{self.version}.zip')
-            
-            with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_DEFLATED) as zipf:
-                for root, dirs, files in os.walk(folder_path):
-                    for file in files:
-                        file_path = os.path.join(root, file)
-                        arcname = os.path.relpath(file_path, folder_path)
-                        zipf.write(file_path, arcname)
-            
-            # Save the zip file path to firmware_file
-            self.firmware_file = fs.save(f'firmware/versions/v{self.version}.zip', open(zip_path, 'rb'))
-            
-            # Delete the original folder
-            fs.delete(self.firmware_folder.name)
-            self.firmware_folder = None
-        
+        # An uploaded folder is zipped in the background (see packaging.py)
+        package = bool(self.firmware_folder and not self.firmware_file
+                       and self.package_status in ('', 'failed'))
+        if package:
+            self.package_status = 'pending'
+            self.package_progress = 0
+
         super().save(*args, **kwargs)
 
+        if package:
+            from .packaging import firmware_packager
+            transaction.on_commit(lambda: firmware_packager.submit(self.pk))
+            return
+
+        # Newly uploaded files move into the content-addressed blob store
+        from .firmware import blob_name, content_address
+        if self.firmware_file and (not self.sha256 or self.firmware_file.name != blob_name(self.sha256)):
+            content_address(self)
+
     @property
     def file_url(self):
         """Return the full URL for the firmware file"""
@@ -108,15 +142,229 @@ class Firmware(models.Model):
     class Meta:
         ordering = ['-created_at']
         unique_together = ['version']
+        indexes = [
+            # Latest active firmware lookup; a partial index because SQLite
+            # filters booleans as a bare column, which a plain index can't serve
+            models.Index(
+                fields=['created_at'], name='firmware_active_created_idx',
+                condition=models.Q(is_active=True)
+            ),
+        ]
+
+class FirmwarePatch(models.Model):
+    """Binary delta from one firmware version to the next (see firmware.py)"""
+    source = models.ForeignKey('Firmware', on_delete=models.CASCADE, related_name='patches_from')
+    target = models.ForeignKey('Firmware', on_delete=models.CASCADE, related_name='patches_to')
+    algorithm = models.CharField(max_length=20)
+    sha256 = models.CharField(max_length=64)
+    size = models.BigIntegerField()
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"v{self.source.version} -> v{self.target.version}"
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['source', 'target'], name='unique_firmware_patch')
+        ]
 
 class DeviceLog(models.Model):
-    device = models.ForeignKey('Device', on_delete=models.CASCADE)
+    # Indexed through devicelog_device_ts_idx, which leads with device
+    device = models.ForeignKey('Device', on_delete=models.CASCADE, db_index=False)
     timestamp = models.DateTimeField(default=timezone.now)
-    data = models.JSONField()
+    # NULL when the payload is stored in data_packed (see payloads.py)
+    data = models.JSONField(null=True)
+    data_packed = models.BinaryField(null=True, blank=True)
+    # Hash of the payload's canonical JSON, for duplicate lookups
+    data_hash = models.BigIntegerField(null=True, blank=True, editable=False)
     created_at = models.DateTimeField(auto_now_add=True)
     
     def __str__(self):
         return f"{self.device.name} - {self.timestamp}"
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        """Decode packed payloads into ``data``"""
+        instance = super().from_db(db, field_names, values)
+        fields = instance.__dict__
+        if fields.get('data') is None and fields.get('data_packed') is not None:
+            instance.data = unpack_payload(instance.data_packed)
+        return instance
+
+    def save(self, *args, **kwargs):
+        """Store the payload with the configured encoding and its hash"""
+        data = self.data
+        self.data_packed = payload_codec.pack(data)
+        self.data_hash = payload_hash(data)
+        if self.data_packed is not None:
+            self.data = None
+        try:
+            super().save(*args, **kwargs)
+        finally:
+            self.data = data
+
     class Meta:
         ordering = ['-timestamp']
+        indexes = [
+            # Per-device log listing, keyset pagination and duplicate lookups
+            models.Index(fields=['device', 'timestamp', 'id'], name='devicelog_device_ts_idx'),
+            # Fleet-wide recent logs and retention by day bucket
+            models.Index(fields=['timestamp'], name='devicelog_ts_idx'),
+            # Ingestion's duplicate lookups by payload hash
+            models.Index(fields=['device', 'data_hash'], name='devicelog_device_hash_idx'),
+        ]
+
+
+class DeviceLogRollup(models.Model):
+    """Per-device message counts for one hour or day of DeviceLog history.
+
+    Written by the retention job before raw logs expire, so historical views
+    don't depend on the raw rows.
+    """
+    PERIOD_CHOICES = [
+        ('hour', 'Hour'),
+        ('day', 'Day')
+    ]
+    # Indexed through unique_devicelog_rollup, which leads with device
+    device = models.ForeignKey('Device', on_delete=models.CASCADE, db_index=False)
+    period = models.CharField(max_length=4, choices=PERIOD_CHOICES)
+    bucket_start = models.DateTimeField()
+    message_count = models.PositiveIntegerField(default=0)
+    first_seen = models.DateTimeField()
+    last_seen = models.DateTimeField()
+    status_counts = models.JSONField(default=dict)
+
+    def __str__(self):
+        return f"{self.device_id} - {self.period} {self.bucket_start}"
+
+    class Meta:
+        ordering = ['-bucket_start']
+        indexes = [
+            # Rebuilding and expiring a day of rollups works by bucket range
+            models.Index(fields=['bucket_start'], name='devicelog_rollup_bucket_idx'),
+        ]
+        constraints = [
+            models.UniqueConstraint(
+                fields=['device', 'period', 'bucket_start'], name='unique_devicelog_rollup'
+            )
+        ]
+
+
+class RollupMark(models.Model):
+    """High-water mark of the raw logs one UTC day's rollups were built from.
+
+    ``prune_device_logs`` rebuilds a day's rollups when its log count or
+    highest log id no longer match, e.g. after ``import_logs`` backfilled it.
+    """
+    day = models.DateTimeField(unique=True)
+    log_count = models.BigIntegerField(default=0)
+    max_log_id = models.BigIntegerField(null=True)
+    rolled_up_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.day:%Y-%m-%d}: {self.log_count} logs up to #{self.max_log_id}"
+
+
+class FleetVersion(models.Model):
+    """Single-row counter stamped on every device status change (see versions.py)"""
+    version = models.BigIntegerField(default=0)
+
+    def __str__(self):
+        return f"Fleet version {self.version}"
+
+
+class RecentMessage(models.Model):
+    """Shared copy of the recent messages list (``RECENT_MESSAGES_BACKEND = 'database'``).
+
+    Written by the consumer workers and loaded by each process at startup;
+    requests are served from memory (see ``recent.py``).
+    """
+    # sha1 of device_id and data, the dedup key of the list
+    key = models.CharField(max_length=40, unique=True)
+    device_id = models.CharField(max_length=100)
+    device_type = models.CharField(max_length=50, null=True, blank=True)
+    data = models.TextField()
+    timestamp = models.DateTimeField()
+
+    def __str__(self):
+        return f"{self.device_id} - {self.data}"
+
+
+class ImportCheckpoint(models.Model):
+    """Progress of one ``manage.py import_logs`` source file.
+
+    Saved in the same transaction as each imported batch, so a resumed
+    import continues exactly after the last committed batch.
+    """
+    source = models.CharField(max_length=500, unique=True)
+    # Records consumed, and the byte offset after them (uncompressed files)
+    position = models.BigIntegerField(default=0)
+    offset = models.BigIntegerField(default=0)
+    rows_imported = models.BigIntegerField(default=0)
+    completed = models.BooleanField(default=False)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.source} @ {self.position}"
+
+
+class FleetCommand(models.Model):
+    """A command sent to a selection of devices (see fleet.py).
+
+    Dispatch and acknowledgements are tracked in memory by the web process
+    that sent it; this row carries its progress for the other processes.
+    """
+    STATUS_CHOICES = [
+        ('dispatching', 'Dispatching'),
+        ('waiting', 'Waiting for acknowledgements'),
+        ('complete', 'Complete'),
+        ('timed_out', 'Timed out'),
+    ]
+    command_id = models.CharField(max_length=32, unique=True)
+    command = models.CharField(max_length=50)
+    payload = models.JSONField(default=dict, blank=True)
+    selector = models.JSONField(default=dict)
+    qos = models.PositiveSmallIntegerField(default=1)
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='dispatching')
+    targets = models.PositiveIntegerField(default=0)
+    sent = models.PositiveIntegerField(default=0)
+    acked = models.PositiveIntegerField(default=0)
+    failed = models.PositiveIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    def __str__(self):
+        return f"{self.command} {self.command_id}"
+
+    class Meta:
+        ordering = ['-created_at']
+
+
+class DeviceQuery(models.Model):
+    """A query sent to one device (see pending.py).
+
+    The web process that sent it waits for the reply in memory; this row
+    carries the outcome for the other processes.
+    """
+    STATUS_CHOICES = [
+        ('pending', 'Pending'),
+        ('answered', 'Answered'),
+        ('timed_out', 'Timed out'),
+    ]
+    correlation_id = models.CharField(max_length=32, unique=True)
+    device_id = models.CharField(max_length=50)
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='pending')
+    response = models.JSONField(null=True, blank=True)
+    rtt_ms = models.FloatField(null=True, blank=True)
+    sent_at = models.DateTimeField(default=timezone.now)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    def __str__(self):
+        return f"{self.device_id} {self.correlation_id}"
+
+    class Meta:
+        ordering = ['-sent_at']
+        indexes = [
+            # Old queries are pruned by send time
+            models.Index(fields=['sent_at'], name='devicequery_sent_idx'),
+        ]
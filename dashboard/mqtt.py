@@ -0,0 +1,78 @@
+"""MQTT client helpers shared by the consumer workers and web processes"""
+import json
+import os
+import time
+
+import paho.mqtt.client as mqtt
+from django.conf import settings
+
+
+def create_client(name, subscriptions=(), on_message=None, status_topic=None):
+    """Build a client, connect it in the background and start its network loop.
+
+    ``subscriptions`` are ``(topic, qos)`` pairs, (re)subscribed on every
+    connect. paho reconnects on its own once the loop is running. With
+    ``status_topic``, "online" is published there (retained) and "offline"
+    is left as the last will.
+    """
+    client = mqtt.Client(client_id=f"{name}_{os.getpid()}_{int(time.time())}")
+    host = getattr(settings, 'MQTT_BROKER_HOST', 'localhost')
+    port = getattr(settings, 'MQTT_BROKER_PORT', 1883)
+
+    def on_connect(client, userdata, flags, rc):
+        if rc == 0:
+            print(f"✅ {name} connected to MQTT broker at {host}:{port}")
+            if subscriptions:
+                client.subscribe(list(subscriptions))
+            if status_topic:
+                client.publish(status_topic, "online", qos=1, retain=True)
+        else:
+            print(f"❌ {name} MQTT connection failed with code {rc}")
+
+    client.on_connect = on_connect
+    if on_message is not None:
+        client.on_message = on_message
+    if status_topic:
+        client.will_set(status_topic, "offline", qos=1, retain=True)
+
+    print(f"🔌 {name} connecting to MQTT broker at {host}:{port}...")
+    client.connect_async(host, port, 60)
+    client.loop_start()
+    return client
+
+
+def publish_json(client, topic, message, qos=0):
+    """Publish ``message`` as JSON; returns True once paho has queued it"""
+    if client is None or not client.is_connected():
+        return False
+    result = client.publish(topic, json.dumps(message), qos=qos)
+    return result.rc == mqtt.MQTT_ERR_SUCCESS
+
+
+def publish_many(client, messages, qos=0, timeout=10.0):
+    """Publish ``[(topic, message), ...]`` as JSON; returns the indexes that failed.
+
+    With QoS 1 or 2 this waits (up to ``timeout`` seconds in all) until the
+    broker has acknowledged the batch, so callers publishing in batches never
+    have more than one batch in flight.
+    """
+    if client is None or not client.is_connected():
+        return list(range(len(messages)))
+    failed = []
+    sent = []
+    for index, (topic, message) in enumerate(messages):
+        info = client.publish(topic, json.dumps(message), qos=qos)
+        if info.rc == mqtt.MQTT_ERR_SUCCESS:
+            sent.append((index, info))
+        else:
+            failed.append(index)
+    if qos:
+        deadline = time.monotonic() + timeout
+        for index, info in sent:
+            try:
+                info.wait_for_publish(max(deadline - time.monotonic(), 0))
+            except (ValueError, RuntimeError):
+                pass
+            if not info.is_published():
+                failed.append(index)
+    return failed
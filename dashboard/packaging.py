@@ -0,0 +1,311 @@
+"""Background packaging of uploaded firmware folders into zip images.
+
+Saving a ``Firmware`` with a ``firmware_folder`` and no ``firmware_file``
+marks it ``pending`` and hands it to :data:`firmware_packager` once the
+transaction commits; the request returns straight away. The packager
+builds the zip in one streaming pass, straight into the blob store:
+
+* files are read in ``BLOCK_SIZE`` blocks, and blocks (of one file or of
+  consecutive files) are deflated in parallel on ``FIRMWARE_PACKAGE_WORKERS``
+  threads (zlib releases the GIL). As in pigz, each block is a raw deflate
+  run primed with the previous 32 KiB and ended with a sync flush, so the
+  blocks join into one ordinary deflate stream per file
+* compressed blocks are written in order as they finish, with a data
+  descriptor after each file, so nothing is buffered beyond the blocks in
+  flight
+* the SHA-256 of the archive is computed as it is written, and the file is
+  then renamed to ``firmware/blobs/<aa>/<sha256>`` without being read again
+
+Progress is stored on the row (``package_status`` and ``package_progress``,
+shown in the admin) about once a second. ``FIRMWARE_ZIP_LEVEL`` sets the
+compression level (0-9). Rows left ``pending`` by a restart are packaged by
+``python manage.py package_firmware``.
+"""
+import hashlib
+import os
+import shutil
+import struct
+import threading
+import time
+import uuid
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.db import close_old_connections
+
+from .firmware import BLOB_DIR, blob_name, patch_builder
+
+BLOCK_SIZE = 1024 * 1024
+DICT_SIZE = 32 * 1024
+PROGRESS_INTERVAL = 1.0
+ZIP_LIMIT = 0xFFFFFFFF
+
+STATUS_PENDING = 'pending'
+STATUS_PACKAGING = 'packaging'
+STATUS_READY = 'ready'
+STATUS_FAILED = 'failed'
+
+
+def deflate_block(data, zdict, last, level):
+    """Raw deflate of one block, joinable with the blocks around it"""
+    if zdict:
+        compressor = zlib.compressobj(
+            level, zlib.DEFLATED, -zlib.MAX_WBITS, zlib.DEF_MEM_LEVEL, zlib.Z_DEFAULT_STRATEGY, zdict
+        )
+    else:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush(zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH)
+
+
+def folder_files(path):
+    """``(path, arcname, size)`` of every file under ``path``, in a stable order"""
+    if os.path.isfile(path):
+        return [(path, os.path.basename(path), os.path.getsize(path))]
+    if not os.path.isdir(path):
+        raise FileNotFoundError(f"Firmware folder not found: {path}")
+    files = []
+    for root, dirs, names in os.walk(path):
+        dirs.sort()
+        for name in sorted(names):
+            file_path = os.path.join(root, name)
+            files.append((file_path, os.path.relpath(file_path, path).replace(os.sep, '/'),
+                          os.path.getsize(file_path)))
+    return files
+
+
+def dos_datetime(timestamp):
+    """Zip (MS-DOS) ``(time, date)`` fields of a modification time"""
+    t = time.localtime(timestamp)
+    dos_time = (t.tm_hour << 11) | (t.tm_min << 5) | (t.tm_sec // 2)
+    dos_date = ((max(t.tm_year, 1980) - 1980) << 9) | (t.tm_mon << 5) | t.tm_mday
+    return dos_time, dos_date
+
+
+class ZipStream:
+    """Writes a zip archive front to back for deflated entries.
+
+    Each entry's local header is written before its data (sizes follow in a
+    data descriptor), and the central directory at :meth:`close`. The
+    SHA-256 and size of everything written are kept as it goes.
+    """
+
+    def __init__(self, out):
+        self.out = out
+        self.offset = 0
+        self.sha256 = hashlib.sha256()
+        self._entries = []
+        self._current = None
+
+    def _write(self, data):
+        self.out.write(data)
+        self.sha256.update(data)
+        self.offset += len(data)
+
+    def start(self, arcname, mtime):
+        name = arcname.encode()
+        dos_time, dos_date = dos_datetime(mtime)
+        # Bit 3: sizes in a data descriptor; bit 11: UTF-8 names
+        flags = 0x0808
+        self._current = [name, flags, dos_time, dos_date, self.offset]
+        self._write(struct.pack(
+            '<IHHHHHIIIHH', 0x04034b50, 20, flags, zlib.DEFLATED, dos_time, dos_date,
+            0, 0, 0, len(name), 0
+        ) + name)
+        self._current.append(self.offset)
+
+    def write(self, data):
+        self._write(data)
+
+    def finish(self, crc, size):
+        name, flags, dos_time, dos_date, header_offset, data_offset = self._current
+        compressed = self.offset - data_offset
+        if max(size, compressed, self.offset) >= ZIP_LIMIT:
+            raise ValueError('Firmware packages of 4 GiB or more are not supported')
+        self._write(struct.pack('<IIII', 0x08074b50, crc, compressed, size))
+        self._entries.append((name, flags, dos_time, dos_date, crc, compressed, size, header_offset))
+        self._current = None
+
+    def close(self):
+        directory_offset = self.offset
+        for name, flags, dos_time, dos_date, crc, compressed, size, header_offset in self._entries:
+            self._write(struct.pack(
+                '<IHHHHHHIIIHHHHHII', 0x02014b50, 20, 20, flags, zlib.DEFLATED, dos_time, dos_date,
+                crc, compressed, size, len(name), 0, 0, 0, 0, 0, header_offset
+            ) + name)
+        if len(self._entries) > 0xFFFF or self.offset >= ZIP_LIMIT:
+            raise ValueError('Firmware packages of 4 GiB or more are not supported')
+        self._write(struct.pack(
+            '<IHHHHIIH', 0x06054b50, 0, 0, len(self._entries), len(self._entries),
+            self.offset - directory_offset, directory_offset, 0
+        ))
+        return self.sha256.hexdigest(), self.offset
+
+
+class FirmwarePackager:
+    """Packages firmware folders on a background thread, one at a time"""
+
+    def __init__(self, level=6, workers=None):
+        self.level = level
+        self.workers = workers or os.cpu_count() or 1
+        self._lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+
+        self._packaged = 0
+        self._failed = 0
+        self._bytes_in = 0
+        self._bytes_out = 0
+        self._seconds = 0.0
+
+    @classmethod
+    def from_settings(cls):
+        return cls(
+            level=getattr(settings, 'FIRMWARE_ZIP_LEVEL', 6),
+            workers=getattr(settings, 'FIRMWARE_PACKAGE_WORKERS', None),
+        )
+
+    def submit(self, firmware_pk):
+        threading.Thread(
+            target=self._run, args=(firmware_pk,), name='firmware-package', daemon=True
+        ).start()
+
+    def _run(self, firmware_pk):
+        try:
+            close_old_connections()
+            firmware = self.package(firmware_pk)
+            print(f"📦 Packaged firmware {firmware} ({firmware.size} bytes)")
+        except Exception as e:
+            print(f"❌ Failed to package firmware: {e}")
+        finally:
+            close_old_connections()
+
+    def package(self, firmware_pk):
+        """Package a firmware's folder into its ``firmware_file``"""
+        from .models import Firmware
+        from .signals import firmware_changed
+
+        # One package at a time: each already uses every worker
+        with self._lock:
+            rows = Firmware.objects.filter(pk=firmware_pk)
+            firmware = rows.get()
+            rows.update(package_status=STATUS_PACKAGING, package_progress=0, package_error='')
+            try:
+                storage = firmware.firmware_folder.storage
+                folder = storage.path(firmware.firmware_folder.name)
+                started = time.perf_counter()
+
+                def progress(percent):
+                    rows.update(package_progress=percent)
+
+                temp_name = f"{BLOB_DIR}/tmp/{uuid.uuid4().hex}.zip"
+                temp_path = storage.path(temp_name)
+                os.makedirs(os.path.dirname(temp_path), exist_ok=True)
+                try:
+                    with open(temp_path, 'wb') as out:
+                        digest, size, total = self.build(folder, out, progress)
+                    name = blob_name(digest)
+                    if not storage.exists(name):
+                        destination = storage.path(name)
+                        os.makedirs(os.path.dirname(destination), exist_ok=True)
+                        os.replace(temp_path, destination)
+                finally:
+                    if os.path.exists(temp_path):
+                        os.remove(temp_path)
+            except Exception as e:
+                rows.update(package_status=STATUS_FAILED, package_error=str(e))
+                with self._stats_lock:
+                    self._failed += 1
+                raise
+
+            rows.update(
+                firmware_file=name, firmware_folder='', sha256=digest, size=size,
+                package_status=STATUS_READY, package_progress=100,
+            )
+            if os.path.isdir(folder):
+                shutil.rmtree(folder)
+            else:
+                storage.delete(firmware.firmware_folder.name)
+            with self._stats_lock:
+                self._packaged += 1
+                self._bytes_in += total
+                self._bytes_out += size
+                self._seconds += time.perf_counter() - started
+
+        firmware_changed()
+        patch_builder.submit(firmware_pk)
+        firmware.refresh_from_db()
+        return firmware
+
+    def build(self, folder, out, progress=None):
+        """Write the zip of ``folder`` to ``out``; returns ``(sha256, size, input bytes)``"""
+        files = folder_files(folder)
+        total = sum(size for _, _, size in files)
+        stream = ZipStream(out)
+        # Output steps in order: bytes to write, a compressed block, or the
+        # end of an entry; at most ``2 * workers`` blocks are in flight
+        steps = deque()
+        in_flight = 0
+        done = 0
+        last_report = time.monotonic()
+        reported = -1
+
+        def drain(limit):
+            nonlocal in_flight, done, last_report, reported
+            while steps and (in_flight > limit or steps[0][0] != 'block'):
+                kind, value, length = steps.popleft()
+                if kind == 'start':
+                    stream.start(*value)
+                elif kind == 'block':
+                    stream.write(value.result())
+                    in_flight -= 1
+                    done += length
+                else:
+                    stream.finish(*value)
+            if progress is not None and time.monotonic() - last_report >= PROGRESS_INTERVAL:
+                percent = min(done * 100 // total, 99) if total else 99
+                if percent != reported:
+                    progress(percent)
+                    reported = percent
+                last_report = time.monotonic()
+
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='firmware-zip') as pool:
+            for path, arcname, _ in files:
+                steps.append(('start', (arcname, os.path.getmtime(path)), 0))
+                crc = 0
+                size = 0
+                zdict = b''
+                with open(path, 'rb') as f:
+                    block = f.read(BLOCK_SIZE)
+                    while True:
+                        following = f.read(BLOCK_SIZE) if block else b''
+                        last = not following
+                        crc = zlib.crc32(block, crc)
+                        size += len(block)
+                        future = pool.submit(deflate_block, block, zdict, last, self.level)
+                        steps.append(('block', future, len(block)))
+                        in_flight += 1
+                        drain(self.workers * 2)
+                        if last:
+                            break
+                        zdict = block[-DICT_SIZE:]
+                        block = following
+                steps.append(('finish', (crc, size), 0))
+            drain(0)
+        digest, size = stream.close()
+        return digest, size, total
+
+    def stats(self):
+        with self._stats_lock:
+            return {
+                'packaged': self._packaged,
+                'failed': self._failed,
+                'bytes_in': self._bytes_in,
+                'bytes_out': self._bytes_out,
+                'mb_per_second': round(self._bytes_in / self._seconds / 1e6, 1) if self._seconds else None,
+                'workers': self.workers,
+                'level': self.level,
+            }
+
+
+firmware_packager = FirmwarePackager.from_settings()
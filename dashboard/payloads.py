@@ -0,0 +1,102 @@
+"""Storage encoding and content hashes of ``DeviceLog`` payloads.
+
+Every log row stores ``data_hash``, a 64-bit hash of its payload's
+canonical JSON. Duplicate detection at ingestion is then an indexed
+``(device, data_hash)`` lookup (``devicelog_device_hash_idx``) instead of a
+JSON comparison of every candidate row.
+
+With ``LOG_PAYLOAD_ENCODING = 'msgpack'`` (``pip install msgpack``) or
+``'cbor'`` (``pip install cbor2``), new payloads are written to the binary
+``data_packed`` column and ``data`` is left NULL. The first byte of
+``data_packed`` names its codec, so rows written under different settings
+can be read side by side. Payloads are decoded transparently: model instances
+(admin, templates) through ``DeviceLog.from_db``, and ``.values()`` readers
+(log pages, export) through :func:`load_payload`.
+"""
+import hashlib
+import json
+
+from django.conf import settings
+
+try:
+    import msgpack
+except ImportError:  # optional dependency
+    msgpack = None
+
+try:
+    import cbor2
+except ImportError:  # optional dependency
+    cbor2 = None
+
+ENCODING_JSON = 'json'
+ENCODING_MSGPACK = 'msgpack'
+ENCODING_CBOR = 'cbor'
+
+TAG_MSGPACK = b'm'
+TAG_CBOR = b'c'
+
+
+def canonical_json(data):
+    return json.dumps(data, sort_keys=True, separators=(',', ':'), ensure_ascii=False)
+
+
+def payload_hash(data):
+    """Signed 64-bit hash of a payload, equal for equal JSON values"""
+    digest = hashlib.blake2b(canonical_json(data).encode(), digest_size=8).digest()
+    return int.from_bytes(digest, 'big', signed=True)
+
+
+def unpack_payload(packed):
+    """Decode a ``data_packed`` value"""
+    packed = bytes(packed)
+    tag, body = packed[:1], packed[1:]
+    if tag == TAG_MSGPACK and msgpack is not None:
+        return msgpack.unpackb(body, raw=False)
+    if tag == TAG_CBOR and cbor2 is not None:
+        return cbor2.loads(body)
+    raise ValueError(f"Can't decode a payload packed with {tag!r}; is its codec installed?")
+
+
+def load_payload(data, packed):
+    """The payload of a row from its ``data`` and ``data_packed`` columns"""
+    if data is None and packed is not None:
+        return unpack_payload(packed)
+    return data
+
+
+class PayloadCodec:
+    """Turns payloads into ``(data, data_packed, data_hash)`` column values"""
+
+    def __init__(self, encoding=ENCODING_JSON):
+        if encoding == ENCODING_MSGPACK:
+            self._pack = lambda data: TAG_MSGPACK + msgpack.packb(data, use_bin_type=True)
+        elif encoding == ENCODING_CBOR:
+            self._pack = lambda data: TAG_CBOR + cbor2.dumps(data)
+        elif encoding == ENCODING_JSON:
+            self._pack = None
+        else:
+            raise ValueError(f"Unknown LOG_PAYLOAD_ENCODING: {encoding}")
+        self.encoding = encoding
+
+    @classmethod
+    def from_settings(cls):
+        encoding = getattr(settings, 'LOG_PAYLOAD_ENCODING', ENCODING_JSON)
+        library = {ENCODING_MSGPACK: msgpack, ENCODING_CBOR: cbor2}.get(encoding, True)
+        if library is None:
+            print(f"⚠️ LOG_PAYLOAD_ENCODING is {encoding!r} but its library is not installed; "
+                  f"storing log payloads as JSON")
+            encoding = ENCODING_JSON
+        return cls(encoding)
+
+    def pack(self, data):
+        """``data_packed`` for a payload, or None when payloads are stored as JSON"""
+        return self._pack(data) if self._pack is not None else None
+
+    def prepare(self, data):
+        """Database values of ``(data, data_packed, data_hash)`` for a payload"""
+        if self._pack is not None:
+            return None, self._pack(data), payload_hash(data)
+        return json.dumps(data), None, payload_hash(data)
+
+
+payload_codec = PayloadCodec.from_settings()
@@ -0,0 +1,292 @@
+"""Correlation of device queries with their replies.
+
+Every query (``/api/device/<id>/query/`` and ``/api/queries/``) gets a
+correlation ID, sent to the device as ``command-id`` next to the ping. The
+device echoes it on ``check/response``; the consumer worker that owns the
+device forwards the reply as an ``ack`` event, and the event bridge resolves
+it here with one dict lookup.
+
+:data:`pending_requests` is the table of queries this web process is
+waiting for. Callers can wait for one reply (:meth:`PendingRequests.wait`)
+or for a batch until a common deadline (:meth:`PendingRequests.wait_all`).
+A query that isn't answered within its timeout is marked ``timed_out``.
+Answered and timed out queries are kept for ``QUERY_RESULT_TTL`` seconds so
+their outcome can still be fetched.
+
+Every web process gets the ``ack`` events, but only the one that sent a
+query knows about it. Each query is also recorded as a ``DeviceQuery`` row
+when it is sent, and a saver thread copies outcomes to the rows about once
+a second, so :meth:`PendingRequests.outcome` works in any process. Rows are
+deleted ``QUERY_RESULT_TTL`` seconds after they finish.
+
+The round-trip time is measured from the publish to the moment the consumer
+received the reply, so it doesn't include the event bridge's forwarding
+delay.
+"""
+import heapq
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta, timezone
+
+from django.conf import settings
+from django.db import close_old_connections, transaction
+from django.db.models import Q
+
+from .models import DeviceQuery
+
+STATUS_PENDING = 'pending'
+STATUS_ANSWERED = 'answered'
+STATUS_TIMED_OUT = 'timed_out'
+
+SAVE_INTERVAL = 1.0
+PRUNE_INTERVAL = 60.0
+# Rows a process never finished (it restarted) are dropped after this long
+ORPHAN_TTL = timedelta(days=1)
+
+
+def round_trip_ms(sent_at, received_at):
+    """Milliseconds from ``sent_at`` (epoch seconds) to an ISO 8601 receive time"""
+    try:
+        received = datetime.fromisoformat(received_at).timestamp()
+    except (TypeError, ValueError):
+        received = time.time()
+    return round(max(received - sent_at, 0) * 1000, 3)
+
+
+class PendingRequest:
+    """One query waiting for (or answered by) a device"""
+
+    __slots__ = ('correlation_id', 'device_id', 'sent_at', 'deadline', 'status', 'response',
+                 'rtt_ms', 'finished_at')
+
+    def __init__(self, correlation_id, device_id, timeout):
+        self.correlation_id = correlation_id
+        self.device_id = device_id
+        self.sent_at = time.time()
+        self.deadline = time.monotonic() + timeout
+        self.status = STATUS_PENDING
+        self.response = None
+        self.rtt_ms = None
+        self.finished_at = None
+
+    @property
+    def sent_time(self):
+        return datetime.fromtimestamp(self.sent_at, timezone.utc)
+
+    def as_dict(self):
+        return {
+            'correlation_id': self.correlation_id,
+            'device_id': self.device_id,
+            'status': self.status,
+            'response': self.response,
+            'rtt_ms': self.rtt_ms,
+            'sent_at': self.sent_time.isoformat(),
+        }
+
+
+class PendingRequests:
+    """Thread-safe ``correlation_id`` -> :class:`PendingRequest` table"""
+
+    def __init__(self, timeout=10.0, result_ttl=300.0, max_size=100000, save_interval=SAVE_INTERVAL):
+        self.timeout = timeout
+        self.result_ttl = result_ttl
+        self.max_size = max_size
+        # None: no saver thread, outcomes are only saved by calling save()
+        self.save_interval = save_interval
+        self._requests = {}
+        # (deadline, correlation_id) of pending requests, then of results to drop
+        self._deadlines = []
+        self._expiries = []
+        self._changed = threading.Condition()
+        # Finished requests whose rows haven't been updated yet
+        self._unsaved = []
+        self._thread = None
+
+        self._created = 0
+        self._answered = 0
+        self._timed_out = 0
+        self._rtt_total = 0.0
+
+    @classmethod
+    def from_settings(cls):
+        return cls(
+            timeout=getattr(settings, 'QUERY_TIMEOUT', 10),
+            result_ttl=getattr(settings, 'QUERY_RESULT_TTL', 300),
+        )
+
+    def create(self, device_id, timeout=None):
+        """Register a query to ``device_id``; returns it with a new correlation ID"""
+        return self.create_many([device_id], timeout)[0]
+
+    def create_many(self, device_ids, timeout=None):
+        """Register one query per device, recording them with one insert"""
+        requests = [
+            PendingRequest(uuid.uuid4().hex, device_id, timeout or self.timeout)
+            for device_id in device_ids
+        ]
+        with self._changed:
+            self._expire()
+            if len(self._requests) + len(requests) > self.max_size:
+                raise RuntimeError('Too many pending device queries')
+        DeviceQuery.objects.bulk_create([
+            DeviceQuery(
+                correlation_id=request.correlation_id, device_id=request.device_id,
+                sent_at=request.sent_time,
+            )
+            for request in requests
+        ])
+        with self._changed:
+            for request in requests:
+                self._requests[request.correlation_id] = request
+                heapq.heappush(self._deadlines, (request.deadline, request.correlation_id))
+            self._created += len(requests)
+        self.start()
+        return requests
+
+    def get(self, correlation_id):
+        with self._changed:
+            self._expire()
+            return self._requests.get(correlation_id)
+
+    def resolve(self, correlation_id, device_id, response=None, received_at=None):
+        """Match a reply to its query; returns False when it isn't one of ours"""
+        with self._changed:
+            request = self._requests.get(correlation_id)
+            if request is None or request.device_id != device_id or request.status != STATUS_PENDING:
+                return False
+            request.status = STATUS_ANSWERED
+            request.response = response
+            request.rtt_ms = round_trip_ms(request.sent_at, received_at)
+            self._finish(request)
+            self._answered += 1
+            self._rtt_total += request.rtt_ms
+            self._changed.notify_all()
+        return True
+
+    def fail(self, correlation_ids):
+        """Drop queries that couldn't be sent"""
+        with self._changed:
+            for correlation_id in correlation_ids:
+                self._requests.pop(correlation_id, None)
+        DeviceQuery.objects.filter(correlation_id__in=correlation_ids).delete()
+
+    def outcome(self, correlation_id, wait=0):
+        """A query's outcome as a dict, from memory or from its row; None if unknown.
+
+        Only the process that sent the query can wait for it.
+        """
+        request = self.wait(correlation_id, wait) if wait else self.get(correlation_id)
+        if request is not None:
+            return request.as_dict()
+        row = DeviceQuery.objects.filter(correlation_id=correlation_id).values(
+            'correlation_id', 'device_id', 'status', 'response', 'rtt_ms', 'sent_at'
+        ).first()
+        if row is not None:
+            row['sent_at'] = row['sent_at'].isoformat()
+        return row
+
+    def wait(self, correlation_id, timeout):
+        """Wait up to ``timeout`` seconds for a reply; returns the request (or None)"""
+        return self.wait_all([correlation_id], timeout).get(correlation_id)
+
+    def wait_all(self, correlation_ids, timeout):
+        """Wait until every query is answered or timed out, or ``timeout`` seconds pass.
+
+        Returns ``{correlation_id: request}``; requests still pending at the
+        deadline are returned as they are.
+        """
+        deadline = time.monotonic() + timeout
+        with self._changed:
+            while True:
+                self._expire()
+                requests = {
+                    correlation_id: self._requests.get(correlation_id)
+                    for correlation_id in correlation_ids
+                }
+                remaining = deadline - time.monotonic()
+                waiting = [
+                    request for request in requests.values()
+                    if request is not None and request.status == STATUS_PENDING
+                ]
+                if not waiting or remaining <= 0:
+                    return requests
+                # Wake up for replies, and at the next query timeout
+                next_timeout = min(request.deadline for request in waiting) - time.monotonic()
+                self._changed.wait(max(min(remaining, next_timeout), 0.001))
+
+    def _finish(self, request):
+        request.finished_at = time.monotonic()
+        heapq.heappush(self._expiries, (request.finished_at + self.result_ttl, request.correlation_id))
+        self._unsaved.append(request)
+
+    def _expire(self):
+        """Time out overdue queries and drop old results (lock held)"""
+        now = time.monotonic()
+        while self._deadlines and self._deadlines[0][0] <= now:
+            _, correlation_id = heapq.heappop(self._deadlines)
+            request = self._requests.get(correlation_id)
+            if request is not None and request.status == STATUS_PENDING:
+                request.status = STATUS_TIMED_OUT
+                self._finish(request)
+                self._timed_out += 1
+        while self._expiries and self._expiries[0][0] <= now:
+            _, correlation_id = heapq.heappop(self._expiries)
+            self._requests.pop(correlation_id, None)
+
+    def start(self):
+        if not self.save_interval or (self._thread is not None and self._thread.is_alive()):
+            return
+        self._thread = threading.Thread(target=self._run, name='query-saver', daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        last_prune = 0.0
+        while True:
+            time.sleep(self.save_interval)
+            try:
+                self.save()
+                if time.monotonic() - last_prune >= PRUNE_INTERVAL:
+                    last_prune = time.monotonic()
+                    self.prune()
+            except Exception as e:
+                print(f"❌ Failed to save device queries: {e}")
+
+    def save(self):
+        """Copy finished queries' outcomes to their ``DeviceQuery`` rows"""
+        with self._changed:
+            self._expire()
+            finished, self._unsaved = self._unsaved, []
+        if not finished:
+            return 0
+        close_old_connections()
+        now = datetime.now(timezone.utc)
+        with transaction.atomic():
+            for request in finished:
+                DeviceQuery.objects.filter(correlation_id=request.correlation_id).update(
+                    status=request.status, response=request.response, rtt_ms=request.rtt_ms,
+                    finished_at=now,
+                )
+        return len(finished)
+
+    def prune(self):
+        """Delete rows of queries that finished more than ``result_ttl`` ago"""
+        now = datetime.now(timezone.utc)
+        return DeviceQuery.objects.filter(
+            Q(finished_at__lt=now - timedelta(seconds=self.result_ttl))
+            | Q(finished_at__isnull=True, sent_at__lt=now - ORPHAN_TTL)
+        ).delete()[0]
+
+    def stats(self):
+        with self._changed:
+            self._expire()
+            return {
+                'pending': sum(1 for request in self._requests.values() if request.status == STATUS_PENDING),
+                'created': self._created,
+                'answered': self._answered,
+                'timed_out': self._timed_out,
+                'rtt_ms_avg': round(self._rtt_total / self._answered, 3) if self._answered else None,
+            }
+
+
+pending_requests = PendingRequests.from_settings()
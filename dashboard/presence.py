@@ -0,0 +1,262 @@
+"""Deadline-driven presence tracking.
+
+The ingestion path calls :meth:`PresenceTracker.touch` for every device it
+sees. The tracker keeps one deadline per device in a min-heap, and a
+background thread wakes for the earliest deadline (at least once per
+``PRESENCE_TICK`` seconds). Work per tick is proportional to the number of
+expiring devices, not the fleet size.
+
+Heap entries are not removed when a device reports again. Each device has
+one authoritative deadline, and an entry whose deadline doesn't match it
+is discarded or rescheduled when it is popped. A device that reports every
+few seconds therefore costs one heap entry per threshold window, not one
+per message.
+
+Transitions are written with the same guarded ``UPDATE`` as the sweeper
+(``status`` and ``last_seen`` are re-checked in SQL), so a device that was
+seen more recently by another process is never demoted. The tracker only
+advances devices whose row was updated; the others are reloaded from the
+database and rescheduled.
+"""
+import heapq
+import threading
+import time
+from datetime import datetime, timezone as dt_timezone
+from itertools import count
+
+from django.conf import settings
+from django.db import close_old_connections
+from django.utils import timezone
+
+from .database import db_writer
+from .events import event_hub
+from .models import Device
+from .registry import device_registry
+from .sweeper import NEXT_STATUS, silence_limit, update_status_returning
+
+# Keep device_id IN (...) lists well below SQLite's 999 parameter limit
+TRANSITION_CHUNK = 500
+
+
+class _Presence:
+    __slots__ = ('device_type', 'status', 'last_seen', 'deadline')
+
+    def __init__(self, device_type, status, last_seen):
+        self.device_type = device_type
+        self.status = status
+        self.last_seen = last_seen
+        self.deadline = None
+
+    def due(self):
+        """Epoch seconds at which the device leaves its current status"""
+        return self.last_seen + silence_limit(self.status, self.device_type).total_seconds()
+
+
+class PresenceTracker:
+    """Per-device deadlines in a heap, drained by a ticker thread"""
+
+    def __init__(self, tick=1.0):
+        self.tick = tick
+        # Optional ``owns(device_id)`` predicate limiting warm() to one shard
+        self.owns = None
+        self._devices = {}
+        self._heap = []
+        self._sequence = count()
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition(self._lock)
+        self._thread = None
+
+        self._transitions = {status: 0 for status in NEXT_STATUS.values()}
+        self._ticks = 0
+        self._max_lateness = 0.0
+        self._last_tick_expired = 0
+
+    @classmethod
+    def from_settings(cls):
+        return cls(tick=getattr(settings, 'PRESENCE_TICK', 1.0))
+
+    def touch(self, device_id, device_type, last_seen, status='online'):
+        """Record that ``device_id`` reported ``status`` at ``last_seen``"""
+        if status not in NEXT_STATUS:
+            return
+        seen = last_seen.timestamp()
+        with self._lock:
+            presence = self._devices.get(device_id)
+            if presence is None:
+                presence = self._devices[device_id] = _Presence(device_type, status, seen)
+            elif seen < presence.last_seen:
+                return
+            else:
+                presence.device_type = device_type or presence.device_type
+                presence.status = status
+                presence.last_seen = seen
+            self._schedule(device_id, presence)
+
+    def forget(self, device_id):
+        with self._lock:
+            self._devices.pop(device_id, None)
+
+    def _schedule(self, device_id, presence):
+        due = presence.due()
+        # A later entry is already queued: it will be rescheduled when popped.
+        # An earlier or missing one needs a new entry.
+        if presence.deadline is None or due < presence.deadline:
+            presence.deadline = due
+            heapq.heappush(self._heap, (due, next(self._sequence), device_id))
+            if self._heap[0][2] == device_id:
+                self._wakeup.notify()
+
+    def warm(self):
+        """Track every device the database currently shows as online or idle"""
+        rows = Device.objects.filter(status__in=list(NEXT_STATUS)).values_list(
+            'device_id', 'device_type', 'status', 'last_seen'
+        )
+        fallback = timezone.now()
+        for device_id, device_type, status, last_seen in rows.iterator():
+            if self.owns is not None and not self.owns(device_id):
+                continue
+            self.touch(device_id, device_type, last_seen or fallback, status)
+
+    def expire(self, now=None):
+        """Pop every deadline that has passed and write the resulting transitions"""
+        now = time.time() if now is None else now
+        expired = {status: {} for status in NEXT_STATUS}
+        with self._lock:
+            while self._heap and self._heap[0][0] <= now:
+                deadline, _, device_id = heapq.heappop(self._heap)
+                presence = self._devices.get(device_id)
+                if presence is None or presence.deadline != deadline:
+                    continue
+                presence.deadline = None
+                if presence.due() > now:
+                    self._schedule(device_id, presence)
+                    continue
+                self._max_lateness = max(self._max_lateness, now - deadline)
+                # Left unscheduled until the database write says what happened
+                expired[presence.status].setdefault(presence.device_type, []).append(device_id)
+            self._ticks += 1
+            self._last_tick_expired = sum(
+                len(ids) for by_type in expired.values() for ids in by_type.values()
+            )
+
+        try:
+            changed = self._write_transitions(expired, now)
+        except Exception:
+            # Try the whole tick's transitions again one tick later
+            with self._lock:
+                for by_type in expired.values():
+                    for device_ids in by_type.values():
+                        for device_id in device_ids:
+                            self._retry(device_id, now + self.tick)
+            raise
+
+        stale = []
+        with self._lock:
+            for from_status, by_type in expired.items():
+                updated = set(changed[NEXT_STATUS[from_status]])
+                for device_ids in by_type.values():
+                    for device_id in device_ids:
+                        presence = self._devices.get(device_id)
+                        if presence is None or presence.deadline is not None:
+                            # Forgotten, or reported again during the write
+                            continue
+                        if device_id not in updated:
+                            # The database disagrees (seen more recently elsewhere,
+                            # or already moved on): start over from the stored row
+                            del self._devices[device_id]
+                            stale.append(device_id)
+                            continue
+                        presence.status = NEXT_STATUS[from_status]
+                        if presence.status in NEXT_STATUS:
+                            self._schedule(device_id, presence)
+                        else:
+                            del self._devices[device_id]
+        if stale:
+            self._reload(stale)
+
+        for status, device_ids in changed.items():
+            if not device_ids:
+                continue
+            with self._lock:
+                self._transitions[status] += len(device_ids)
+            for device_id in device_ids:
+                device_registry.update(device_id, status=status)
+            event_hub.publish_status(status, device_ids)
+        return changed
+
+    def _write_transitions(self, expired, now):
+        """Guarded UPDATEs for the expired devices; returns the changed device_ids"""
+        changed = {}
+        when = datetime.fromtimestamp(now, tz=dt_timezone.utc)
+        for from_status, by_type in expired.items():
+            to_status = NEXT_STATUS[from_status]
+            changed[to_status] = []
+            for device_type, device_ids in by_type.items():
+                cutoff = when - silence_limit(from_status, device_type)
+                for start in range(0, len(device_ids), TRANSITION_CHUNK):
+                    changed[to_status] += db_writer.run(
+                        update_status_returning,
+                        Device.objects.filter(
+                            device_id__in=device_ids[start:start + TRANSITION_CHUNK],
+                            status=from_status,
+                            last_seen__lte=cutoff,
+                        ),
+                        to_status
+                    )
+        return changed
+
+    def _retry(self, device_id, when):
+        presence = self._devices.get(device_id)
+        if presence is not None and presence.deadline is None:
+            presence.deadline = when
+            heapq.heappush(self._heap, (when, next(self._sequence), device_id))
+
+    def _reload(self, device_ids):
+        """Track ``device_ids`` again from their database rows"""
+        for start in range(0, len(device_ids), TRANSITION_CHUNK):
+            rows = Device.objects.filter(
+                device_id__in=device_ids[start:start + TRANSITION_CHUNK]
+            ).values_list('device_id', 'device_type', 'status', 'last_seen')
+            for device_id, device_type, status, last_seen in rows:
+                if last_seen is not None:
+                    self.touch(device_id, device_type, last_seen, status)
+
+    def start(self):
+        """Warm from the database and start the ticker thread (idempotent)"""
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._thread = threading.Thread(target=self._run, name='presence-ticker', daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        try:
+            self.warm()
+        except Exception as e:
+            print(f"❌ Failed to warm presence tracker: {e}")
+        while True:
+            with self._lock:
+                timeout = self.tick
+                if self._heap:
+                    timeout = min(timeout, max(self._heap[0][0] - time.time(), 0))
+                if timeout > 0:
+                    self._wakeup.wait(timeout)
+            try:
+                close_old_connections()
+                self.expire()
+            except Exception as e:
+                print(f"❌ Presence tick failed: {e}")
+
+    def stats(self):
+        with self._lock:
+            return {
+                'tracked_devices': len(self._devices),
+                'heap_size': len(self._heap),
+                'next_deadline_in': round(self._heap[0][0] - time.time(), 3) if self._heap else None,
+                'ticks': self._ticks,
+                'last_tick_expired': self._last_tick_expired,
+                'transitions': dict(self._transitions),
+                'max_lateness_ms': round(self._max_lateness * 1000, 3),
+            }
+
+
+presence_tracker = PresenceTracker.from_settings()
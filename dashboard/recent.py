@@ -0,0 +1,209 @@
+"""The recent messages list shown on the dashboard.
+
+Consumer workers record messages as they arrive. Web processes receive them
+through the event bridge and keep their own copy for
+``/get_recent_messages/`` and the dashboard, so reads never touch the
+database.
+
+The list is a fixed-capacity ring buffer (``MAX_RECENT_MESSAGES``) with a
+hash index on ``(device_id, data)``. Recording a message, refreshing a
+duplicate's timestamp and evicting the oldest entry are all O(1).
+
+With ``RECENT_MESSAGES_BACKEND = 'database'`` the consumer workers also
+write the list to the ``RecentMessage`` table every
+``RECENT_MESSAGES_FLUSH_INTERVAL`` seconds. Processes load it at startup,
+so a restarted or newly started web process serves the same list as the
+others instead of starting empty.
+"""
+import hashlib
+import threading
+import time
+from datetime import datetime
+
+from django.conf import settings
+from django.db import close_old_connections, transaction
+
+from .database import db_writer
+
+BACKEND_MEMORY = 'memory'
+BACKEND_DATABASE = 'database'
+
+
+def message_key(device_id, data):
+    """Stable digest of a (device_id, data) pair, unique in ``RecentMessage``"""
+    return hashlib.sha1(f"{device_id}\0{data}".encode()).hexdigest()
+
+
+class RecentMessages:
+    """The last ``capacity`` distinct (device_id, data) messages"""
+
+    def __init__(self, capacity=200, backend=BACKEND_MEMORY, flush_interval=1.0):
+        if backend not in (BACKEND_MEMORY, BACKEND_DATABASE):
+            raise ValueError(f"Unknown recent messages backend: {backend}")
+        self.capacity = capacity
+        self.backend = backend
+        self.flush_interval = flush_interval
+        self._slots = [None] * capacity
+        self._index = {}  # (device_id, data) -> slot
+        self._next = 0  # slot written next, i.e. the oldest entry once full
+        self._size = 0
+        self._lock = threading.Lock()
+        # Entries changed since the last flush, only collected by writers
+        self._dirty = {}
+        self._writer = None
+
+        self._recorded = 0
+        self._refreshed = 0
+        self._evicted = 0
+        self._flushed = 0
+
+    @classmethod
+    def from_settings(cls):
+        return cls(
+            capacity=getattr(settings, 'MAX_RECENT_MESSAGES', 200),
+            backend=getattr(settings, 'RECENT_MESSAGES_BACKEND', BACKEND_MEMORY),
+            flush_interval=getattr(settings, 'RECENT_MESSAGES_FLUSH_INTERVAL', 1.0),
+        )
+
+    def remember(self, device_id, device_type, data, timestamp):
+        """Record a message; returns the entry, or None if it only refreshed one"""
+        timestamp = timestamp if isinstance(timestamp, str) else timestamp.isoformat()
+        key = (device_id, data)
+        with self._lock:
+            # Refresh the timestamp if the same device already sent the same data
+            slot = self._index.get(key)
+            if slot is not None:
+                message = self._slots[slot]
+                message['timestamp'] = timestamp
+                self._refreshed += 1
+                if self._writer is not None:
+                    self._dirty[key] = message
+                return None
+
+            # Overwrite the oldest message once the buffer is full
+            oldest = self._slots[self._next]
+            if oldest is not None:
+                oldest_key = (oldest['device_id'], oldest['data'])
+                del self._index[oldest_key]
+                self._dirty.pop(oldest_key, None)
+                self._evicted += 1
+            message = {
+                'device_id': device_id,
+                'data': data,
+                'timestamp': timestamp,
+                'device_type': device_type
+            }
+            self._slots[self._next] = message
+            self._index[key] = self._next
+            self._next = (self._next + 1) % self.capacity
+            self._size = min(self._size + 1, self.capacity)
+            self._recorded += 1
+            if self._writer is not None:
+                self._dirty[key] = message
+            return dict(message)
+
+    def all(self, limit=None):
+        """Copies of the messages, oldest first; ``limit`` keeps the newest"""
+        with self._lock:
+            if self._size < self.capacity:
+                messages = self._slots[:self._size]
+            else:
+                messages = self._slots[self._next:] + self._slots[:self._next]
+            if limit is not None:
+                messages = messages[-limit:] if limit > 0 else []
+            return [dict(message) for message in messages]
+
+    def __len__(self):
+        return self._size
+
+    def warm(self):
+        """Load the shared list; no-op with the memory backend"""
+        if self.backend != BACKEND_DATABASE:
+            return 0
+        from .models import RecentMessage
+
+        rows = list(RecentMessage.objects.order_by('-id').values_list(
+            'device_id', 'device_type', 'data', 'timestamp'
+        )[:self.capacity])
+        for device_id, device_type, data, timestamp in reversed(rows):
+            self.remember(device_id, device_type, data, timestamp)
+        return len(rows)
+
+    def flush(self):
+        """Write the entries changed since the last flush to ``RecentMessage``"""
+        from .models import RecentMessage
+
+        with self._lock:
+            dirty, self._dirty = self._dirty, {}
+            entries = {message_key(*key): dict(message) for key, message in dirty.items()}
+        if not entries:
+            return 0
+
+        try:
+            with transaction.atomic():
+                existing = dict(RecentMessage.objects.filter(key__in=list(entries)).values_list('key', 'pk'))
+                RecentMessage.objects.bulk_update([
+                    RecentMessage(pk=pk, timestamp=datetime.fromisoformat(entries[key]['timestamp']))
+                    for key, pk in existing.items()
+                ], ['timestamp'])
+                # Another worker may insert the same key concurrently
+                RecentMessage.objects.bulk_create([
+                    RecentMessage(
+                        key=key,
+                        device_id=message['device_id'],
+                        device_type=message['device_type'],
+                        data=message['data'],
+                        timestamp=datetime.fromisoformat(message['timestamp']),
+                    )
+                    for key, message in entries.items() if key not in existing
+                ], ignore_conflicts=True)
+                # Keep only the newest ``capacity`` rows
+                cutoff = RecentMessage.objects.order_by('-id').values_list(
+                    'id', flat=True
+                )[self.capacity:self.capacity + 1]
+                if cutoff:
+                    RecentMessage.objects.filter(id__lte=cutoff[0]).delete()
+        except Exception:
+            # Retry on the next flush unless newer changes replaced them
+            with self._lock:
+                for key in dirty:
+                    if key in self._index and key not in self._dirty:
+                        self._dirty[key] = self._slots[self._index[key]]
+            raise
+
+        with self._lock:
+            self._flushed += len(entries)
+        return len(entries)
+
+    def start_writer(self):
+        """Load the shared list and keep writing to it (consumer workers only)"""
+        if self.backend != BACKEND_DATABASE or self._writer is not None:
+            return
+        self.warm()
+        self._writer = threading.Thread(target=self._run_writer, name='recent-messages', daemon=True)
+        self._writer.start()
+
+    def _run_writer(self):
+        while True:
+            time.sleep(self.flush_interval)
+            try:
+                close_old_connections()
+                db_writer.run(self.flush)
+            except Exception as e:
+                print(f"❌ Failed to write recent messages: {e}")
+
+    def stats(self):
+        with self._lock:
+            return {
+                'backend': self.backend,
+                'capacity': self.capacity,
+                'size': self._size,
+                'recorded': self._recorded,
+                'refreshed': self._refreshed,
+                'evicted': self._evicted,
+                'pending_writes': len(self._dirty),
+                'written': self._flushed,
+            }
+
+
+recent_messages = RecentMessages.from_settings()
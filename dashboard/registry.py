@@ -0,0 +1,278 @@
+"""Process-wide cache of the device state needed on the ingestion hot path.
+
+The registry is warmed with one query at startup and kept current by the
+``Device`` save/delete signals (see ``signals.py``) and by the ingestion
+flusher, which updates it after each committed batch. In steady state
+neither ingestion nor the status API needs to SELECT from ``Device``.
+
+Every status transition (ingestion, presence, sweeps, admin saves and the
+events bridge) goes through the registry, so it also keeps per-status and
+per-device_type counters that give the fleet summary in O(1). A periodic
+reconciliation compares them with a ``GROUP BY`` over ``Device`` and
+reloads the registry if they drifted.
+"""
+import sys
+import threading
+import time
+from collections import Counter
+
+from django.db import close_old_connections
+from django.db.models import Count
+
+from .models import Device
+
+# How many distinct log payloads to remember per device so repeated
+# heartbeats can skip the DeviceLog duplicate lookup
+RECENT_DATA_PER_DEVICE = 8
+
+
+class DeviceState:
+    """Compact snapshot of a ``Device`` row"""
+
+    __slots__ = ('pk', 'device_id', 'name', 'device_type', 'status', 'last_seen', 'recent_data')
+
+    def __init__(self, pk, device_id, name, device_type, status, last_seen):
+        self.pk = pk
+        self.device_id = device_id
+        self.name = name
+        self.device_type = device_type
+        self.status = status
+        self.last_seen = last_seen
+        self.recent_data = {}
+
+    @classmethod
+    def from_device(cls, device):
+        return cls(device.pk, device.device_id, device.name, device.device_type,
+                   device.status, device.last_seen)
+
+    def remember_data(self, data):
+        """Remember that a log entry with ``data`` exists for this device"""
+        self.recent_data.pop(data, None)
+        self.recent_data[data] = True
+        if len(self.recent_data) > RECENT_DATA_PER_DEVICE:
+            del self.recent_data[next(iter(self.recent_data))]
+
+    def footprint(self):
+        size = sys.getsizeof(self) + sys.getsizeof(self.recent_data)
+        for value in (self.device_id, self.name, self.device_type, self.status, self.last_seen):
+            size += sys.getsizeof(value)
+        return size + sum(sys.getsizeof(data) for data in self.recent_data)
+
+
+def count_key(state):
+    """Counter bucket of a device: (status, device_type)"""
+    return (state.status or 'offline', state.device_type)
+
+
+class DeviceRegistry:
+    """Thread-safe ``device_id`` -> :class:`DeviceState` map"""
+
+    def __init__(self):
+        self._devices = {}
+        self._device_ids = {}  # pk -> device_id, to find an entry after a rename
+        self._lock = threading.RLock()
+        self._counts = Counter()
+        self._warm = False
+        self._hits = 0
+        self._misses = 0
+        self._reconciler = None
+        self._last_drift = {}
+        self._reconciled = 0
+        self._corrections = 0
+
+    def warm(self):
+        """(Re)load every device with a single query"""
+        rows = Device.objects.values_list(
+            'pk', 'device_id', 'name', 'device_type', 'status', 'last_seen'
+        )
+        devices = {row[1]: DeviceState(*row) for row in rows.iterator()}
+        device_ids = {state.pk: device_id for device_id, state in devices.items()}
+        counts = Counter(count_key(state) for state in devices.values())
+        with self._lock:
+            self._devices = devices
+            self._device_ids = device_ids
+            self._counts = counts
+            self._warm = True
+        return len(devices)
+
+    def ensure_warm(self):
+        with self._lock:
+            if not self._warm:
+                self.warm()
+
+    def get(self, device_id):
+        """Return the cached state for ``device_id`` or None if unknown"""
+        self.ensure_warm()
+        with self._lock:
+            state = self._devices.get(device_id)
+            if state is None:
+                self._misses += 1
+            else:
+                self._hits += 1
+            return state
+
+    def get_or_load(self, device_id):
+        """Like :meth:`get`, but a miss is looked up in the database"""
+        return self.get_many([device_id]).get(device_id)
+
+    def get_many(self, device_ids):
+        """``{device_id: state}`` for the given devices that exist.
+
+        Devices this process hasn't heard of yet (created by a consumer
+        worker, say) are loaded with one query for all of them.
+        """
+        states = {device_id: self.get(device_id) for device_id in dict.fromkeys(device_ids)}
+        missing = [device_id for device_id, state in states.items() if state is None]
+        if missing and self.load(missing):
+            with self._lock:
+                for device_id in missing:
+                    states[device_id] = self._devices.get(device_id)
+        return {device_id: state for device_id, state in states.items() if state is not None}
+
+    def all(self):
+        """Snapshot of every cached device state"""
+        self.ensure_warm()
+        with self._lock:
+            return list(self._devices.values())
+
+    def _adjust(self, key, delta):
+        self._counts[key] += delta
+        if not self._counts[key]:
+            del self._counts[key]
+
+    def _count(self, state, delta):
+        self._adjust(count_key(state), delta)
+
+    def put(self, state):
+        with self._lock:
+            previous = self._devices.get(state.device_id)
+            if previous is not None:
+                self._count(previous, -1)
+            if previous is not None and previous.pk == state.pk:
+                state.recent_data = previous.recent_data
+            else:
+                if previous is not None:
+                    self._device_ids.pop(previous.pk, None)
+                # Renamed device_id: drop the entry under the old one
+                stale = self._device_ids.get(state.pk)
+                if stale is not None:
+                    self._count(self._devices.pop(stale), -1)
+            self._devices[state.device_id] = state
+            self._device_ids[state.pk] = state.device_id
+            self._count(state, 1)
+
+    def load(self, device_ids):
+        """Fetch devices this process hasn't cached yet (e.g. created by a
+        consumer worker) with one query; returns the number loaded"""
+        rows = Device.objects.filter(device_id__in=list(device_ids)).values_list(
+            'pk', 'device_id', 'name', 'device_type', 'status', 'last_seen'
+        )
+        states = [DeviceState(*row) for row in rows]
+        for state in states:
+            self.put(state)
+        return len(states)
+
+    def update(self, device_id, **fields):
+        """Update cached fields of a known device; unknown devices are ignored"""
+        with self._lock:
+            state = self._devices.get(device_id)
+            if state is not None:
+                previous = count_key(state)
+                for name, value in fields.items():
+                    setattr(state, name, value)
+                if count_key(state) != previous:
+                    self._adjust(previous, -1)
+                    self._count(state, 1)
+            return state
+
+    def discard(self, device_id):
+        with self._lock:
+            state = self._devices.pop(device_id, None)
+            if state is not None:
+                self._count(state, -1)
+                if self._device_ids.get(state.pk) == device_id:
+                    del self._device_ids[state.pk]
+
+    def summary(self):
+        """Fleet totals per status and per device_type, from the counters"""
+        self.ensure_warm()
+        with self._lock:
+            counts = list(self._counts.items())
+        statuses = [status for status, _ in Device.STATUS_CHOICES]
+        by_status = dict.fromkeys(statuses, 0)
+        by_type = {}
+        for (status, device_type), count in counts:
+            by_status[status] = by_status.get(status, 0) + count
+            type_counts = by_type.setdefault(device_type, dict.fromkeys(statuses, 0))
+            type_counts[status] = type_counts.get(status, 0) + count
+        return {'total': sum(by_status.values()), 'by_status': by_status, 'by_type': by_type}
+
+    def reconcile(self):
+        """Compare the counters with the Device table; returns the drift.
+
+        The database trails the registry by up to ``HEARTBEAT_FLUSH_INTERVAL``,
+        so a single mismatch is expected. The registry is reloaded only when
+        the same drift shows up in two consecutive checks.
+        """
+        rows = Device.objects.order_by().values_list('status', 'device_type').annotate(count=Count('id'))
+        actual = Counter()
+        for status, device_type, count in rows:
+            actual[(status or 'offline', device_type)] += count
+        self.ensure_warm()
+        with self._lock:
+            counts = Counter(self._counts)
+        drift = {
+            f"{status}/{device_type}": actual[(status, device_type)] - counts[(status, device_type)]
+            for status, device_type in set(actual) | set(counts)
+            if actual[(status, device_type)] != counts[(status, device_type)]
+        }
+        persistent = bool(drift) and drift == self._last_drift
+        with self._lock:
+            self._reconciled += 1
+            self._last_drift = drift
+            if persistent:
+                self._corrections += 1
+        if persistent:
+            print(f"⚠️ Fleet counters drifted from the database, reloading the registry: {drift}")
+            self.warm()
+            self._last_drift = {}
+        return drift
+
+    def start_reconciler(self, interval=60):
+        """Reconcile the counters every ``interval`` seconds (idempotent)"""
+        if self._reconciler is not None and self._reconciler.is_alive():
+            return
+        self._reconciler = threading.Thread(
+            target=self._run_reconciler, args=(interval,), name='fleet-reconcile', daemon=True
+        )
+        self._reconciler.start()
+
+    def _run_reconciler(self, interval):
+        while True:
+            time.sleep(interval)
+            try:
+                close_old_connections()
+                self.reconcile()
+            except Exception as e:
+                print(f"❌ Fleet counter reconciliation failed: {e}")
+
+    def stats(self):
+        with self._lock:
+            lookups = self._hits + self._misses
+            return {
+                'devices': len(self._devices),
+                'warm': self._warm,
+                'hits': self._hits,
+                'misses': self._misses,
+                'hit_ratio': round(self._hits / lookups, 4) if lookups else None,
+                'reconciled': self._reconciled,
+                'corrections': self._corrections,
+                'drift': self._last_drift,
+                'memory_bytes': sys.getsizeof(self._devices) + sum(
+                    sys.getsizeof(device_id) + state.footprint()
+                    for device_id, state in self._devices.items()
+                ),
+            }
+
+
+device_registry = DeviceRegistry()
@@ -0,0 +1,263 @@
+"""Day-bucketed DeviceLog retention with hourly/daily rollups.
+
+Raw logs are treated as one bucket per UTC day. :func:`prune_device_logs`
+first writes per-device hourly and daily :class:`DeviceLogRollup` rows for
+every complete day with raw logs. A :class:`RollupMark` records each day's
+log count and highest log id at rollup time, so a day is rebuilt only when
+its logs changed since (history brought in by ``import_logs``, say). It
+then drops the buckets older than ``LOG_RETENTION_DAYS``.
+
+On PostgreSQL the log table can be converted to native range partitions,
+one per day (``manage.py partition_device_logs``). Dropping an expired
+bucket is then a ``DROP TABLE`` of its partition, O(1) however many rows
+it held. SQLite has no partitioning, and moving logs into attached
+databases would hide them from the ORM views, admin and exports. There,
+each expired day is deleted in bounded chunks through ``devicelog_ts_idx``
+so no single statement holds the write lock for long.
+"""
+from collections import defaultdict
+from datetime import datetime, time, timedelta, timezone as dt_timezone
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import Count, Max, Min, Q
+from django.db.models.functions import TruncHour
+from django.utils import timezone
+
+from .models import DeviceLog, DeviceLogRollup, RollupMark
+from .payloads import payload_hash
+
+DELETE_CHUNK = 10000
+ROLLUP_BATCH = 1000
+
+
+def day_start(value):
+    """Midnight UTC of the day containing ``value``"""
+    return datetime.combine(value.astimezone(dt_timezone.utc).date(), time.min, tzinfo=dt_timezone.utc)
+
+
+def days_between(start, end):
+    day = day_start(start)
+    while day < end:
+        yield day
+        day += timedelta(days=1)
+
+
+def day_mark(day):
+    """``(log count, highest log id)`` of one UTC day, through devicelog_ts_idx"""
+    mark = DeviceLog.objects.filter(timestamp__gte=day, timestamp__lt=day + timedelta(days=1)).aggregate(
+        count=Count('id'), max_id=Max('id')
+    )
+    return mark['count'], mark['max_id']
+
+
+def rollup_day(day, mark=None):
+    """(Re)build the hourly and daily rollups of one UTC day"""
+    end = day + timedelta(days=1)
+    # Taken first: rows added while the rollup runs make the next run redo the day
+    log_count, max_log_id = mark or day_mark(day)
+    hourly = (
+        DeviceLog.objects.filter(timestamp__gte=day, timestamp__lt=end)
+        .order_by()
+        .annotate(bucket=TruncHour('timestamp', tzinfo=dt_timezone.utc))
+        .values('device_id', 'bucket')
+        .annotate(
+            count=Count('id'),
+            first=Min('timestamp'),
+            last=Max('timestamp'),
+            # Packed payloads (data NULL) are recognised by their hash
+            idle=Count('id', filter=Q(data='idle') | Q(data_hash=payload_hash('idle'))),
+        )
+    )
+
+    rollups = []
+    daily = defaultdict(lambda: {'count': 0, 'idle': 0, 'first': None, 'last': None})
+    for row in hourly.iterator():
+        rollups.append(DeviceLogRollup(
+            device_id=row['device_id'], period='hour', bucket_start=row['bucket'],
+            message_count=row['count'], first_seen=row['first'], last_seen=row['last'],
+            status_counts={'online': row['count'] - row['idle'], 'idle': row['idle']},
+        ))
+        totals = daily[row['device_id']]
+        totals['count'] += row['count']
+        totals['idle'] += row['idle']
+        totals['first'] = min(filter(None, (totals['first'], row['first'])))
+        totals['last'] = max(filter(None, (totals['last'], row['last'])))
+    for device_id, totals in daily.items():
+        rollups.append(DeviceLogRollup(
+            device_id=device_id, period='day', bucket_start=day,
+            message_count=totals['count'], first_seen=totals['first'], last_seen=totals['last'],
+            status_counts={'online': totals['count'] - totals['idle'], 'idle': totals['idle']},
+        ))
+
+    with transaction.atomic():
+        DeviceLogRollup.objects.filter(bucket_start__gte=day, bucket_start__lt=end).delete()
+        DeviceLogRollup.objects.bulk_create(rollups, batch_size=ROLLUP_BATCH)
+        RollupMark.objects.update_or_create(
+            day=day, defaults={'log_count': log_count, 'max_log_id': max_log_id}
+        )
+    return len(daily)
+
+
+# ========== PostgreSQL partitions ==========
+
+def log_table():
+    return DeviceLog._meta.db_table
+
+
+def partition_name(day):
+    return f"{log_table()}_p{day:%Y%m%d}"
+
+
+def is_partitioned():
+    if connection.vendor != 'postgresql':
+        return False
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT 1 FROM pg_partitioned_table pt JOIN pg_class c ON c.oid = pt.partrelid "
+            "WHERE c.relname = %s",
+            [log_table()]
+        )
+        return cursor.fetchone() is not None
+
+
+def existing_partitions():
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT child.relname FROM pg_inherits i "
+            "JOIN pg_class child ON child.oid = i.inhrelid "
+            "JOIN pg_class parent ON parent.oid = i.inhparent "
+            "WHERE parent.relname = %s",
+            [log_table()]
+        )
+        return {row[0] for row in cursor.fetchall()}
+
+
+def ensure_partitions(start, end):
+    """Create the missing daily partitions for ``[start, end)``"""
+    existing = existing_partitions()
+    created = []
+    with connection.cursor() as cursor:
+        for day in days_between(start, end):
+            name = partition_name(day)
+            if name in existing:
+                continue
+            cursor.execute(
+                f"CREATE TABLE {connection.ops.quote_name(name)} "
+                f"PARTITION OF {connection.ops.quote_name(log_table())} "
+                f"FOR VALUES FROM (%s) TO (%s)",
+                [day, day + timedelta(days=1)]
+            )
+            created.append(name)
+    return created
+
+
+def convert_to_partitioned(days_ahead=7):
+    """Rebuild the PostgreSQL log table as one range partition per day.
+
+    A one-off maintenance operation: it copies every row, so run it in a
+    maintenance window. New rows outside the prepared range land in a
+    default partition.
+    """
+    if connection.vendor != 'postgresql':
+        raise RuntimeError('Native partitioning requires PostgreSQL')
+    if is_partitioned():
+        return False
+
+    table = log_table()
+    legacy = f"{table}_unpartitioned"
+    quote = connection.ops.quote_name
+    oldest = DeviceLog.objects.aggregate(oldest=Min('timestamp'))['oldest'] or timezone.now()
+
+    with transaction.atomic(), connection.schema_editor(atomic=False) as editor:
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT pg_get_serial_sequence(%s, 'id')", [table])
+            sequence = cursor.fetchone()[0]
+            cursor.execute(f"ALTER TABLE {quote(table)} RENAME TO {quote(legacy)}")
+            for index in DeviceLog._meta.indexes:
+                cursor.execute(
+                    f"ALTER INDEX IF EXISTS {quote(index.name)} RENAME TO {quote(index.name + '_old')}"
+                )
+            cursor.execute(
+                f"CREATE TABLE {quote(table)} (LIKE {quote(legacy)} INCLUDING DEFAULTS) "
+                f'PARTITION BY RANGE ("timestamp")'
+            )
+            # The partition key must be part of the primary key
+            cursor.execute(f'ALTER TABLE {quote(table)} ADD PRIMARY KEY ("id", "timestamp")')
+            cursor.execute(
+                f'ALTER TABLE {quote(table)} ADD CONSTRAINT {quote(table + "_device_id_fk")} '
+                f'FOREIGN KEY ("device_id") REFERENCES {quote(DeviceLog._meta.get_field("device").related_model._meta.db_table)} ("id") '
+                f'DEFERRABLE INITIALLY DEFERRED'
+            )
+            if sequence:
+                cursor.execute(f'ALTER SEQUENCE {sequence} OWNED BY {quote(table)}."id"')
+            cursor.execute(
+                f"CREATE TABLE {quote(table + '_default')} PARTITION OF {quote(table)} DEFAULT"
+            )
+        ensure_partitions(oldest, day_start(timezone.now()) + timedelta(days=days_ahead + 1))
+        for index in DeviceLog._meta.indexes:
+            editor.add_index(DeviceLog, index)
+        with connection.cursor() as cursor:
+            cursor.execute(f"INSERT INTO {quote(table)} SELECT * FROM {quote(legacy)}")
+            cursor.execute(f"DROP TABLE {quote(legacy)}")
+    return True
+
+
+# ========== Retention ==========
+
+def drop_day(day, chunk_size=DELETE_CHUNK):
+    """Remove one day of raw logs; returns the number of rows deleted, or
+    None when a whole partition was dropped"""
+    end = day + timedelta(days=1)
+    dropped_partition = False
+    if is_partitioned() and partition_name(day) in existing_partitions():
+        with connection.cursor() as cursor:
+            cursor.execute(f"DROP TABLE {connection.ops.quote_name(partition_name(day))}")
+        dropped_partition = True
+
+    # Rows outside a dedicated partition (SQLite, or a default partition)
+    deleted = 0
+    expired = DeviceLog.objects.filter(timestamp__gte=day, timestamp__lt=end).order_by()
+    while True:
+        ids = list(expired.values_list('id', flat=True)[:chunk_size])
+        if not ids:
+            break
+        deleted += DeviceLog.objects.filter(id__in=ids).delete()[0]
+    return None if dropped_partition and not deleted else deleted
+
+
+def prune_device_logs(retention_days=None, now=None, days_ahead=7):
+    """Roll up complete days, then drop raw log buckets past retention"""
+    now = now or timezone.now()
+    if retention_days is None:
+        retention_days = getattr(settings, 'LOG_RETENTION_DAYS', 30)
+    today = day_start(now)
+    cutoff = today - timedelta(days=retention_days)
+
+    oldest = DeviceLog.objects.aggregate(oldest=Min('timestamp'))['oldest']
+    rolled_up = []
+    if oldest is not None:
+        marks = {
+            mark.day: (mark.log_count, mark.max_log_id)
+            for mark in RollupMark.objects.filter(day__gte=day_start(oldest))
+        }
+        for day in days_between(oldest, today):
+            mark = day_mark(day)
+            if mark[0] and mark != marks.get(day):
+                rollup_day(day, mark)
+                rolled_up.append(day)
+
+    dropped = {}
+    if oldest is not None:
+        for day in days_between(oldest, cutoff):
+            dropped[day.date().isoformat()] = drop_day(day)
+
+    created_partitions = []
+    if is_partitioned():
+        created_partitions = ensure_partitions(today, today + timedelta(days=days_ahead + 1))
+
+    return {
+        'rolled_up_days': [day.date().isoformat() for day in rolled_up],
+        'dropped_days': dropped,
+        'created_partitions': created_partitions,
+    }
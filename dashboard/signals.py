@@ -0,0 +1,37 @@
+import time
+
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from .bridge import event_bridge
+from .events import event_hub
+from .manifest import firmware_manifest
+from .models import Device, Firmware, FirmwarePatch
+from .registry import DeviceState, device_registry
+
+
+@receiver(post_save, sender=Device)
+def cache_device(sender, instance, **kwargs):
+    """Keep the device registry in sync with saves (including admin edits)"""
+    device_registry.put(DeviceState.from_device(instance))
+    event_hub.publish_status(instance.status, [instance.device_id], instance.last_seen)
+
+
+@receiver(post_delete, sender=Device)
+def evict_device(sender, instance, **kwargs):
+    device_registry.discard(instance.device_id)
+
+
+def firmware_changed():
+    """Reload the firmware manifest here and in the other web processes"""
+    firmware_manifest.invalidate()
+    event_bridge.broadcast('firmware', {'changed_at': time.time()})
+
+
+@receiver(post_save, sender=Firmware)
+@receiver(post_delete, sender=Firmware)
+@receiver(post_save, sender=FirmwarePatch)
+@receiver(post_delete, sender=FirmwarePatch)
+def invalidate_firmware_manifest(sender, instance, **kwargs):
+    transaction.on_commit(firmware_changed)
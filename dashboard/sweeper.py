@@ -0,0 +1,106 @@
+"""Set-based online -> idle -> offline status sweep.
+
+Shared by the background thread in ``views.py``, the Celery task in
+``tasks.py`` and the ``update_device_status`` management command. A sweep
+is two ``UPDATE`` statements filtered on ``(status, last_seen)``. Each one
+returns the device_ids it changed so callers can broadcast the transitions.
+
+Inactivity thresholds default to ``DEVICE_IDLE_AFTER``/``DEVICE_OFFLINE_AFTER``
+and can be overridden per ``device_type`` with ``DEVICE_TYPE_THRESHOLDS``.
+"""
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from .events import event_hub
+from .models import Device
+from .registry import device_registry
+from .versions import next_fleet_version
+
+# Status a device moves to once it has been silent for too long
+NEXT_STATUS = {'online': 'idle', 'idle': 'offline'}
+
+
+def thresholds_for(device_type):
+    """Return the (idle_after, offline_after) timedeltas for a device type"""
+    overrides = getattr(settings, 'DEVICE_TYPE_THRESHOLDS', {}).get(device_type, {})
+    return (
+        timedelta(seconds=overrides.get('idle_after', getattr(settings, 'DEVICE_IDLE_AFTER', 120))),
+        timedelta(seconds=overrides.get('offline_after', getattr(settings, 'DEVICE_OFFLINE_AFTER', 300))),
+    )
+
+
+def silence_limit(from_status, device_type):
+    """How long a device may stay silent in ``from_status`` before it moves on"""
+    idle_after, offline_after = thresholds_for(device_type)
+    return idle_after if from_status == 'online' else offline_after
+
+
+def stale_filter(from_status, now):
+    """Q matching devices in ``from_status`` that exceeded their type's threshold"""
+    overridden = list(getattr(settings, 'DEVICE_TYPE_THRESHOLDS', {}))
+    condition = Q(last_seen__lt=now - silence_limit(from_status, None))
+    if overridden:
+        condition &= ~Q(device_type__in=overridden)
+    for device_type in overridden:
+        condition |= Q(
+            device_type=device_type,
+            last_seen__lt=now - silence_limit(from_status, device_type)
+        )
+    return Q(status=from_status) & condition
+
+
+def _supports_update_returning():
+    if connection.vendor == 'postgresql':
+        return True
+    if connection.vendor == 'sqlite':
+        import sqlite3
+        return sqlite3.sqlite_version_info >= (3, 35)
+    return False
+
+
+def update_status_returning(queryset, status):
+    """``queryset.update(status=status)`` that returns the changed device_ids.
+
+    Changed rows get a new fleet version. The version bump is rolled back
+    when nothing matched, so an idle sweep doesn't invalidate status ETags.
+    """
+    with transaction.atomic():
+        version = next_fleet_version()
+        if _supports_update_returning():
+            query = queryset.query
+            where, params = query.get_compiler(connection=connection).compile(query.where)
+            table = connection.ops.quote_name(Device._meta.db_table)
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    f'UPDATE {table} SET "status" = %s, "version" = %s WHERE {where} RETURNING "device_id"',
+                    [status, version, *params]
+                )
+                device_ids = [row[0] for row in cursor.fetchall()]
+        else:
+            device_ids = list(queryset.values_list('device_id', flat=True))
+            queryset.update(status=status, version=version)
+        if not device_ids:
+            transaction.set_rollback(True)
+    return device_ids
+
+
+def sweep_device_status(now=None):
+    """Run one sweep and return the device_ids that changed, per new status"""
+    now = now or timezone.now()
+
+    changed = {}
+    with transaction.atomic():
+        for from_status, to_status in NEXT_STATUS.items():
+            changed[to_status] = update_status_returning(
+                Device.objects.filter(stale_filter(from_status, now)), to_status
+            )
+
+    for status, device_ids in changed.items():
+        for device_id in device_ids:
+            device_registry.update(device_id, status=status)
+        event_hub.publish_status(status, device_ids)
+    return changed
@@ -1,7 +1,14 @@
 from celery import shared_task
-from django.core.management import call_command
+from .database import db_writer
+from .retention import prune_device_logs as prune_logs
+from .sweeper import sweep_device_status
 
 @shared_task
 def update_device_status():
-    """Update device status to offline if no message received in last 2 minutes"""
-    call_command('update_device_status')
+    """Move devices online -> idle -> offline when they have stopped reporting"""
+    return db_writer.run(sweep_device_status)
+
+@shared_task
+def prune_device_logs():
+    """Roll up complete days of device logs and drop the ones past retention"""
+    return prune_logs()
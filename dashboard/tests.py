@@ -0,0 +1,1432 @@
+"""Tests for the dashboard's hot paths.
+
+``HotQueryPlanTests`` runs each hot code path against seeded data, captures
+the SQL it issues and checks SQLite's ``EXPLAIN QUERY PLAN`` for it. A
+change that makes one of these queries fall back to a full table scan or a
+temporary sort fails there. The other classes cover the behaviour of the
+ingestion, firmware and command machinery.
+"""
+import contextlib
+import csv
+import gzip
+import hashlib
+import io
+import json
+import os
+import re
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+import unittest
+import zipfile
+import zlib
+from datetime import timedelta
+from types import SimpleNamespace
+from unittest import mock
+
+from django.contrib.auth.models import User
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db import connection, connections, transaction
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from .consumer import MODE_HASH, MODE_SHARED, ConsumerWorker, shard_for
+from .database import DatabaseWriter
+from .decoding import RESPONSE_TOPIC, PoolDecoder, decode
+from .events import EventHub
+from .firmware import blob_name, parse_range
+from .heartbeat import HeartbeatWriter
+from .fleet import STATUS_COMPLETE, STATUS_DISPATCHING, CommandRun
+from .importer import LogImporter
+from .ingestion import BACKPRESSURE_BLOCK, IngestionQueue, persist_batch
+from .logs import encode_cursor, log_page
+from .manifest import firmware_manifest
+from .models import (
+    Device, DeviceLog, DeviceLogRollup, DeviceQuery, Firmware, ImportCheckpoint, RecentMessage, RollupMark,
+)
+from .packaging import BLOCK_SIZE, FirmwarePackager, ZipStream, deflate_block
+from .payloads import ENCODING_JSON, ENCODING_MSGPACK, PayloadCodec, msgpack, payload_hash
+from .pending import STATUS_ANSWERED, STATUS_PENDING, STATUS_TIMED_OUT, PendingRequests
+from .presence import PresenceTracker
+from .recent import BACKEND_DATABASE, RecentMessages
+from .registry import DeviceRegistry, DeviceState, device_registry
+from .retention import day_start, drop_day, prune_device_logs
+from .storage import DefaultStorage, SQLiteStorage, storage_from_settings, timestamp_adapter
+from .sweeper import _supports_update_returning, sweep_device_status
+from .versions import next_fleet_version
+from .wal import CHECKPOINT_FILE, FRAME, QUARANTINE_FILE, WriteAheadLog, read_frames
+
+
+def explain(sql):
+    with connection.cursor() as cursor:
+        cursor.execute(f'EXPLAIN QUERY PLAN {sql}')
+        return '\n'.join(row[-1] for row in cursor.fetchall())
+
+
+def table_scan(table):
+    # "SCAN dashboard_x" (or "SCAN TABLE dashboard_x" on older SQLite)
+    # without "USING ... INDEX" is a full table scan
+    return re.compile(rf'\bSCAN (TABLE )?{table}\b(?! USING)')
+
+
+@unittest.skipUnless(connection.vendor == 'sqlite', 'Plans are asserted for SQLite')
+class HotQueryPlanTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        now = timezone.now()
+        Device.objects.bulk_create([
+            Device(
+                device_id=f'DEV{i}', device_type='ESP' if i % 2 else 'BMF', name=f'Device {i}',
+                status=('online', 'idle', 'offline')[i % 3], last_seen=now - timedelta(seconds=i * 30),
+            )
+            for i in range(60)
+        ])
+        cls.devices = list(Device.objects.order_by('device_id'))
+        DeviceLog.objects.bulk_create([
+            DeviceLog(device=device, data=f'reading {n}', timestamp=now - timedelta(seconds=n))
+            for device in cls.devices
+            for n in range(40)
+        ])
+        for n in range(5):
+            Firmware.objects.create(version=f'1.0.{n}', firmware_file=f'firmware/versions/{n}.bin')
+
+    def setUp(self):
+        device_registry.warm()
+
+    def captured(self, func, *args, **kwargs):
+        """Run ``func`` and return the SELECT/UPDATE statements it issued"""
+        with CaptureQueriesContext(connection) as queries:
+            func(*args, **kwargs)
+        statements = [
+            query['sql'] for query in queries
+            if query['sql'].startswith(('SELECT', 'UPDATE'))
+        ]
+        self.assertTrue(statements, f'{func.__name__} issued no queries')
+        return statements
+
+    def assertIndexed(self, sql, table, index_name):
+        plan = explain(sql)
+        self.assertIn(f'INDEX {index_name}', plan, f'{sql}\n{plan}')
+        self.assertNotRegex(plan, table_scan(table), f'{sql}\n{plan}')
+        self.assertNotIn('USE TEMP B-TREE FOR ORDER BY', plan, f'{sql}\n{plan}')
+
+    def test_log_listing(self):
+        device = self.devices[0]
+        for sql in self.captured(log_page, device.pk, limit=10):
+            self.assertIndexed(sql, 'dashboard_devicelog', 'devicelog_device_ts_idx')
+
+    def test_log_keyset_pages(self):
+        device = self.devices[1]
+        first = log_page(device.pk, limit=10)
+        statements = (
+            self.captured(log_page, device.pk, limit=10, before=first['oldest_cursor'])
+            + self.captured(log_page, device.pk, limit=10, after=first['oldest_cursor'])
+            + self.captured(
+                log_page, device.pk, since=timezone.now() - timedelta(seconds=20),
+                until=timezone.now()
+            )
+        )
+        for sql in statements:
+            self.assertIndexed(sql, 'dashboard_devicelog', 'devicelog_device_ts_idx')
+
+    def test_ingestion_duplicate_lookup(self):
+        now = timezone.now()
+        records = [
+            {'device_id': device.device_id, 'device_type': device.device_type,
+             'status': 'online', 'data': f'new reading {now}', 'timestamp': now}
+            for device in self.devices[:20]
+        ]
+        for sql in self.captured(persist_batch, records):
+            self.assertIndexed(sql, 'dashboard_devicelog', 'devicelog_device_hash_idx')
+
+    def test_status_sweep(self):
+        # The fleet version bump touches only its own single-row table
+        statements = [
+            sql for sql in self.captured(sweep_device_status) if '"dashboard_device"' in sql
+        ]
+        self.assertEqual(len(statements), 2)
+        for sql in statements:
+            self.assertIndexed(sql, 'dashboard_device', 'device_status_seen_idx')
+
+    def test_firmware_lookup(self):
+        queryset = Firmware.objects.filter(is_active=True).order_by('-created_at')[:1]
+        self.assertIndexed(str(queryset.query), 'dashboard_firmware', 'firmware_active_created_idx')
+
+    def test_firmware_manifest_does_not_query(self):
+        firmware_manifest.load()
+        with CaptureQueriesContext(connection) as queries:
+            entry = firmware_manifest.resolve('ESP', 'DEV1')
+        self.assertEqual(entry.version, '1.0.4')
+        self.assertEqual(len(queries), 0)
+
+    def test_retention_delete(self):
+        for sql in self.captured(drop_day, day_start(timezone.now()) - timedelta(days=1)):
+            self.assertIndexed(sql, 'dashboard_devicelog', 'devicelog_ts_idx')
+
+    def test_status_api(self):
+        self.client.force_login(User.objects.create_user('operator'))
+        url = reverse('get_device_statuses')
+        full = self.client.get(url)
+        self.assertEqual(full.status_code, 200)
+        body = full.json()
+        self.assertIsNone(body['since'])
+        self.assertEqual(len(body['devices']), len(self.devices))
+
+        # An unchanged fleet is answered from the fleet version alone
+        with CaptureQueriesContext(connection) as queries:
+            unchanged = self.client.get(url, HTTP_IF_NONE_MATCH=full['ETag'])
+        self.assertEqual(unchanged.status_code, 304)
+        self.assertFalse([query for query in queries if '"dashboard_device"' in query['sql']])
+
+        with transaction.atomic():
+            Device.objects.filter(device_id='DEV5').update(status='online', version=next_fleet_version())
+        delta = self.client.get(url, {'since': body['version']}, HTTP_IF_NONE_MATCH=full['ETag'])
+        self.assertEqual(delta.status_code, 200)
+        self.assertNotEqual(delta['ETag'], full['ETag'])
+        self.assertEqual(delta.json()['since'], body['version'])
+        self.assertEqual(
+            [(device['device_id'], device['status']) for device in delta.json()['devices']],
+            [('DEV5', 'online')]
+        )
+
+    def test_fleet_summary_follows_transitions(self):
+        sweep_device_status()
+        with CaptureQueriesContext(connection) as queries:
+            summary = device_registry.summary()
+        self.assertEqual(len(queries), 0)
+        self.assertEqual(summary['total'], len(self.devices))
+        self.assertEqual(device_registry.reconcile(), {})
+
+    def test_status_delta_lookup(self):
+        queryset = Device.objects.order_by().filter(version__gt=10).values_list(
+            'device_id', 'status', 'last_seen', 'name'
+        )
+        self.assertIndexed(str(queryset.query), 'dashboard_device', 'device_version_idx')
+
+
+class FirmwareDownloadTests(TestCase):
+
+    data = bytes(range(256)) * 4
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.media_root = tempfile.mkdtemp()
+        cls.media = override_settings(MEDIA_ROOT=cls.media_root, FIRMWARE_SENDFILE_HEADER=None)
+        cls.media.enable()
+        cls.digest = hashlib.sha256(cls.data).hexdigest()
+        default_storage.save(blob_name(cls.digest), ContentFile(cls.data))
+        cls.url = reverse('download_firmware', args=[cls.digest])
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.media.disable()
+        shutil.rmtree(cls.media_root, ignore_errors=True)
+        super().tearDownClass()
+
+    def download(self, **headers):
+        response = self.client.get(self.url, **headers)
+        body = b''.join(response.streaming_content) if response.streaming else response.content
+        response.close()
+        return response, body
+
+    def test_parse_range(self):
+        self.assertEqual(parse_range('bytes=2-5', 10), (2, 5))
+        self.assertEqual(parse_range('bytes=2-', 10), (2, 9))
+        self.assertEqual(parse_range('bytes=-3', 10), (7, 9))
+        self.assertEqual(parse_range('bytes=8-99', 10), (8, 9))
+        for header in (None, '', 'bytes=5-2', 'bytes=0-1,4-5', 'items=0-1'):
+            self.assertIsNone(parse_range(header, 10), header)
+        for header in ('bytes=10-', 'bytes=-0'):
+            with self.assertRaises(ValueError):
+                parse_range(header, 10)
+
+    def test_full_download(self):
+        response, body = self.download()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(body, self.data)
+        self.assertEqual(response['ETag'], f'"{self.digest}"')
+
+    def test_not_modified(self):
+        response, body = self.download(HTTP_IF_NONE_MATCH=f'"{self.digest}"')
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(body, b'')
+
+    def test_range(self):
+        response, body = self.download(HTTP_RANGE='bytes=10-19')
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(body, self.data[10:20])
+        self.assertEqual(response['Content-Range'], f'bytes 10-19/{len(self.data)}')
+
+    def test_unsatisfiable_range(self):
+        response, _ = self.download(HTTP_RANGE=f'bytes={len(self.data)}-')
+        self.assertEqual(response.status_code, 416)
+        self.assertEqual(response['Content-Range'], f'bytes */{len(self.data)}')
+
+    def test_invalid_range_is_ignored(self):
+        response, body = self.download(HTTP_RANGE='bytes=5-2')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(body, self.data)
+
+    def test_if_range(self):
+        response, body = self.download(HTTP_RANGE='bytes=0-3', HTTP_IF_RANGE=f'"{self.digest}"')
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(body, self.data[:4])
+        response, body = self.download(HTTP_RANGE='bytes=0-3', HTTP_IF_RANGE='"other"')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(body, self.data)
+
+
+class WriteAheadLogTests(SimpleTestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory, ignore_errors=True)
+        self.applied = []
+
+    def open_log(self, apply=None):
+        # Small segments, so a dozen records span several of them
+        wal = WriteAheadLog(self.directory, segment_bytes=300, batch_size=4,
+                            apply=apply or self.applied.extend)
+        self.assertTrue(wal.open())
+        self.addCleanup(wal.close)
+        return wal
+
+    def append(self, wal, *numbers):
+        for n in numbers:
+            wal.append({'device_id': f'DEV{n}', 'device_type': 'ESP', 'status': 'online',
+                        'data': f'reading {n}', 'timestamp': timezone.now()})
+
+    def applied_ids(self):
+        return [record['device_id'] for record in self.applied]
+
+    def segments(self):
+        return sorted(name for name in os.listdir(self.directory) if name.endswith('.wal'))
+
+    def test_replay_after_restart(self):
+        wal = self.open_log()
+        self.append(wal, *range(10))
+        wal.close()
+        self.assertEqual(self.applied, [])
+
+        wal = self.open_log()
+        self.assertEqual(wal.replay_pending(), 10)
+        self.assertEqual(self.applied_ids(), [f'DEV{n}' for n in range(10)])
+        wal.close()
+        # Nothing is applied twice
+        self.assertEqual(self.open_log().replay_pending(), 0)
+
+    def test_checkpoint_advances(self):
+        wal = self.open_log()
+        self.append(wal, *range(12))
+        self.assertGreater(len(self.segments()), 1)
+        wal.replay_pending()
+        self.assertEqual(wal.stats()['applied_seq'], 12)
+        with open(os.path.join(self.directory, CHECKPOINT_FILE)) as handle:
+            self.assertIn('"seq": 12', handle.read())
+        # Applied segments are deleted; the one being written stays
+        self.assertEqual(len(self.segments()), 1)
+
+        self.append(wal, 12, 13)
+        self.assertEqual(wal.replay_pending(), 2)
+        self.assertEqual(self.applied_ids()[-2:], ['DEV12', 'DEV13'])
+
+    def test_torn_tail_is_truncated(self):
+        wal = self.open_log()
+        self.append(wal, 0, 1, 2)
+        wal.close()
+        torn = FRAME.pack(100, 0, 4) + b'half a frame'
+        with open(os.path.join(self.directory, self.segments()[-1]), 'ab') as handle:
+            handle.write(torn)
+
+        wal = self.open_log()
+        self.assertEqual(wal.stats()['truncated_bytes'], len(torn))
+        self.append(wal, 3)
+        self.assertEqual(wal.replay_pending(), 4)
+        self.assertEqual(self.applied_ids(), ['DEV0', 'DEV1', 'DEV2', 'DEV3'])
+
+    def test_rejected_records_are_quarantined(self):
+        def apply(records):
+            if any(record['device_id'] == 'DEV5' for record in records):
+                raise ValueError('rejected')
+            self.applied.extend(records)
+
+        wal = self.open_log(apply)
+        self.append(wal, *range(8))
+        wal.replay_pending()
+        self.assertEqual(self.applied_ids(), [f'DEV{n}' for n in range(8) if n != 5])
+        self.assertEqual(wal.stats()['quarantined'], 1)
+        self.assertEqual(wal.stats()['applied_seq'], 8)
+        with open(os.path.join(self.directory, QUARANTINE_FILE), 'rb') as handle:
+            self.assertEqual([seq for seq, _, _ in read_frames(handle)], [6])
+
+
+class FirmwarePackagingTests(SimpleTestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.folder, ignore_errors=True)
+
+    def write(self, name, data):
+        path = os.path.join(self.folder, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as handle:
+            handle.write(data)
+
+    def test_zip_stream(self):
+        data = b'firmware image ' * 1000
+        out = io.BytesIO()
+        stream = ZipStream(out)
+        stream.start('image.bin', 0)
+        stream.write(deflate_block(data, b'', True, 6))
+        stream.finish(zlib.crc32(data), len(data))
+        digest, size = stream.close()
+
+        self.assertEqual(size, len(out.getvalue()))
+        self.assertEqual(digest, hashlib.sha256(out.getvalue()).hexdigest())
+        with zipfile.ZipFile(out) as archive:
+            self.assertIsNone(archive.testzip())
+            self.assertEqual(archive.read('image.bin'), data)
+
+    def test_build_round_trip(self):
+        # A file spanning several deflate blocks, a small one, an empty one
+        large = b''.join(hashlib.sha256(str(n).encode()).digest() * 8 for n in range(10000))
+        self.assertGreater(len(large), 2 * BLOCK_SIZE)
+        files = {'boot/large.bin': large, 'config.json': b'{"baud": 115200}', 'empty.txt': b''}
+        for name, data in files.items():
+            self.write(name, data)
+
+        out = io.BytesIO()
+        digest, size, total = FirmwarePackager(level=6, workers=2).build(self.folder, out)
+
+        self.assertEqual(total, sum(len(data) for data in files.values()))
+        self.assertEqual(size, len(out.getvalue()))
+        self.assertEqual(digest, hashlib.sha256(out.getvalue()).hexdigest())
+        with zipfile.ZipFile(out) as archive:
+            self.assertIsNone(archive.testzip())
+            self.assertEqual(sorted(archive.namelist()), sorted(files))
+            for name, data in files.items():
+                self.assertEqual(archive.read(name), data)
+
+    def test_missing_folder(self):
+        with self.assertRaises(FileNotFoundError):
+            FirmwarePackager().build(os.path.join(self.folder, 'missing'), io.BytesIO())
+
+
+class FleetCommandRunTests(SimpleTestCase):
+
+    def command_run(self, *device_ids):
+        targets = [SimpleNamespace(device_id=device_id, device_type='ESP') for device_id in device_ids]
+        return CommandRun('c0ffee', 'ping', {'level': 2}, 1, targets)
+
+    def send(self, run):
+        # What the dispatcher does for each batch
+        batch = run.next_batch(100)
+        run.sent.update((device_id, time.time()) for device_id in batch)
+        return batch
+
+    def test_message(self):
+        run = self.command_run('DEV1')
+        topic, message = run.message('DEV1', 'check/{device_type}/{device_id}')
+        self.assertEqual(topic, 'check/ESP/DEV1')
+        self.assertEqual(message, {'level': 2, 'device-id': 'DEV1', 'message': 'ping', 'command-id': 'c0ffee'})
+
+    def test_acks_complete_the_command(self):
+        run = self.command_run('DEV1', 'DEV2')
+        self.assertFalse(run.ack('DEV1', 'pong', timezone.now().isoformat()))
+        self.assertEqual(self.send(run), ['DEV1', 'DEV2'])
+        self.assertTrue(run.dispatched)
+
+        self.assertTrue(run.ack('DEV1', 'pong', timezone.now().isoformat()))
+        # Duplicates and devices outside the command are ignored
+        self.assertFalse(run.ack('DEV1', 'pong', timezone.now().isoformat()))
+        self.assertFalse(run.ack('DEV3', 'pong', timezone.now().isoformat()))
+        progress = run.progress()
+        self.assertEqual((progress['acked'], progress['pending']), (1, 1))
+        self.assertEqual(run.status, STATUS_DISPATCHING)
+
+        self.assertTrue(run.ack('DEV2', 'pong', timezone.now().isoformat()))
+        progress = run.progress()
+        self.assertEqual(run.status, STATUS_COMPLETE)
+        self.assertIsNotNone(run.finished_at)
+        self.assertEqual((progress['acked'], progress['pending'], progress['progress']), (2, 0, 1.0))
+        self.assertIsNotNone(progress['rtt_ms_p95'])
+        self.assertEqual(run.details()['pending_devices'], [])
+
+    def test_empty_command_is_complete(self):
+        run = self.command_run()
+        self.assertEqual(run.status, STATUS_COMPLETE)
+        self.assertEqual(run.progress()['progress'], 1.0)
+
+
+class PendingRequestTests(TransactionTestCase):
+
+    def test_resolve(self):
+        pending = PendingRequests(save_interval=None)
+        query = pending.create('DEV1')
+        self.assertEqual(DeviceQuery.objects.get().status, STATUS_PENDING)
+        threading.Timer(
+            0.05, pending.resolve, (query.correlation_id, 'DEV1', 'pong', timezone.now().isoformat())
+        ).start()
+
+        query = pending.wait(query.correlation_id, 5)
+        self.assertEqual(query.status, STATUS_ANSWERED)
+        self.assertEqual(query.response, 'pong')
+        self.assertGreaterEqual(query.rtt_ms, 0)
+        # Replies from another device, or a second reply, don't match
+        self.assertFalse(pending.resolve(query.correlation_id, 'DEV2', 'pong'))
+        self.assertFalse(pending.resolve(query.correlation_id, 'DEV1', 'pong'))
+
+        # Other processes read the outcome from the row
+        self.assertEqual(pending.save(), 1)
+        outcome = PendingRequests(save_interval=None).outcome(query.correlation_id)
+        self.assertEqual((outcome['status'], outcome['response']), (STATUS_ANSWERED, 'pong'))
+
+    def test_timeout(self):
+        pending = PendingRequests(timeout=0.05, save_interval=None)
+        query = pending.create('DEV1')
+        started = time.monotonic()
+        self.assertEqual(pending.wait(query.correlation_id, 5).status, STATUS_TIMED_OUT)
+        self.assertLess(time.monotonic() - started, 1)
+        self.assertEqual(pending.stats()['timed_out'], 1)
+        pending.save()
+        self.assertEqual(DeviceQuery.objects.get().status, STATUS_TIMED_OUT)
+
+    def test_results_expire(self):
+        pending = PendingRequests(result_ttl=0.05, save_interval=None)
+        query = pending.create('DEV1')
+        pending.resolve(query.correlation_id, 'DEV1', 'pong')
+        self.assertIsNotNone(pending.get(query.correlation_id))
+        pending.save()
+        time.sleep(0.1)
+        self.assertIsNone(pending.get(query.correlation_id))
+        self.assertEqual(pending.prune(), 1)
+        self.assertIsNone(pending.outcome(query.correlation_id))
+
+
+class ConsumerShardTests(SimpleTestCase):
+
+    device_ids = [f'DEV{n}' for n in range(200)]
+
+    def worker(self, shard, shards, mode):
+        worker = ConsumerWorker(shard, shards, mode)
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory, ignore_errors=True)
+        worker.wal = WriteAheadLog(directory)
+        worker.wal.open()
+        self.addCleanup(worker.wal.close)
+        return worker
+
+    def deliver(self, worker):
+        """Feed every device's message to ``worker``; returns the device_ids it kept"""
+        for device_id in self.device_ids:
+            worker.handle_decoded((device_id, 'ESP', 'online', 'ping', False, None), timezone.now())
+        worker.wal.sync()
+        with open(worker.wal._path(worker.wal._segments[0]), 'rb') as handle:
+            return [json.loads(payload)['device_id'] for _, payload, _ in read_frames(handle)]
+
+    def test_shard_is_stable(self):
+        self.assertEqual(shard_for('DEV1', 4), shard_for('DEV1', 4))
+        self.assertEqual({shard_for(device_id, 4) for device_id in self.device_ids}, {0, 1, 2, 3})
+
+    def test_hash_mode_splits_devices(self):
+        kept = [self.deliver(self.worker(shard, 3, MODE_HASH)) for shard in range(3)]
+        # Every device is kept by exactly one worker, the one its hash names
+        self.assertEqual(sorted(sum(kept, [])), sorted(self.device_ids))
+        for shard, device_ids in enumerate(kept):
+            self.assertTrue(all(shard_for(device_id, 3) == shard for device_id in device_ids))
+        self.assertEqual(self.worker(0, 3, MODE_HASH).subscriptions()[0], ('devices/#', 1))
+
+    def test_shared_mode_keeps_everything(self):
+        worker = self.worker(1, 3, MODE_SHARED)
+        # The broker splits the stream, so the worker keeps what it gets
+        self.assertEqual(self.deliver(worker), self.device_ids)
+        self.assertEqual(
+            [topic for topic, _ in worker.subscriptions()],
+            ['$share/dashboard/devices/#', '$share/dashboard/check/response'],
+        )
+
+
+class IngestionQueueTests(SimpleTestCase):
+
+    def records(self, count):
+        return [{'device_id': f'DEV{n}', 'data': str(n)} for n in range(count)]
+
+    def test_drop_oldest(self):
+        queue = IngestionQueue(maxsize=3, batch_size=10)
+        accepted = [queue.put(record) for record in self.records(5)]
+        self.assertEqual(accepted, [True, True, True, False, False])
+        self.assertEqual([record['data'] for record in queue.get_batch(timeout=0)], ['2', '3', '4'])
+        stats = queue.stats()
+        self.assertEqual((stats['enqueued'], stats['dropped'], stats['blocked']), (5, 2, 0))
+
+    def test_block(self):
+        queue = IngestionQueue(maxsize=2, batch_size=1, backpressure=BACKPRESSURE_BLOCK, block_timeout=0.05)
+        first, second, third, fourth = self.records(4)
+        self.assertTrue(queue.put(first))
+        self.assertTrue(queue.put(second))
+        # Nobody drains the queue: the put gives up after block_timeout
+        started = time.monotonic()
+        self.assertFalse(queue.put(third))
+        self.assertGreaterEqual(time.monotonic() - started, 0.05)
+
+        # A flush during the wait makes room
+        queue.block_timeout = 5
+        drain = threading.Timer(0.05, queue.get_batch, kwargs={'timeout': 0})
+        drain.start()
+        self.assertTrue(queue.put(fourth))
+        drain.join()
+        self.assertEqual([record['data'] for record in queue.get_batch(timeout=0)], ['1'])
+        self.assertEqual([record['data'] for record in queue.get_batch(timeout=0)], ['3'])
+        stats = queue.stats()
+        self.assertEqual((stats['enqueued'], stats['dropped'], stats['blocked']), (3, 1, 2))
+
+
+class PersistBatchTests(TestCase):
+
+    def setUp(self):
+        self.now = timezone.now()
+        self.device = Device.objects.create(
+            device_id='DEV0', device_type='ESP', name='Device 0', status='offline',
+            last_seen=self.now - timedelta(hours=1),
+        )
+        DeviceLog.objects.create(device=self.device, data='known', timestamp=self.now - timedelta(hours=1))
+        device_registry.warm()
+
+    def record(self, device_id, data, seconds, device_type='ESP', status='online'):
+        return {'device_id': device_id, 'device_type': device_type, 'status': status,
+                'data': data, 'timestamp': self.now + timedelta(seconds=seconds)}
+
+    def logs(self, device_id):
+        return sorted(DeviceLog.objects.filter(device__device_id=device_id).values_list('data', flat=True))
+
+    def test_duplicates_and_new_devices(self):
+        persist_batch([
+            self.record('DEV0', 'known', 1),
+            self.record('DEV0', 'reading', 2),
+            self.record('DEV0', 'reading', 3),
+            self.record('NEW1', 'hello', 1, device_type='BMF', status='idle'),
+            self.record('NEW1', 'hello', 2, device_type='BMF'),
+            self.record('NEW2', 'hello', 1, device_type=None),
+        ])
+        # One row per new (device, data): neither the stored row nor the
+        # repeats within the batch are written again
+        self.assertEqual(self.logs('DEV0'), ['known', 'reading'])
+        self.assertEqual(self.logs('NEW1'), ['hello'])
+        self.assertEqual(self.logs('NEW2'), ['hello'])
+        self.assertEqual(DeviceLog.objects.count(), 4)
+
+        # New devices take the newest record's status and last_seen
+        created = Device.objects.get(device_id='NEW1')
+        self.assertEqual(
+            (created.device_type, created.name, created.status, created.last_seen),
+            ('BMF', 'BMF - NEW1', 'online', self.now + timedelta(seconds=2))
+        )
+        self.assertEqual(Device.objects.get(device_id='NEW2').device_type, 'unknown')
+        self.assertEqual(device_registry.get('NEW1').pk, created.pk)
+
+        # Replaying the batch writes nothing new
+        persist_batch([self.record('DEV0', 'reading', 4), self.record('NEW1', 'hello', 3)])
+        self.assertEqual(DeviceLog.objects.count(), 4)
+
+
+class DeviceRegistryTests(TestCase):
+
+    def setUp(self):
+        now = timezone.now()
+        Device.objects.bulk_create([
+            Device(device_id=f'DEV{i}', device_type='ESP' if i % 2 else 'BMF', name=f'Device {i}',
+                   status='online', last_seen=now)
+            for i in range(4)
+        ])
+        self.registry = DeviceRegistry()
+        self.registry.warm()
+
+    def state(self, cached_id, **fields):
+        state = self.registry.get(cached_id)
+        return DeviceState(**{
+            'pk': state.pk, 'device_id': state.device_id, 'name': state.name,
+            'device_type': state.device_type, 'status': state.status, 'last_seen': state.last_seen,
+            **fields,
+        })
+
+    def test_put_on_rename(self):
+        renamed = self.state('DEV1', device_id='RENAMED', status='idle')
+        self.registry.put(renamed)
+        self.assertIsNone(self.registry.get('DEV1'))
+        self.assertIs(self.registry.get('RENAMED'), renamed)
+        summary = self.registry.summary()
+        self.assertEqual(summary['total'], 4)
+        self.assertEqual(summary['by_status'], {'online': 3, 'idle': 1, 'offline': 0})
+
+        # Renaming back and forgetting the device leave no stale entry behind
+        self.registry.put(self.state('RENAMED', device_id='DEV1'))
+        self.registry.discard('DEV1')
+        self.assertEqual(self.registry.summary()['total'], 3)
+        self.assertEqual(sorted(state.device_id for state in self.registry.all()), ['DEV0', 'DEV2', 'DEV3'])
+
+    def test_counters(self):
+        self.registry.update('DEV0', status='offline')
+        self.registry.update('DEV1', status='idle')
+        self.registry.update('DEV2', last_seen=timezone.now())
+        self.registry.put(self.state('DEV3', device_type='BMF'))
+        summary = self.registry.summary()
+        self.assertEqual(summary['by_status'], {'online': 2, 'idle': 1, 'offline': 1})
+        self.assertEqual(summary['by_type'], {
+            'BMF': {'online': 2, 'idle': 0, 'offline': 1},
+            'ESP': {'online': 0, 'idle': 1, 'offline': 0},
+        })
+
+    def test_reconcile_drift(self):
+        self.assertEqual(self.registry.reconcile(), {})
+        # Changed behind the registry's back (no signals)
+        Device.objects.filter(device_id__in=['DEV0', 'DEV2']).update(status='offline')
+        drift = {'online/BMF': -2, 'offline/BMF': 2}
+        # The first mismatch may be heartbeats not yet flushed: keep the counters
+        self.assertEqual(self.registry.reconcile(), drift)
+        self.assertEqual(self.registry.summary()['by_status']['online'], 4)
+        # The same drift twice reloads the registry
+        self.assertEqual(self.registry.reconcile(), drift)
+        self.assertEqual(self.registry.summary()['by_status'], {'online': 2, 'idle': 0, 'offline': 2})
+        self.assertEqual(self.registry.get('DEV0').status, 'offline')
+        self.assertEqual(self.registry.reconcile(), {})
+        self.assertEqual(self.registry.stats()['corrections'], 1)
+
+
+class LogPaginationTests(TestCase):
+
+    def setUp(self):
+        self.device = Device.objects.create(device_id='DEV0', device_type='ESP', name='Device 0')
+        now = timezone.now().replace(microsecond=0)
+        # Five entries per timestamp: only the id tells them apart
+        DeviceLog.objects.bulk_create([
+            DeviceLog(device=self.device, data=f'reading {n}', timestamp=now - timedelta(seconds=n // 5))
+            for n in range(23)
+        ])
+        self.expected = list(
+            DeviceLog.objects.order_by('-timestamp', '-id').values_list('id', flat=True)
+        )
+
+    def test_walk_back_with_tied_timestamps(self):
+        seen, cursor = [], None
+        while True:
+            page = log_page(self.device.pk, limit=4, before=cursor)
+            seen += [row['id'] for row in page['logs']]
+            if not page['has_more']:
+                break
+            cursor = page['oldest_cursor']
+        self.assertEqual(seen, self.expected)
+
+    def test_walk_forward_with_tied_timestamps(self):
+        oldest = DeviceLog.objects.get(pk=self.expected[-1])
+        seen, cursor = [], encode_cursor(oldest.timestamp, oldest.pk)
+        while True:
+            page = log_page(self.device.pk, limit=4, after=cursor)
+            # Each page is newest first; pages move forward in time
+            seen = [row['id'] for row in page['logs']] + seen
+            if not page['logs']:
+                break
+            cursor = page['newest_cursor']
+        self.assertEqual(seen, self.expected[:-1])
+
+    def test_invalid_cursor(self):
+        self.client.force_login(User.objects.create_user('operator'))
+        for cursor in ('99999999999999999999_1', '-99999999999999999999_1', 'abc', '1_2_3'):
+            with self.subTest(cursor=cursor):
+                response = self.client.get(
+                    reverse('device_logs', args=['DEV0']), {'before': cursor},
+                    HTTP_X_REQUESTED_WITH='XMLHttpRequest',
+                )
+                self.assertEqual(response.status_code, 400)
+                self.assertIn('Invalid cursor', response.json()['error'])
+
+
+class HeartbeatWriterTests(TransactionTestCase):
+
+    def setUp(self):
+        self.now = timezone.now()
+        self.device = Device.objects.create(
+            device_id='DEV0', device_type='ESP', name='Device 0', status='offline',
+            last_seen=self.now - timedelta(minutes=10),
+        )
+        device_registry.warm()
+        self.writer = HeartbeatWriter()
+
+    def test_out_of_order_heartbeats(self):
+        newer, older = self.now, self.now - timedelta(seconds=30)
+        self.writer.record(self.device.pk, 'DEV0', newer, 'online')
+        self.writer.record(self.device.pk, 'DEV0', older, 'idle')
+        # The registry follows the newest heartbeat straight away
+        self.assertEqual((device_registry.get('DEV0').last_seen, device_registry.get('DEV0').status),
+                         (newer, 'online'))
+
+        # Both heartbeats coalesce into a single row update
+        self.assertEqual(self.writer.flush(), 1)
+        stats = self.writer.stats()
+        self.assertEqual((stats['recorded'], stats['last_flush_size'], stats['rows_written']), (2, 1, 1))
+        self.device.refresh_from_db()
+        self.assertEqual((self.device.last_seen, self.device.status), (newer, 'online'))
+
+        # A late heartbeat older than the stored one changes nothing
+        self.writer.record(self.device.pk, 'DEV0', older, 'idle')
+        self.assertEqual(self.writer.flush(), 0)
+        self.device.refresh_from_db()
+        self.assertEqual((self.device.last_seen, self.device.status), (newer, 'online'))
+        self.assertEqual(device_registry.get('DEV0').last_seen, newer)
+        self.assertEqual(self.writer.flush(), 0)
+
+
+@override_settings(
+    DEVICE_IDLE_AFTER=120, DEVICE_OFFLINE_AFTER=300,
+    DEVICE_TYPE_THRESHOLDS={'BMF': {'idle_after': 60, 'offline_after': 180}},
+)
+class StatusSweepTests(TestCase):
+
+    devices = [
+        # device_id, device_type, status, seconds since last_seen
+        ('ESP-ONLINE', 'ESP', 'online', 90),
+        ('BMF-ONLINE', 'BMF', 'online', 90),
+        ('ESP-SILENT', 'ESP', 'online', 130),
+        ('ESP-IDLE', 'ESP', 'idle', 200),
+        ('BMF-IDLE', 'BMF', 'idle', 200),
+        ('ESP-GONE', 'ESP', 'idle', 310),
+        ('BMF-OFFLINE', 'BMF', 'offline', 1000),
+    ]
+
+    def setUp(self):
+        self.now = timezone.now()
+        Device.objects.bulk_create([
+            Device(device_id=device_id, device_type=device_type, name=device_id, status=status,
+                   last_seen=self.now - timedelta(seconds=seconds), version=0)
+            for device_id, device_type, status, seconds in self.devices
+        ])
+        device_registry.warm()
+
+    def assertSweep(self):
+        changed = sweep_device_status(self.now)
+        self.assertEqual(
+            {status: sorted(device_ids) for status, device_ids in changed.items()},
+            {'idle': ['BMF-ONLINE', 'ESP-SILENT'], 'offline': ['BMF-IDLE', 'ESP-GONE']}
+        )
+        statuses = dict(Device.objects.values_list('device_id', 'status'))
+        self.assertEqual(statuses, {
+            'ESP-ONLINE': 'online', 'BMF-ONLINE': 'idle', 'ESP-SILENT': 'idle', 'ESP-IDLE': 'idle',
+            'BMF-IDLE': 'offline', 'ESP-GONE': 'offline', 'BMF-OFFLINE': 'offline',
+        })
+        self.assertEqual({state.device_id: state.status for state in device_registry.all()}, statuses)
+        # Only changed rows get the new fleet version
+        self.assertEqual(
+            sorted(Device.objects.filter(version__gt=0).values_list('device_id', flat=True)),
+            ['BMF-IDLE', 'BMF-ONLINE', 'ESP-GONE', 'ESP-SILENT']
+        )
+        # Nothing left to do
+        self.assertEqual(sweep_device_status(self.now), {'idle': [], 'offline': []})
+
+    @unittest.skipUnless(_supports_update_returning(), 'UPDATE ... RETURNING is not available')
+    def test_update_returning(self):
+        with CaptureQueriesContext(connection) as queries:
+            self.assertSweep()
+        self.assertTrue([query for query in queries if 'RETURNING' in query['sql']])
+
+    def test_select_then_update(self):
+        with mock.patch('dashboard.sweeper._supports_update_returning', return_value=False):
+            with CaptureQueriesContext(connection) as queries:
+                self.assertSweep()
+        self.assertFalse([query for query in queries if 'RETURNING' in query['sql']])
+
+
+class DatabaseWriterTests(SimpleTestCase):
+
+    def test_jobs_run_one_at_a_time(self):
+        writer = DatabaseWriter()
+        lock = threading.Lock()
+        running, overlaps, threads = [], [], set()
+
+        def job(n):
+            with lock:
+                running.append(n)
+                overlaps.append(len(running))
+                threads.add(threading.current_thread().name)
+            time.sleep(0.001)
+            with lock:
+                running.remove(n)
+            return n * 2
+
+        results = {}
+        callers = [
+            threading.Thread(target=lambda n=n: results.setdefault(n, writer.run(job, n)))
+            for n in range(20)
+        ]
+        for caller in callers:
+            caller.start()
+        for caller in callers:
+            caller.join()
+        self.assertEqual(results, {n: n * 2 for n in range(20)})
+        self.assertEqual(max(overlaps), 1)
+        self.assertEqual(threads, {'db-writer'})
+
+    def test_errors_reach_the_caller(self):
+        writer = DatabaseWriter()
+        with self.assertRaises(ZeroDivisionError):
+            writer.run(lambda: 1 / 0)
+        self.assertEqual(writer.stats()['failed'], 1)
+        # The writer keeps going, and nested jobs run in place
+        self.assertEqual(writer.run(lambda: writer.run(threading.current_thread)).name, 'db-writer')
+
+    def test_disabled_runs_in_place(self):
+        writer = DatabaseWriter(enabled=False)
+        self.assertIs(writer.run(threading.current_thread), threading.current_thread())
+
+
+@unittest.skipUnless(connection.vendor == 'sqlite', 'PRAGMAs are SQLite only')
+class SQLitePragmaTests(SimpleTestCase):
+
+    @override_settings(SQLITE_PRAGMAS={'busy_timeout': 1234, 'cache_size': -4321})
+    def test_new_connections_are_configured(self):
+        # A fresh connection goes through connection_created
+        fresh = connections.create_connection('default')
+        self.addCleanup(fresh.close)
+        with fresh.cursor() as cursor:
+            cursor.execute('PRAGMA busy_timeout')
+            self.assertEqual(cursor.fetchone()[0], 1234)
+            cursor.execute('PRAGMA cache_size')
+            self.assertEqual(cursor.fetchone()[0], -4321)
+
+
+@override_settings(DEVICE_IDLE_AFTER=120, DEVICE_OFFLINE_AFTER=300, DEVICE_TYPE_THRESHOLDS={})
+class PresenceTrackerTests(TransactionTestCase):
+
+    def setUp(self):
+        self.seen = timezone.now().replace(microsecond=0) - timedelta(minutes=1)
+        Device.objects.create(device_id='DEV0', device_type='ESP', name='Device 0',
+                              status='online', last_seen=self.seen)
+        device_registry.warm()
+        self.tracker = PresenceTracker()
+        self.tracker.touch('DEV0', 'ESP', self.seen)
+        self.deadline = self.seen.timestamp() + 120
+
+    def status(self):
+        return Device.objects.get(device_id='DEV0').status
+
+    def test_expires_at_exact_deadline(self):
+        self.assertEqual(self.tracker.expire(self.deadline - 0.001), {'idle': [], 'offline': []})
+        self.assertEqual(self.tracker.expire(self.deadline), {'idle': ['DEV0'], 'offline': []})
+        self.assertEqual(self.status(), 'idle')
+        self.assertEqual(device_registry.get('DEV0').status, 'idle')
+
+        self.assertEqual(self.tracker.expire(self.seen.timestamp() + 300), {'idle': [], 'offline': ['DEV0']})
+        self.assertEqual(self.status(), 'offline')
+        stats = self.tracker.stats()
+        self.assertEqual((stats['tracked_devices'], stats['heap_size']), (0, 0))
+
+    def test_lazy_deletion(self):
+        # Reports pushed the deadline out: the old heap entry stays until popped
+        for seconds in (10, 20, 30):
+            self.tracker.touch('DEV0', 'ESP', self.seen + timedelta(seconds=seconds))
+        self.assertEqual(self.tracker.stats()['heap_size'], 1)
+        self.assertEqual(self.tracker.expire(self.deadline), {'idle': [], 'offline': []})
+        # ...and is then rescheduled at the real deadline
+        self.assertEqual(self.tracker.stats()['heap_size'], 1)
+        self.assertEqual(self.tracker.expire(self.deadline + 30), {'idle': ['DEV0'], 'offline': []})
+
+        # Entries of forgotten devices are dropped without a write
+        self.tracker.forget('DEV0')
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(self.tracker.expire(self.deadline + 600), {'idle': [], 'offline': []})
+        self.assertEqual(len(queries), 0)
+        self.assertEqual(self.tracker.stats()['heap_size'], 0)
+
+    def test_only_updated_rows_advance(self):
+        # Another process saw the device after this one did
+        later = self.seen + timedelta(seconds=60)
+        Device.objects.filter(device_id='DEV0').update(last_seen=later)
+        self.assertEqual(self.tracker.expire(self.deadline), {'idle': [], 'offline': []})
+        self.assertEqual(self.status(), 'online')
+        # Still online in the tracker, due again from the stored last_seen
+        self.assertEqual(self.tracker.expire(self.deadline + 59), {'idle': [], 'offline': []})
+        self.assertEqual(self.tracker.expire(self.deadline + 60), {'idle': ['DEV0'], 'offline': []})
+        self.assertEqual(self.status(), 'idle')
+
+
+class EventHubTests(SimpleTestCase):
+
+    def setUp(self):
+        self.hub = EventHub(history=5, subscriber_queue=3)
+
+    def publish(self, count, device_id='DEV0'):
+        return [self.hub.publish('log', {'device_id': device_id, 'data': str(n)}) for n in range(count)]
+
+    def test_resume_from_history(self):
+        events = self.publish(4)
+        subscription, missed = self.hub.subscribe(last_event_id=events[1].id)
+        self.assertEqual([event.id for event in missed], [events[2].id, events[3].id])
+        # Up to date, and a device filter applies to the history as well
+        self.assertEqual(self.hub.subscribe(last_event_id=events[3].id)[1], [])
+        self.publish(1, device_id='DEV1')
+        _, missed = self.hub.subscribe(last_event_id=events[1].id, device_id='DEV1')
+        self.assertEqual([event.device_id for event in missed], ['DEV1'])
+        # New events are delivered live
+        self.publish(1)
+        self.assertEqual([event.data['data'] for event in subscription.get(timeout=0)], ['0', '0'])
+
+    def test_history_trimming(self):
+        events = self.publish(8)
+        self.assertEqual(self.hub.stats()['history'], 5)
+        # The oldest retained event is events[3]; resuming right before it still works
+        _, missed = self.hub.subscribe(last_event_id=events[2].id)
+        self.assertEqual([event.id for event in missed], [event.id for event in events[3:]])
+        # Older ids, and ids from before a restart, ask for a reload
+        self.assertIsNone(self.hub.subscribe(last_event_id=events[1].id)[1])
+        self.assertIsNone(self.hub.subscribe(last_event_id=events[-1].id + 1)[1])
+
+    def test_slow_subscriber_is_disconnected(self):
+        slow, _ = self.hub.subscribe()
+        fast, _ = self.hub.subscribe()
+        self.publish(3)
+        self.assertEqual(len(fast.get(timeout=0)), 3)
+        self.publish(1)
+        # The fourth queued event overflows the slow subscriber only
+        self.assertTrue(slow.overflowed)
+        self.assertEqual(slow.get(timeout=0), [])
+        self.assertFalse(fast.overflowed)
+        self.assertEqual(len(fast.get(timeout=0)), 1)
+        stats = self.hub.stats()
+        self.assertEqual((stats['subscribers'], stats['slow_consumers_disconnected']), (1, 1))
+        # Nothing more reaches it; it resumes from its last event id instead
+        self.publish(1)
+        self.assertEqual(slow.get(timeout=0), [])
+
+
+class DecodeTests(SimpleTestCase):
+
+    def decode(self, topic, payload):
+        with contextlib.redirect_stdout(io.StringIO()):
+            return decode(topic, payload if isinstance(payload, bytes) else json.dumps(payload).encode())
+
+    def test_decode(self):
+        cases = [
+            # topic, payload, expected
+            ('devices/ESP/ESP1', {'device-id': 'ESP1', 'message': ' Hello '},
+             ('ESP1', 'ESP', 'online', 'hello', True, None)),
+            ('devices/ESP', {'device-id': 'ESP1', 'message': 'IDLE'},
+             ('ESP1', 'ESP', 'idle', 'idle', False, None)),
+            ('devices', {'device-id': 'ESP1'}, ('ESP1', None, 'online', '', False, None)),
+            ('devices/ESP/ESP1', {'device-id': 12345, 'message': 7}, ('12345', 'ESP', 'online', '7', True, None)),
+            (RESPONSE_TOPIC, {'device-id': 'ESP1', 'message': 'ok', 'command-id': 42},
+             ('ESP1', None, 'online', 'ok', False, '42')),
+            ('devices/ESP', {'device-id': 'ESP1', 'command-id': 42}, ('ESP1', 'ESP', 'online', '', False, None)),
+            # Rejected
+            ('devices/ESP', b'', None),
+            ('devices/ESP', b'{not json', None),
+            ('devices/ESP', b'\xff\xfe', None),
+            ('devices/ESP', ['ESP1'], None),
+            ('devices/ESP', 'ESP1', None),
+            ('devices/ESP', None, None),
+            ('devices/ESP', {'message': 'hello'}, None),
+            ('devices/ESP', {'device-id': ''}, None),
+            ('devices/ESP', {'device-id': 'ESP-1'}, None),
+            ('devices/ESP', {'device-id': 'ESP 1'}, None),
+            # Length limits of device_id (50), device_type (50) and name (100)
+            ('devices/ESP', {'device-id': 'D' * 50}, ('D' * 50, 'ESP', 'online', '', False, None)),
+            ('devices/ESP', {'device-id': 'D' * 51}, None),
+            (f"devices/{'T' * 50}", {'device-id': 'ESP1'}, ('ESP1', 'T' * 50, 'online', '', False, None)),
+            (f"devices/{'T' * 51}", {'device-id': 'ESP1'}, None),
+            (f"devices/{'T' * 48}", {'device-id': 'D' * 49}, ('D' * 49, 'T' * 48, 'online', '', False, None)),
+            (f"devices/{'T' * 48}", {'device-id': 'D' * 50}, None),
+        ]
+        for topic, payload, expected in cases:
+            with self.subTest(topic=topic[:20], payload=payload):
+                self.assertEqual(self.decode(topic, payload), expected)
+
+
+class PoolDecoderTests(SimpleTestCase):
+
+    def messages(self, count):
+        messages = []
+        for n in range(count):
+            # Every fifth message is rejected
+            payload = b'{' if n % 5 == 4 else json.dumps({'device-id': f'DEV{n % 7}', 'message': str(n)}).encode()
+            messages.append(('devices/ESP/x', payload, timezone.now()))
+        return messages
+
+    def run_decoder(self, messages, break_pool=False):
+        emitted = []
+        decoder = PoolDecoder(
+            lambda decoded, received_at: emitted.append((decoded, received_at)),
+            workers=2, batch_size=7, flush_interval=0.001, max_inflight=3,
+        )
+        decoder.start()
+        if break_pool:
+            decoder._executor.shutdown(wait=True)
+        with contextlib.redirect_stdout(io.StringIO()):
+            for message in messages:
+                decoder.submit(*message)
+            decoder.stop()
+        return emitted, decoder.stats()
+
+    def expected(self, messages):
+        with contextlib.redirect_stdout(io.StringIO()):
+            return [(decode(topic, payload), received_at) for topic, payload, received_at in messages]
+
+    def test_results_in_submission_order(self):
+        messages = self.messages(200)
+        emitted, stats = self.run_decoder(messages)
+        self.assertEqual(emitted, self.expected(messages))
+        self.assertGreater(stats['pool']['batches'], 1)
+        self.assertEqual(stats['pool']['fallbacks'], 0)
+
+    def test_inline_fallback(self):
+        messages = self.messages(50)
+        emitted, stats = self.run_decoder(messages, break_pool=True)
+        self.assertEqual(emitted, self.expected(messages))
+        self.assertEqual(stats['pool']['fallbacks'], stats['pool']['batches'])
+
+
+class RecentMessagesTests(SimpleTestCase):
+
+    def setUp(self):
+        self.messages = RecentMessages(capacity=3)
+        self.start = timezone.now()
+
+    def remember(self, device_id, data, seconds=0):
+        return self.messages.remember(device_id, 'ESP', data, self.start + timedelta(seconds=seconds))
+
+    def contents(self, **kwargs):
+        return [(message['device_id'], message['data']) for message in self.messages.all(**kwargs)]
+
+    def test_eviction_at_capacity(self):
+        for n in range(5):
+            self.assertEqual(self.remember(f'DEV{n}', 'hello')['device_id'], f'DEV{n}')
+        self.assertEqual(self.contents(), [('DEV2', 'hello'), ('DEV3', 'hello'), ('DEV4', 'hello')])
+        self.assertEqual(self.contents(limit=2), [('DEV3', 'hello'), ('DEV4', 'hello')])
+        self.assertEqual(self.contents(limit=0), [])
+        self.assertEqual(len(self.messages), 3)
+        stats = self.messages.stats()
+        self.assertEqual((stats['recorded'], stats['evicted']), (5, 2))
+        # An evicted message is new again
+        self.assertIsNotNone(self.remember('DEV0', 'hello'))
+
+    def test_duplicates_refresh_the_timestamp(self):
+        self.remember('DEV0', 'hello')
+        self.remember('DEV0', 'bye')
+        self.assertIsNone(self.remember('DEV0', 'hello', seconds=5))
+        self.assertEqual(self.contents(), [('DEV0', 'hello'), ('DEV0', 'bye')])
+        self.assertEqual(self.messages.all()[0]['timestamp'], (self.start + timedelta(seconds=5)).isoformat())
+        self.assertEqual(self.messages.stats()['refreshed'], 1)
+
+
+class RecentMessagesDatabaseTests(TransactionTestCase):
+
+    def setUp(self):
+        self.start = timezone.now()
+        # The writer thread sleeps through the test; flushes are explicit
+        self.writer = RecentMessages(capacity=3, backend=BACKEND_DATABASE, flush_interval=3600)
+        self.writer.start_writer()
+
+    def remember(self, device_id, data, seconds=0):
+        self.writer.remember(device_id, 'ESP', data, self.start + timedelta(seconds=seconds))
+
+    def rows(self):
+        return list(RecentMessage.objects.order_by('id').values_list('device_id', 'data'))
+
+    def test_shared_list(self):
+        for device_id in ('DEV0', 'DEV1', 'DEV2'):
+            self.remember(device_id, 'hello')
+        self.assertEqual(self.writer.flush(), 3)
+        self.assertEqual(self.writer.flush(), 0)
+
+        self.remember('DEV1', 'hello', seconds=5)
+        self.remember('DEV3', 'hello', seconds=6)  # evicts DEV0
+        self.assertEqual(self.writer.flush(), 2)
+        self.assertEqual(self.rows(), [('DEV1', 'hello'), ('DEV2', 'hello'), ('DEV3', 'hello')])
+        self.assertEqual(
+            RecentMessage.objects.get(device_id='DEV1').timestamp, self.start + timedelta(seconds=5)
+        )
+
+        # A new process starts with the same list
+        reader = RecentMessages(capacity=3, backend=BACKEND_DATABASE)
+        self.assertEqual(reader.warm(), 3)
+        self.assertEqual(reader.all(), self.writer.all())
+
+
+@unittest.skipIf(msgpack is None, 'msgpack is not installed')
+class LogExportTests(TestCase):
+
+    def setUp(self):
+        self.start = timezone.now().replace(microsecond=0)
+        esp = Device.objects.create(device_id='DEV0', device_type='ESP', name='Device 0')
+        bmf = Device.objects.create(device_id='DEV1', device_type='BMF', name='Device 1')
+        packed = PayloadCodec(ENCODING_MSGPACK)
+        DeviceLog.objects.bulk_create([
+            DeviceLog(device=esp, data='hello', timestamp=self.at(0)),
+            DeviceLog(device=bmf, data=None, data_packed=packed.pack({'temp': 21.5}), timestamp=self.at(1)),
+            DeviceLog(device=esp, data={'readings': [1, 2]}, timestamp=self.at(2)),
+            DeviceLog(device=bmf, data=None, timestamp=self.at(3)),
+            DeviceLog(device=bmf, data=None, data_packed=packed.pack('packed text'), timestamp=self.at(4)),
+        ])
+        self.expected = [
+            ('DEV0', self.at(0), 'hello'),
+            ('DEV1', self.at(1), {'temp': 21.5}),
+            ('DEV0', self.at(2), {'readings': [1, 2]}),
+            ('DEV1', self.at(3), None),
+            ('DEV1', self.at(4), 'packed text'),
+        ]
+        device_registry.warm()
+        self.client.force_login(User.objects.create_user('operator'))
+
+    def at(self, seconds):
+        return self.start + timedelta(seconds=seconds)
+
+    def export(self, **params):
+        response = self.client.get(reverse('export_logs'), params)
+        self.assertEqual(response.status_code, 200)
+        body = b''.join(response.streaming_content)
+        if params.get('gzip'):
+            self.assertEqual(response['Content-Type'], 'application/gzip')
+            body = gzip.decompress(body)
+        return body.decode()
+
+    def ndjson(self, **params):
+        return [
+            (row['device_id'], parse_datetime(row['timestamp']), row['data'])
+            for row in map(json.loads, self.export(**params).splitlines())
+        ]
+
+    def test_ndjson(self):
+        self.assertEqual(self.ndjson(), self.expected)
+        self.assertEqual(self.ndjson(gzip='1'), self.expected)
+
+    def test_device_selection(self):
+        # One device at a time, each in timestamp order
+        self.assertEqual(
+            self.ndjson(device_id='DEV1,DEV0', since=self.at(1).isoformat(), until=self.at(4).isoformat()),
+            [row for row in self.expected if row[0] == 'DEV1' and row[1] < self.at(4)]
+            + [row for row in self.expected if row[0] == 'DEV0' and row[1] >= self.at(1)]
+        )
+        self.assertEqual(self.ndjson(device_type='ESP'), [row for row in self.expected if row[0] == 'DEV0'])
+
+    def test_csv(self):
+        for params in ({}, {'gzip': '1'}):
+            with self.subTest(**params):
+                rows = list(csv.reader(io.StringIO(self.export(format='csv', **params))))
+                self.assertEqual(rows[0], ['device_id', 'timestamp', 'data'])
+                # Strings as-is, everything else as JSON
+                self.assertEqual(rows[1:], [
+                    ['DEV0', self.at(0).isoformat(), 'hello'],
+                    ['DEV1', self.at(1).isoformat(), '{"temp": 21.5}'],
+                    ['DEV0', self.at(2).isoformat(), '{"readings": [1, 2]}'],
+                    ['DEV1', self.at(3).isoformat(), 'null'],
+                    ['DEV1', self.at(4).isoformat(), 'packed text'],
+                ])
+
+
+class Interrupted(Exception):
+    pass
+
+
+class LogImporterTests(TestCase):
+
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory, ignore_errors=True)
+        self.directory = directory
+        self.start = timezone.now().replace(microsecond=0) - timedelta(days=1)
+        device_registry.warm()
+
+    def write(self, name, records):
+        path = os.path.join(self.directory, name)
+        lines = ''.join(json.dumps(record) + '\n' for record in records).encode()
+        with open(path, 'wb') as handle:
+            handle.write(gzip.compress(lines) if name.endswith('.gz') else lines)
+        return path
+
+    def records(self, count):
+        return [
+            {'device_id': f'DEV{n % 3}', 'device_type': 'ESP',
+             'timestamp': (self.start + timedelta(seconds=n)).isoformat(), 'data': {'n': n}}
+            for n in range(count)
+        ]
+
+    def run_import(self, path):
+        with contextlib.redirect_stdout(io.StringIO()):
+            return LogImporter(path, batch_size=10).run()
+
+    def test_interrupted_import_resumes(self):
+        for name in ('logs.ndjson', 'logs.ndjson.gz'):
+            with self.subTest(name=name):
+                DeviceLog.objects.all().delete()
+                path = self.write(name, self.records(25))
+
+                def interrupt(importer):
+                    if importer.batches == 2:
+                        raise Interrupted
+
+                with self.assertRaises(Interrupted):
+                    LogImporter(path, batch_size=10).run(interrupt)
+                checkpoint = ImportCheckpoint.objects.get(source=os.path.abspath(path))
+                self.assertEqual((checkpoint.position, checkpoint.rows_imported), (20, 20))
+                self.assertFalse(checkpoint.completed)
+
+                result = LogImporter(path, batch_size=10).run()
+                self.assertEqual((result['imported'], result['total_imported']), (5, 25))
+                self.assertTrue(result['completed'])
+                # Every record exactly once
+                self.assertEqual(
+                    sorted(log.data['n'] for log in DeviceLog.objects.all()), list(range(25))
+                )
+                # A completed file is not imported again
+                self.assertEqual(LogImporter(path, batch_size=10).run()['imported'], 0)
+
+    def test_invalid_records_are_skipped(self):
+        records = self.records(3) + [
+            {'device_id': 'D' * 50, 'timestamp': self.start.isoformat(), 'data': 'max length'},
+            {'device_id': 'D' * 51, 'timestamp': self.start.isoformat(), 'data': 'too long'},
+            {'device_id': 'DEV9', 'device_type': 'T' * 51, 'timestamp': self.start.isoformat(), 'data': 1},
+            {'device_id': 'D' * 50, 'device_type': 'T' * 48, 'timestamp': self.start.isoformat(), 'data': 2},
+            {'device_id': 'DEV-9', 'timestamp': self.start.isoformat(), 'data': 3},
+            {'device_id': 'DEV9', 'timestamp': 'yesterday', 'data': 4},
+            {'device_id': 'DEV9', 'timestamp': self.start.isoformat()},
+            ['DEV9'],
+        ]
+        result = self.run_import(self.write('logs.ndjson', records))
+        self.assertEqual((result['imported'], result['skipped'], result['created_devices']), (4, 7, 4))
+        self.assertEqual(Device.objects.get(device_id='D' * 50).name, f"unknown - {'D' * 50}")
+        with self.assertRaises(ValueError):
+            LogImporter(self.write('more.ndjson', []), device_type='T' * 51)
+
+
+class StorageTests(TestCase):
+
+    def setUp(self):
+        self.now = timezone.now().replace(microsecond=0)
+        self.devices = {
+            device_id: Device.objects.create(
+                device_id=device_id, device_type='ESP', name=device_id, status='offline',
+                last_seen=last_seen,
+            )
+            for device_id, last_seen in (
+                ('STALE', self.now - timedelta(minutes=5)),
+                ('AHEAD', self.now + timedelta(minutes=5)),
+                ('NEVER', None),
+            )
+        }
+
+    def storages(self):
+        storages = [DefaultStorage()]
+        if connection.vendor == 'sqlite' and sqlite3.sqlite_version_info >= (3, 33):
+            storages.append(SQLiteStorage())
+        return storages
+
+    def test_insert_logs(self):
+        codecs = [PayloadCodec(ENCODING_JSON)] + ([PayloadCodec(ENCODING_MSGPACK)] if msgpack else [])
+        adapt = timestamp_adapter()
+        device = self.devices['STALE']
+        for storage in self.storages():
+            for codec in codecs:
+                with self.subTest(storage=storage.name, encoding=codec.encoding):
+                    DeviceLog.objects.all().delete()
+                    payloads = ['hello', {'temp': 21.5}, [1, 2]]
+                    storage.insert_logs([
+                        (device.pk, adapt(self.now + timedelta(seconds=n)), *codec.prepare(data))
+                        for n, data in enumerate(payloads)
+                    ])
+                    logs = list(DeviceLog.objects.order_by('timestamp'))
+                    self.assertEqual([log.data for log in logs], payloads)
+                    self.assertEqual([log.data_hash for log in logs], [payload_hash(data) for data in payloads])
+                    self.assertEqual(
+                        [log.timestamp for log in logs], [self.now + timedelta(seconds=n) for n in range(3)]
+                    )
+                    self.assertTrue(all(log.created_at for log in logs))
+                    storage.insert_logs([])
+
+    def test_update_heartbeats(self):
+        initial = {device_id: device.last_seen for device_id, device in self.devices.items()}
+        for storage in self.storages():
+            with self.subTest(storage=storage.name):
+                for device_id, last_seen in initial.items():
+                    Device.objects.filter(device_id=device_id).update(
+                        status='offline', last_seen=last_seen, version=0
+                    )
+                with transaction.atomic():
+                    updated = storage.update_heartbeats([
+                        (device.pk, (device_id, self.now, 'online'))
+                        for device_id, device in self.devices.items()
+                    ], version=7)
+                # Only heartbeats newer than the stored last_seen are applied
+                self.assertEqual(updated, 2)
+                rows = {
+                    row[0]: row[1:]
+                    for row in Device.objects.values_list('device_id', 'status', 'last_seen', 'version')
+                }
+                self.assertEqual(rows, {
+                    'STALE': ('online', self.now, 7),
+                    'AHEAD': ('offline', self.now + timedelta(minutes=5), 0),
+                    'NEVER': ('online', self.now, 7),
+                })
+                self.assertEqual(storage.update_heartbeats([], version=8), 0)
+
+    def test_storage_selection(self):
+        for name, expected in (('default', DefaultStorage), ('sqlite', SQLiteStorage)):
+            with self.subTest(name=name), override_settings(INGEST_STORAGE=name):
+                self.assertIs(type(storage_from_settings()), expected)
+        with override_settings(INGEST_STORAGE='oracle'), self.assertRaises(ValueError):
+            storage_from_settings()
+        if connection.vendor == 'sqlite':
+            with override_settings(INGEST_STORAGE='auto'):
+                self.assertIs(type(storage_from_settings()), SQLiteStorage)
+                # UPDATE ... FROM needs SQLite 3.33
+                with mock.patch('sqlite3.sqlite_version_info', (3, 32, 0)):
+                    self.assertIs(type(storage_from_settings()), DefaultStorage)
+
+
+class LogRollupTests(TestCase):
+
+    def setUp(self):
+        self.device = Device.objects.create(device_id='DEV0', device_type='ESP', name='Device 0')
+        self.today = day_start(timezone.now())
+        self.days = [self.today - timedelta(days=n) for n in (3, 2, 1)]
+        for day in self.days[:2]:
+            self.log(day + timedelta(hours=1), 'hello')
+
+    def log(self, timestamp, data):
+        DeviceLog.objects.create(device=self.device, timestamp=timestamp, data=data)
+
+    def daily_counts(self):
+        return dict(
+            DeviceLogRollup.objects.filter(period='day').values_list('bucket_start', 'message_count')
+        )
+
+    def prune(self):
+        return prune_device_logs(retention_days=30)['rolled_up_days']
+
+    def test_days_are_rolled_up_again_when_their_logs_change(self):
+        self.log(timezone.now(), 'today')  # incomplete day: never rolled up
+        self.assertEqual(self.prune(), [day.date().isoformat() for day in self.days[:2]])
+        self.assertEqual(self.daily_counts(), {self.days[0]: 1, self.days[1]: 1})
+        self.assertEqual(RollupMark.objects.get(day=self.days[0]).log_count, 1)
+        self.assertEqual(self.prune(), [])
+
+        # Backfilled logs for an old day and the first logs of an empty one
+        self.log(self.days[0] + timedelta(hours=2), 'idle')
+        self.log(self.days[2] + timedelta(hours=5), 'hello')
+        self.assertEqual(self.prune(), [self.days[0].date().isoformat(), self.days[2].date().isoformat()])
+        self.assertEqual(self.daily_counts(), {self.days[0]: 2, self.days[1]: 1, self.days[2]: 1})
+        rollup = DeviceLogRollup.objects.get(period='day', bucket_start=self.days[0])
+        self.assertEqual(rollup.status_counts, {'online': 1, 'idle': 1})
+        self.assertEqual(self.prune(), [])
+
+    def test_replaced_logs_are_noticed(self):
+        self.prune()
+        # Same count, different rows
+        DeviceLog.objects.filter(timestamp__lt=self.days[1]).delete()
+        self.log(self.days[0] + timedelta(hours=3), 'idle')
+        self.assertEqual(self.prune(), [self.days[0].date().isoformat()])
+        rollup = DeviceLogRollup.objects.get(period='day', bucket_start=self.days[0])
+        self.assertEqual((rollup.message_count, rollup.status_counts), (1, {'online': 0, 'idle': 1}))
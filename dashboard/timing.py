@@ -0,0 +1,34 @@
+"""Per-stage timing for the ingestion pipeline"""
+import threading
+
+
+class StageTimer:
+    """Accumulates how long one pipeline stage spends on its items.
+
+    ``add(seconds, items)`` records one call that handled ``items`` items,
+    e.g. a decoded batch or a persisted batch.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = 0
+        self._items = 0
+        self._total = 0.0
+        self._max = 0.0
+
+    def add(self, seconds, items=1):
+        with self._lock:
+            self._calls += 1
+            self._items += items
+            self._total += seconds
+            self._max = max(self._max, seconds)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'items': self._items,
+                'calls': self._calls,
+                'total_ms': round(self._total * 1000, 3),
+                'avg_item_ms': round(self._total / self._items * 1000, 4) if self._items else 0,
+                'max_call_ms': round(self._max * 1000, 3),
+            }
@@ -1,7 +1,5 @@
 from django.urls import path
 from . import views
-from django.conf import settings
-from django.conf.urls.static import static
 
 urlpatterns = [
     path('', views.DashboardView.as_view(), name='dashboard'),
@@ -10,6 +8,16 @@ urlpatterns = [
     path('get_all_logs/', views.get_all_logs, name='get_all_logs'),
     path('device/<str:device_id>/logs/', views.get_all_logs, name='device_logs'),
     path('api/firmware/', views.get_firmware, name='get_firmware'),
+    path('api/firmware/blobs/<str:digest>/', views.download_firmware, name='download_firmware'),
     path('api/device/<str:device_id>/query/', views.query_device, name='query_device'),
+    path('api/queries/', views.query_devices, name='query_devices'),
+    path('api/queries/<str:correlation_id>/', views.device_query, name='device_query'),
+    path('api/device/<str:device_id>/rollups/', views.get_log_rollups, name='get_log_rollups'),
+    path('api/logs/export/', views.export_logs, name='export_logs'),
     path('api/devices/status/', views.get_device_statuses, name='get_device_statuses'),
-] + static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)
+    path('api/devices/summary/', views.get_device_summary, name='get_device_summary'),
+    path('api/commands/', views.fleet_commands, name='fleet_commands'),
+    path('api/commands/<str:command_id>/', views.fleet_command, name='fleet_command'),
+    path('api/metrics/', views.get_metrics, name='get_metrics'),
+    path('api/events/', views.event_stream, name='event_stream'),
+]
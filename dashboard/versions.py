@@ -0,0 +1,34 @@
+"""Monotonic fleet version for conditional and delta status polls.
+
+Every write that changes a device's ``status``, ``last_seen`` or ``name``
+stamps the affected rows with a new fleet version taken from the single
+``FleetVersion`` row, in the same transaction. The counter row stays locked
+until that transaction commits, so versions become visible in increasing
+order. A client that has seen version N can therefore fetch everything that
+changed since with ``version > N``.
+
+``/api/devices/status/`` uses the current version as its ETag: a poll with a
+matching ``If-None-Match`` gets 304, and ``?since=<version>`` returns only
+the devices changed after that version. Deleted devices only disappear from
+a full response.
+"""
+from django.db import transaction
+from django.db.models import F
+
+from .models import FleetVersion
+
+FLEET_VERSION_PK = 1
+
+
+def next_fleet_version():
+    """Bump and return the fleet version; call inside the writing transaction"""
+    with transaction.atomic():
+        updated = FleetVersion.objects.filter(pk=FLEET_VERSION_PK).update(version=F('version') + 1)
+        if not updated:
+            FleetVersion.objects.get_or_create(pk=FLEET_VERSION_PK)
+            FleetVersion.objects.filter(pk=FLEET_VERSION_PK).update(version=F('version') + 1)
+        return FleetVersion.objects.values_list('version', flat=True).get(pk=FLEET_VERSION_PK)
+
+
+def current_fleet_version():
+    return FleetVersion.objects.filter(pk=FLEET_VERSION_PK).values_list('version', flat=True).first() or 0
@@ -1,386 +1,295 @@
 from django.shortcuts import render, redirect
 from django.views.generic import ListView, CreateView
-from django.urls import reverse_lazy
+from django.urls import reverse, reverse_lazy
 from django.utils import timezone
 from django.contrib import messages
-from django.http import JsonResponse, HttpResponse
+from django.http import FileResponse, JsonResponse, HttpResponse, HttpResponseNotModified, StreamingHttpResponse
 from django.views.decorators.csrf import csrf_exempt, csrf_protect
 from django.contrib.auth.decorators import login_required
 from django.views.decorators.http import require_http_methods
+from django.conf import settings
 from django.shortcuts import get_object_or_404
-from .models import Device, DeviceLog, Firmware
+from django.utils.http import parse_etags
+from django.core.files.storage import default_storage
+from .models import Device, DeviceLog, DeviceLogRollup, FleetCommand
+from .bridge import event_bridge
+from .events import event_hub
+from .export import FORMAT_NDJSON, LogExport
+from .firmware import DIGEST_RE, RangeFile, blob_name, parse_range
+from .fleet import InvalidCommand, fleet_dispatcher
+from .logs import InvalidQuery, log_page, parse_limit, parse_time
+from .manifest import firmware_manifest
+from .mqtt import publish_json, publish_many
+from .packaging import firmware_packager
+from .pending import STATUS_ANSWERED, STATUS_PENDING, STATUS_TIMED_OUT, pending_requests
+from .recent import recent_messages
+from .registry import device_registry
+from .versions import current_fleet_version
 
 import json
+import math
 import threading
-import paho.mqtt.client as mqtt
-from datetime import timedelta
-import time
 
-# Global variable for storing recent messages in memory
-# Keep only the last 10 messages to avoid memory issues
-recent_messages = []
-MAX_RECENT_MESSAGES = 10
-
-# MQTT Client setup
+# MQTT Client setup. Web processes only publish (device queries) and follow
+# the consumer workers' events; device topics are consumed by
+# ``manage.py run_consumer``.
 mqtt_client_instance = None
 
-# Function to update device status
-def update_device_status():
-    """Update device status based on last seen time"""
-    now = timezone.now()
-    two_minutes_ago = now - timedelta(minutes=2)
-    five_minutes_ago = now - timedelta(minutes=5)
-    
-    # Update devices that were online but haven't been seen in 2 minutes to idle
-    idle_devices = Device.objects.filter(
-        status='online',
-        last_seen__lt=two_minutes_ago
-    )
-    
-    for device in idle_devices:
-        device.status = 'idle'
-        device.save()
-        print(f" Set device {device.device_id} to idle")
-    
-    # Update devices that were idle but haven't been seen in 5 minutes to offline
-    offline_devices = Device.objects.filter(
-        status='idle',
-        last_seen__lt=five_minutes_ago
-    )
-    
-    for device in offline_devices:
-        device.status = 'offline'
-        device.save()
-        print(f" Set device {device.device_id} to offline")
-
-# Start periodic status update
-def start_status_update():
-    """Start a background thread to update device status every minute"""
-    def run_periodic():
-        while True:
-            update_device_status()
-            time.sleep(60)  # Check every minute
-    
-    thread = threading.Thread(target=run_periodic, daemon=True)
-    thread.start()
+def warm_device_registry():
+    """Load the device registry so the first requests don't pay for it"""
+    try:
+        device_registry.ensure_warm()
+        recent_messages.warm()
+        firmware_manifest.ensure_loaded()
+    except Exception as e:
+        print(f"❌ Failed to warm device registry: {e}")
+    device_registry.start_reconciler(getattr(settings, 'FLEET_RECONCILE_INTERVAL', 60))
 
 def send_mqtt_message(topic, message):
     """Send an MQTT message"""
-    if mqtt_client_instance and mqtt_client_instance.is_connected():
-        try:
-            result = mqtt_client_instance.publish(topic, json.dumps(message))
-            if result.rc == mqtt.MQTT_ERR_SUCCESS:
-                print(f"✅ Message sent to {topic}: {message}")
-                return True
-            else:
-                print(f"❌ Failed to send message: {result.rc}")
-                return False
-        except Exception as e:
-            print(f"❌ Error sending MQTT message: {str(e)}")
-            return False
-    else:
+    try:
+        if publish_json(mqtt_client_instance, topic, message):
+            print(f"✅ Message sent to {topic}: {message}")
+            return True
         print("❌ MQTT client not connected")
         return False
+    except Exception as e:
+        print(f"❌ Error sending MQTT message: {str(e)}")
+        return False
 
-def query_device_status(device_id):
-    """Send a ping message to query device status"""
-    topic = "check"
-    message = {
+def query_message(device_id, correlation_id):
+    """Ping for a device; it echoes ``command-id`` in its reply"""
+    return {
         "device-id": device_id,
-        "message": "ping"
+        "message": "ping",
+        "command-id": correlation_id,
     }
-    return send_mqtt_message(topic, message)
+
+def query_device_status(device_id, correlation_id):
+    """Send a ping message to query device status"""
+    topic = "check"
+    return send_mqtt_message(topic, query_message(device_id, correlation_id))
+
+def parse_wait(value):
+    """Seconds to wait for device replies, at most ``QUERY_MAX_WAIT``"""
+    if value in (None, ''):
+        return 0
+    try:
+        wait = float(value)
+    except (TypeError, ValueError):
+        raise InvalidQuery('wait must be a number of seconds')
+    if not math.isfinite(wait):
+        raise InvalidQuery('wait must be a number of seconds')
+    if wait < 0:
+        raise InvalidQuery('wait must not be negative')
+    return min(wait, getattr(settings, 'QUERY_MAX_WAIT', 30))
 
 def connect_mqtt():
     global mqtt_client_instance
+    try:
+        mqtt_client_instance = event_bridge.start()
+    except Exception as e:
+        print(f"❌ Failed to connect to MQTT broker: {e}")
 
-    def on_connect(client, userdata, flags, rc):
-        if rc == 0:
-            print("✅ Successfully connected to MQTT Broker")
-            # Subscribe to all device messages
-            client.subscribe("devices/#")
-            # Also subscribe to the check topic for query responses
-            client.subscribe("check/response")
-        else:
-            print(f"❌ MQTT Connection failed with code {rc}")
+_services_started = False
 
-    def on_message(client, userdata, msg):
-        try:
-            print(f"\n📩 MQTT Message Received on topic: {msg.topic}")
-            
-            # Skip processing if payload is empty
-            if not msg.payload:
-                print("⚠️ Empty payload received, skipping...")
-                return
-                
-            print(f"📦 Raw Payload: {msg.payload}")
+def start_web_services():
+    """Warm the device registry and follow the consumer workers' events.
 
-            try:
-                # Decode JSON message
-                message_data = json.loads(msg.payload.decode())
-                print(f"✅ Decoded JSON: {message_data}")
-            except json.JSONDecodeError as e:
-                print(f"❌ Failed to decode JSON: {e}")
-                return
-
-            # Extract device type from topic or message
-            device_type = "unknown"
-            if 'devices/' in msg.topic:
-                device_type = msg.topic.split('/')[-1]
-            print(f"🎯 Device Type: {device_type}")
-
-            # Extract and validate device-id
-            device_id = message_data.get('device-id')
-            if not device_id:
-                print("❌ device-id is missing in payload!")
-                return
-            
-            device_id = str(device_id).strip()
-            if not device_id or not device_id.isalnum():
-                print(f"❌ Invalid device-id format: {device_id}")
-                return
-
-            message_content = str(message_data.get('message', '')).lower().strip()
-            print(f"🎯 Message Content: {message_content}")
-
-            # Initialize variables
-            created = False
-            device = None
-            
-            # Check if device already exists with this device_id
-            try:
-                existing_device = Device.objects.filter(device_id=device_id).first()
-                if existing_device:
-                    print(f"🔄 Found existing device: {existing_device}")
-                    # Update existing device
-                    existing_device.device_type = device_type
-                    
-                    # Update status based on message content
-                    if message_content == 'idle':
-                        existing_device.status = 'idle'
-                    elif message_content == 'online':
-                        existing_device.status = 'online'
-                    else:
-                        # For any other message, consider it as online
-                        existing_device.status = 'online'
-                        
-                    existing_device.last_seen = timezone.now()
-                    existing_device.save()
-                    print(f"✅ Updated device {device_id} status to {existing_device.status}")
-                    device = existing_device
-                else:
-                    # Create new device
-                    device = Device.objects.create(
-                        device_id=device_id,
-                        device_type=device_type,
-                        status='online',
-                        last_seen=timezone.now(),
-                        name=f"{device_type} - {device_id}"
-                    )
-                    created = True
-                    print(f"✅ New device created: {device_id}")
-            except Exception as e:
-                print(f"❌ Error updating/creating device status: {e}")
-                return
-
-            # Create or update device log
-            log_entry, log_created = DeviceLog.objects.get_or_create(
-                device=device,
-                data=message_content,
-                defaults={'timestamp': timezone.now()}
-            )
-            
-            if log_created:
-                print(f"📝 Log entry created for {device_id}: {message_content}")
-            else:
-                print(f"🔄 Log entry already exists for {device_id}: {message_content}")
-
-            # Only store logs for messages from devices/ topics
-            if msg.topic.startswith('devices/'):
-                # Extract device type from topic (devices/type/device_id)
-                topic_parts = msg.topic.split('/')
-                if len(topic_parts) >= 3:  # Ensure we have at least devices/type/id
-                    device_type = topic_parts[1]  # Get the type part
-                    
-                    # Save to in-memory recent messages (keep only last 10)
-                    message = {
-                        'device_id': device_id,
-                        'data': message_content,
-                        'timestamp': timezone.now().isoformat(),
-                        'log_id': log_entry.id,
-                        'device_type': device_type
-                    }
-                    
-                    # Check if this message already exists (same device and data)
-                    existing_index = None
-                    for i, msg in enumerate(recent_messages):
-                        if msg['device_id'] == device_id and msg['data'] == message_content:
-                            existing_index = i
-                            break
-                    
-                    if existing_index is not None:
-                        # Update existing message timestamp
-                        recent_messages[existing_index]['timestamp'] = message['timestamp']
-                    else:
-                        # Ensure we don't exceed max messages
-                        if len(recent_messages) >= MAX_RECENT_MESSAGES:
-                            recent_messages.pop(0)  # Remove oldest message
-                        # Add new message
-                        recent_messages.append(message)
-                
-            # Keep only the last MAX_RECENT_MESSAGES messages
-            if len(recent_messages) > MAX_RECENT_MESSAGES:
-                recent_messages = recent_messages[-MAX_RECENT_MESSAGES:]
-                
-            # Check if device exists and update/create if needed
-            try:
-                existing_device = Device.objects.filter(device_id=device_id).first()
-                if existing_device:
-                    print(f"🔄 Found existing device: {existing_device}")
-                    # Update existing device
-                    existing_device.device_type = device_type
-                    
-                    # Update status based on message content
-                    if message_content == 'idle':
-                        existing_device.status = 'idle'
-                    elif message_content == 'online':
-                        existing_device.status = 'online'
-                    else:
-                        # For any other message, consider it as online
-                        existing_device.status = 'online'
-                        
-                    existing_device.last_seen = timezone.now()
-                    existing_device.save()
-                    print(f"✅ Updated device {device_id} status to {existing_device.status}")
-                    device = existing_device
-                else:
-                    # Create new device
-                    device = Device.objects.create(
-                        device_id=device_id,
-                        device_type=device_type,
-                        status='online',
-                        last_seen=timezone.now(),
-                        name=f"{device_type} - {device_id}"
-                    )
-                    print(f"✅ New device created: {device_id}")
-
-                # Create or update device log
-                log_entry, log_created = DeviceLog.objects.get_or_create(
-                    device=device,
-                    data=message_content,
-                    defaults={'timestamp': timezone.now()}
-                )
-                
-                if log_created:
-                    print(f"📝 Log entry created for {device_id}: {message_content}")
-                else:
-                    print(f"🔄 Log entry already exists for {device_id}: {message_content}")
-                
-                # Check if this message already exists (same device and data)
-                existing_index = None
-                for i, msg in enumerate(recent_messages):
-                    if msg['device_id'] == device_id and msg['data'] == message_content:
-                        existing_index = i
-                        break
-                
-                if existing_index is not None:
-                    # Update existing message timestamp
-                    recent_messages[existing_index]['timestamp'] = message['timestamp']
-                else:
-                    # Add new message
-                    recent_messages.append(message)
-                    
-                # Keep only the last MAX_RECENT_MESSAGES messages
-                if len(recent_messages) > MAX_RECENT_MESSAGES:
-                    recent_messages = recent_messages[-MAX_RECENT_MESSAGES:]
-
-            except Exception as e:
-                print(f"❌ Error processing message: {e}")
-
-        except Exception as e:
-            print(f"❌ Error in on_message: {e}")
-
-
-    # Create MQTT client instance if it doesn't exist
-    if mqtt_client_instance is None:
-        try:
-            client_id = f"dashboard_{int(time.time())}"
-            mqtt_client_instance = mqtt.Client(client_id=client_id)
-            mqtt_client_instance.on_connect = on_connect
-            mqtt_client_instance.on_message = on_message
-            
-            # Set last will and testament
-            mqtt_client_instance.will_set("dashboard/status", "offline", qos=1, retain=True)
-            
-            from django.conf import settings
-            print(f"🔌 Connecting to MQTT broker at {getattr(settings, 'MQTT_BROKER_HOST', 'localhost')}:{getattr(settings, 'MQTT_BROKER_PORT', 1883)}...")
-            mqtt_client_instance.connect(
-                getattr(settings, 'MQTT_BROKER_HOST', 'localhost'),
-                getattr(settings, 'MQTT_BROKER_PORT', 1883),
-                60
-            )
-            mqtt_client_instance.loop_start()
-            
-            # Publish online status
-            mqtt_client_instance.publish("dashboard/status", "online", qos=1, retain=True)
-            
-        except Exception as e:
-            print(f"❌ Failed to connect to MQTT broker: {e}")
-            mqtt_client_instance = None
-    else:
-        # If client exists but not connected, try to reconnect
-        if not mqtt_client_instance.is_connected():
-            try:
-                mqtt_client_instance.reconnect()
-                mqtt_client_instance.loop_start()
-            except Exception as e:
-                print(f"❌ Failed to reconnect to MQTT broker: {e}")
-                mqtt_client_instance = None
-
-# Start MQTT client in background thread
-threading.Thread(target=connect_mqtt, daemon=True).start()
-
-# Start status update thread
-start_status_update()
+    Called once per web process from ``DashboardConfig.ready()`` (see apps.py).
+    """
+    global _services_started
+    if _services_started:
+        return
+    _services_started = True
+    threading.Thread(target=warm_device_registry, daemon=True).start()
+    threading.Thread(target=connect_mqtt, daemon=True).start()
 
 # ========== Views ==========
 
 @csrf_exempt
 def get_recent_messages(request):
-    return JsonResponse({'messages': recent_messages})
+    # Served from memory; ``?limit=`` keeps only the newest messages
+    try:
+        limit = parse_limit(request.GET.get('limit'), None, recent_messages.capacity)
+    except InvalidQuery as e:
+        return JsonResponse({'error': str(e)}, status=400)
+    return JsonResponse({'messages': recent_messages.all(limit)})
+
+
+@login_required
+def event_stream(request):
+    """Server-Sent Events stream of status, log and recent message deltas.
+
+    Pass ``?device_id=`` to only receive that device's events. Browsers resend
+    the last event id in the ``Last-Event-ID`` header when they reconnect.
+    """
+    last_event_id = request.META.get('HTTP_LAST_EVENT_ID') or request.GET.get('last_event_id')
+    try:
+        last_event_id = int(last_event_id) if last_event_id else None
+    except ValueError:
+        last_event_id = None
+    subscription, missed = event_hub.subscribe(last_event_id, request.GET.get('device_id') or None)
+    keepalive = getattr(settings, 'EVENT_KEEPALIVE', 15)
+
+    def stream():
+        try:
+            yield f"retry: {getattr(settings, 'EVENT_RETRY_MS', 3000)}\n\n"
+            if missed is None:
+                # Too far behind to replay: the client reloads its state
+                yield f"id: {event_hub.last_event_id}\nevent: reset\ndata: {{}}\n\n"
+            else:
+                for event in missed:
+                    yield event.encode()
+            while True:
+                events = subscription.get(keepalive)
+                if subscription.overflowed:
+                    # Slow consumer: end the stream, the client resumes from its last id
+                    return
+                if not events:
+                    yield ": keepalive\n\n"
+                for event in events:
+                    yield event.encode()
+        finally:
+            subscription.close()
+
+    response = StreamingHttpResponse(stream(), content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
+
+@login_required
+def get_metrics(request):
+    """API endpoint exposing in-process pipeline metrics"""
+    return JsonResponse({
+        'events': event_hub.stats(),
+        'registry': device_registry.stats(),
+        'recent_messages': recent_messages.stats(),
+        'bridge': event_bridge.stats(),
+        'firmware_manifest': firmware_manifest.stats(),
+        'firmware_packager': firmware_packager.stats(),
+        'fleet_commands': fleet_dispatcher.stats(),
+        'device_queries': pending_requests.stats(),
+        # Ingestion, WAL, heartbeat and presence stats as last reported by
+        # each consumer worker
+        'consumers': event_bridge.consumer_stats(),
+    })
 
 
 @login_required
 def get_all_logs(request, device_id=None):
+    """Paginated device logs, newest first.
+
+    Query parameters: ``device_id`` (unless in the URL), ``limit``, ``since``
+    and ``until`` (ISO 8601), and either ``before`` (older than a cursor) or
+    ``after`` (newer than a cursor). Responses carry ``newest_cursor`` and
+    ``oldest_cursor`` to continue in either direction.
+    """
     if request.is_ajax():
-        if device_id:
-            logs = DeviceLog.objects.filter(device__device_id=device_id).order_by('-timestamp')
-        else:
-            device_id = request.GET.get('device_id')
-            if not device_id:
-                return JsonResponse({'error': 'Device ID required'}, status=400)
-            logs = DeviceLog.objects.filter(device__device_id=device_id).order_by('-timestamp')
+        device_id = device_id or request.GET.get('device_id')
+        if not device_id:
+            return JsonResponse({'error': 'Device ID required'}, status=400)
+        state = device_registry.get_or_load(device_id)
+        if state is None:
+            return JsonResponse({'error': 'Device not found'}, status=404)
 
-        return JsonResponse({
-            'logs': [
-                {
-                    'id': log.id,
-                    'timestamp': log.timestamp.isoformat(),
-                    'data': log.data
-                }
-                for log in logs
-            ]
-        })
+        try:
+            page = log_page(
+                state.pk,
+                limit=parse_limit(request.GET.get('limit')),
+                before=request.GET.get('before'),
+                after=request.GET.get('after'),
+                since=parse_time(request.GET.get('since'), 'since'),
+                until=parse_time(request.GET.get('until'), 'until'),
+            )
+        except InvalidQuery as e:
+            return JsonResponse({'error': str(e)}, status=400)
+
+        for log in page['logs']:
+            log['timestamp'] = log['timestamp'].isoformat()
+        return JsonResponse(page)
 
     if not device_id:
         return JsonResponse({'error': 'Device ID required'}, status=400)
+    return device_logs(request, device_id)
 
-    device = Device.objects.get(device_id=device_id)
-    logs = DeviceLog.objects.filter(device=device).order_by('-timestamp')
-    return render(request, 'dashboard/device_logs.html', {
-        'device': device,
-        'logs': logs
-    })
+
+@login_required
+def get_log_rollups(request, device_id):
+    """Hourly or daily message counts for a device, kept after raw logs expire.
+
+    Query parameters: ``period`` (``hour`` or ``day``, default ``hour``) and
+    ``since``/``until`` (ISO 8601) bounding the bucket start.
+    """
+    state = device_registry.get_or_load(device_id)
+    if state is None:
+        return JsonResponse({'error': 'Device not found'}, status=404)
+    period = request.GET.get('period', 'hour')
+    if period not in dict(DeviceLogRollup.PERIOD_CHOICES):
+        return JsonResponse({'error': f'Invalid period: {period!r}'}, status=400)
+    try:
+        since = parse_time(request.GET.get('since'), 'since')
+        until = parse_time(request.GET.get('until'), 'until')
+        limit = parse_limit(request.GET.get('limit'))
+    except InvalidQuery as e:
+        return JsonResponse({'error': str(e)}, status=400)
+
+    rollups = DeviceLogRollup.objects.filter(device_id=state.pk, period=period)
+    if since:
+        rollups = rollups.filter(bucket_start__gte=since)
+    if until:
+        rollups = rollups.filter(bucket_start__lt=until)
+    rows = list(rollups.order_by('-bucket_start').values(
+        'bucket_start', 'message_count', 'first_seen', 'last_seen', 'status_counts'
+    )[:limit])
+    for row in rows:
+        for field in ('bucket_start', 'first_seen', 'last_seen'):
+            row[field] = row[field].isoformat()
+    return JsonResponse({'device_id': state.device_id, 'period': period, 'rollups': rows})
+
+
+@login_required
+def export_logs(request):
+    """Stream device logs as NDJSON (default) or CSV.
+
+    Query parameters: ``device_id`` (repeatable or comma-separated) and/or
+    ``device_type`` to pick devices (default: all), ``since``/``until``
+    (ISO 8601), ``format`` (``ndjson`` or ``csv``) and ``gzip=1``.
+    """
+    device_ids = [
+        device_id.strip()
+        for value in request.GET.getlist('device_id') for device_id in value.split(',')
+        if device_id.strip()
+    ]
+    device_type = request.GET.get('device_type')
+    devices = None
+    if device_ids:
+        states = device_registry.get_many(device_ids)
+        missing = [device_id for device_id in device_ids if device_id not in states]
+        if missing:
+            return JsonResponse({'error': f'Device not found: {missing[0]}'}, status=404)
+        devices = list(states.values())
+    if device_type:
+        devices = [
+            state for state in (devices if devices is not None else device_registry.all())
+            if state.device_type == device_type
+        ]
+    try:
+        export = LogExport(
+            devices=devices,
+            since=parse_time(request.GET.get('since'), 'since'),
+            until=parse_time(request.GET.get('until'), 'until'),
+            format=request.GET.get('format', FORMAT_NDJSON),
+            gzip=request.GET.get('gzip') in ('1', 'true'),
+        )
+    except (InvalidQuery, ValueError) as e:
+        return JsonResponse({'error': str(e)}, status=400)
+
+    response = StreamingHttpResponse(export, content_type=export.content_type)
+    response['Content-Disposition'] = f'attachment; filename="{export.filename}"'
+    response['X-Accel-Buffering'] = 'no'
+    return response
 
 
 class DashboardView(ListView):
@@ -390,10 +299,12 @@ class DashboardView(ListView):
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
-        context['recent_logs'] = DeviceLog.objects.all().order_by('-timestamp')
-        context['online_devices'] = Device.objects.filter(status=True)
-        context['offline_devices'] = Device.objects.filter(status=False)
-        context['recent_messages'] = recent_messages
+        context['recent_logs'] = DeviceLog.objects.select_related('device').order_by(
+            '-timestamp'
+        )[:getattr(settings, 'RECENT_LOGS_LIMIT', 50)]
+        # Header counts come from the registry's counters, not a Device query
+        context['fleet'] = device_registry.summary()
+        context['recent_messages'] = recent_messages.all()
         return context
 
 
@@ -410,62 +321,252 @@ class DeviceLogCreateView(CreateView):
 
 
 def device_logs(request, device_id):
-    device = Device.objects.get(device_id=device_id)
-    logs = DeviceLog.objects.filter(device=device).order_by('-timestamp')
+    device = get_object_or_404(Device, device_id=device_id)
+    # Only the first page is rendered; the page loads older entries and new
+    # ones through the cursors
+    page = log_page(device.pk)
     return render(request, 'dashboard/device_logs.html', {
         'device': device,
-        'logs': logs
+        'logs': page['logs'],
+        'has_more': page['has_more'],
+        'newest_cursor': page['newest_cursor'] or '',
+        'oldest_cursor': page['oldest_cursor'] or '',
     })
 
 
 @csrf_protect
 @require_http_methods(["POST"])
 def query_device(request, device_id):
-    """Handle device query request"""
+    """Ping a device; ``?wait=<seconds>`` waits for its reply.
+
+    The ping carries a correlation ID that the device echoes on
+    ``check/response`` (see pending.py). The response includes the query's
+    ``status`` (``pending``, ``answered`` or ``timed_out``) and, once
+    answered, the device's reply and round-trip time; ``url`` follows it up.
+    """
     if not request.user.is_authenticated:
         return JsonResponse({'status': 'error', 'message': 'Authentication required'}, status=403)
     
-    device = get_object_or_404(Device, device_id=device_id)
+    get_object_or_404(Device, device_id=device_id)
+    try:
+        wait = parse_wait(request.GET.get('wait'))
+    except InvalidQuery as e:
+        return JsonResponse({'status': 'error', 'message': str(e)}, status=400)
     
     # Send ping message to device
-    success = query_device_status(device_id)
-    
-    if success:
-        # Set status to 'idle' immediately to show we're waiting for response
-        device.status = 'idle'
-        device.save()
-        return JsonResponse({'status': 'success', 'message': 'Query sent to device'})
-    else:
+    query = pending_requests.create(device_id)
+    if not query_device_status(device_id, query.correlation_id):
+        pending_requests.fail([query.correlation_id])
         return JsonResponse({'status': 'error', 'message': 'Failed to send query'}, status=500)
 
+    if wait:
+        query = pending_requests.wait(query.correlation_id, wait) or query
+    if query.status == STATUS_ANSWERED:
+        message = f'Device answered in {query.rtt_ms:.0f} ms'
+    elif query.status == STATUS_TIMED_OUT:
+        message = 'Device did not answer in time'
+    else:
+        message = 'Query sent to device'
+    return JsonResponse({
+        'status': 'success',
+        'message': message,
+        'query': query.as_dict(),
+        'url': reverse('device_query', args=[query.correlation_id]),
+    })
+
+
+@csrf_protect
+@require_http_methods(["POST"])
+def query_devices(request):
+    """Ping several devices and wait for their replies until a deadline.
+
+    POST a JSON object with ``device_ids`` (at most ``QUERY_MAX_BATCH``), and
+    optionally ``wait`` (seconds to wait for replies) and ``timeout`` (seconds
+    before an unanswered query times out, default ``QUERY_TIMEOUT``). Returns
+    every query with its status and round-trip time. For whole fleets, use
+    ``/api/commands/``.
+    """
+    if not request.user.is_authenticated:
+        return JsonResponse({'status': 'error', 'message': 'Authentication required'}, status=403)
+    try:
+        body = json.loads(request.body or b'{}')
+    except ValueError:
+        return JsonResponse({'error': 'Request body must be JSON'}, status=400)
+    device_ids = body.get('device_ids') if isinstance(body, dict) else None
+    if not isinstance(device_ids, list) or not device_ids:
+        return JsonResponse({'error': 'device_ids must be a non-empty list'}, status=400)
+    device_ids = list(dict.fromkeys(str(device_id) for device_id in device_ids))
+    if len(device_ids) > getattr(settings, 'QUERY_MAX_BATCH', 1000):
+        return JsonResponse({'error': 'Too many devices; use /api/commands/ for fleets'}, status=400)
+    try:
+        wait = parse_wait(body.get('wait'))
+        timeout = float(body['timeout']) if body.get('timeout') is not None else None
+    except (InvalidQuery, TypeError, ValueError) as e:
+        return JsonResponse({'error': str(e)}, status=400)
+    if timeout is not None and not (math.isfinite(timeout) and timeout > 0):
+        return JsonResponse({'error': 'timeout must be a positive number of seconds'}, status=400)
+
+    known = list(device_registry.get_many(device_ids))
+    unknown = sorted(set(device_ids) - set(known))
+    queries = pending_requests.create_many(known, timeout)
+    failed = set(publish_many(
+        mqtt_client_instance,
+        [("check", query_message(query.device_id, query.correlation_id)) for query in queries],
+        qos=1,
+    ))
+    if failed:
+        pending_requests.fail([queries[index].correlation_id for index in failed])
+    sent = [query for index, query in enumerate(queries) if index not in failed]
+    if wait and sent:
+        results = pending_requests.wait_all([query.correlation_id for query in sent], wait)
+        sent = [results.get(query.correlation_id) or query for query in sent]
+
+    counts = {STATUS_PENDING: 0, STATUS_ANSWERED: 0, STATUS_TIMED_OUT: 0}
+    for query in sent:
+        counts[query.status] += 1
+    return JsonResponse({
+        'queries': [query.as_dict() for query in sent],
+        'answered': counts[STATUS_ANSWERED],
+        'timed_out': counts[STATUS_TIMED_OUT],
+        'pending': counts[STATUS_PENDING],
+        'failed': [queries[index].device_id for index in sorted(failed)],
+        'unknown': unknown,
+    })
+
+
+@login_required
+def device_query(request, correlation_id):
+    """A device query's status, reply and round-trip time.
+
+    ``?wait=`` waits for the reply in the web process that sent the query;
+    other processes answer from its ``DeviceQuery`` row, updated every second.
+    """
+    try:
+        wait = parse_wait(request.GET.get('wait'))
+    except InvalidQuery as e:
+        return JsonResponse({'error': str(e)}, status=400)
+    query = pending_requests.outcome(correlation_id, wait)
+    if query is None:
+        return JsonResponse({'error': 'Query not found'}, status=404)
+    return JsonResponse(query)
+
+
+@csrf_protect
+@require_http_methods(["GET", "POST"])
+def fleet_commands(request):
+    """Send a command to a selection of devices, or list recent commands.
+
+    POST a JSON object with ``command`` (e.g. ``ping``, or ``update`` to push
+    each device its firmware from the manifest), any of ``device_type``,
+    ``status`` and ``device_ids`` to select devices, and optionally
+    ``payload`` (merged into every message) and ``qos``. The command is sent
+    in the background (see fleet.py); the 202 response links its progress.
+    """
+    if not request.user.is_authenticated:
+        return JsonResponse({'status': 'error', 'message': 'Authentication required'}, status=403)
+
+    if request.method == 'GET':
+        commands = list(FleetCommand.objects.values(
+            'command_id', 'command', 'selector', 'status', 'targets', 'sent', 'acked', 'failed',
+            'created_at', 'finished_at'
+        )[:50])
+        return JsonResponse({'commands': commands})
+
+    try:
+        body = json.loads(request.body or b'{}')
+    except ValueError:
+        return JsonResponse({'error': 'Request body must be JSON'}, status=400)
+    if not isinstance(body, dict):
+        return JsonResponse({'error': 'Request body must be a JSON object'}, status=400)
+    if mqtt_client_instance is None or not mqtt_client_instance.is_connected():
+        return JsonResponse({'error': 'MQTT client not connected'}, status=503)
+    try:
+        run = fleet_dispatcher.submit(
+            mqtt_client_instance, body.get('command'), body,
+            payload=body.get('payload'), qos=body.get('qos'),
+            base_url=request.build_absolute_uri('/'),
+        )
+    except InvalidCommand as e:
+        return JsonResponse({'error': str(e)}, status=400)
+    response = fleet_dispatcher.progress(run.command_id)
+    response['url'] = reverse('fleet_command', args=[run.command_id])
+    return JsonResponse(response, status=202)
+
+
+@login_required
+def fleet_command(request, command_id):
+    """Progress of a fleet command; ``?details=1`` adds the per-device outcome.
+
+    Full progress comes from the web process that sent the command; other
+    processes answer from its ``FleetCommand`` row, updated every second.
+    """
+    response = fleet_dispatcher.progress(command_id, details=bool(request.GET.get('details')))
+    if response is not None:
+        return JsonResponse(response)
+    command = FleetCommand.objects.filter(command_id=command_id).values(
+        'command_id', 'command', 'status', 'targets', 'sent', 'acked', 'failed',
+        'created_at', 'finished_at'
+    ).first()
+    if command is None:
+        return JsonResponse({'error': 'Command not found'}, status=404)
+    done = command['acked'] + command['failed']
+    command['pending'] = command['targets'] - done
+    command['progress'] = round(done / command['targets'], 4) if command['targets'] else 1.0
+    return JsonResponse(command)
+
+
+@login_required
+def get_device_summary(request):
+    """Fleet totals per status and per device_type, kept up to date incrementally"""
+    return JsonResponse(device_registry.summary())
+
 
 @login_required
 def get_device_statuses(request):
-    """API endpoint to get status of all devices"""
-    print("\n=== get_device_statuses called ===")
-    print(f"User: {request.user}")
-    print(f"Authenticated: {request.user.is_authenticated}")
-    
+    """API endpoint to get status of all devices.
+
+    The response's ETag is the fleet version (see ``versions.py``): polls
+    with a matching ``If-None-Match`` get 304, and ``?since=<version>``
+    returns only the devices changed after that version.
+    """
     try:
-        devices = list(Device.objects.all())
-        print(f"Found {len(devices)} devices in database")
-        
-        device_data = []
-        for device in devices:
-            status = device.status or 'offline'
-            print(f"Device: {device.device_id}, Status: {status}, Last Seen: {device.last_seen}")
-            
-            device_data.append({
-                'device_id': device.device_id,
-                'status': status,
-                'last_seen': device.last_seen.isoformat() if device.last_seen else None,
-                'name': device.name
-            })
-        
-        response_data = {'devices': device_data}
-        print("Returning device data:", response_data)
-        return JsonResponse(response_data)
-        
+        # Read the version before the rows: a change committed in between is
+        # sent again on the next poll rather than missed
+        version = current_fleet_version()
+        etag = f'"{version}"'
+        if etag in parse_etags(request.META.get('HTTP_IF_NONE_MATCH', '')):
+            response = HttpResponseNotModified()
+            response['ETag'] = etag
+            return response
+
+        since = request.GET.get('since')
+        try:
+            since = int(since) if since else None
+        except ValueError:
+            return JsonResponse({'error': f'Invalid since: {since!r}'}, status=400)
+        if since is not None and since > version:
+            # The client's version comes from elsewhere (e.g. a restored database)
+            since = None
+
+        devices = Device.objects.order_by()
+        if since is not None:
+            devices = devices.filter(version__gt=since)
+        device_data = [
+            {
+                'device_id': device_id,
+                'status': status or 'offline',
+                'last_seen': last_seen.isoformat() if last_seen else None,
+                'name': name
+            }
+            for device_id, status, last_seen, name in devices.values_list(
+                'device_id', 'status', 'last_seen', 'name'
+            ).iterator()
+        ]
+        response = JsonResponse({'version': version, 'since': since, 'devices': device_data})
+        response['ETag'] = etag
+        response['Cache-Control'] = 'private, no-cache'
+        return response
+
     except Exception as e:
         print(f"Error in get_device_statuses: {str(e)}")
         return JsonResponse(
@@ -475,14 +576,40 @@ def get_device_statuses(request):
 
 
 def get_firmware(request):
+    """Newest firmware offered to the polling device, from the manifest.
+
+    ``?device_id=`` places the device in its rollout cohort and, unless
+    ``?device_type=`` is given, picks its type from the device registry.
+    ``?from=<version>`` adds a delta ``patch`` from that version when one
+    has been built; ``url`` always points at the full image. Served from
+    memory (see manifest.py), with no database queries.
+    """
     try:
-        firmware = Firmware.objects.filter(is_active=True).order_by('-created_at').first()
+        device_id = request.GET.get('device_id') or None
+        device_type = request.GET.get('device_type') or None
+        if device_type is None and device_id is not None:
+            state = device_registry.get(device_id)
+            device_type = state.device_type if state is not None else None
+        firmware = firmware_manifest.resolve(device_type, device_id)
         if firmware:
             response = {
-                'type': 'my-device-type',
+                'type': firmware.device_type or device_type,
                 'version': firmware.version,
-                'url': f"{request.scheme}://{request.get_host()}{firmware.firmware_file.url}"
+                'url': request.build_absolute_uri(firmware.path),
+                'sha256': firmware.sha256,
+                'size': firmware.size,
+                'rollout_percent': firmware.rollout_percent,
             }
+            from_version = request.GET.get('from')
+            if from_version and from_version != firmware.version and from_version in firmware.patches:
+                patch = firmware.patches[from_version]
+                response['patch'] = {
+                    'from': from_version,
+                    'algorithm': patch['algorithm'],
+                    'url': request.build_absolute_uri(patch['path']),
+                    'sha256': patch['sha256'],
+                    'size': patch['size'],
+                }
             return JsonResponse(response)
         else:
             return JsonResponse({
@@ -494,3 +621,59 @@ def get_firmware(request):
             'error': str(e),
             'success': False
         }, status=500)
+
+
+@require_http_methods(['GET', 'HEAD'])
+def download_firmware(request, digest):
+    """Serve a firmware image or patch by SHA-256.
+
+    Blobs are immutable, so a matching ``If-None-Match`` gets a 304 and
+    responses may be cached forever. A single ``Range`` is honoured (unless
+    ``If-Range`` names another ETag) so interrupted downloads resume.
+    """
+    if not DIGEST_RE.match(digest):
+        return JsonResponse({'error': 'Invalid digest'}, status=400)
+    name = blob_name(digest)
+    if not default_storage.exists(name):
+        return JsonResponse({'error': 'Firmware not found'}, status=404)
+
+    etag = f'"{digest}"'
+    headers = {
+        'ETag': etag,
+        'Accept-Ranges': 'bytes',
+        'Cache-Control': 'public, max-age=31536000, immutable',
+    }
+    if_none_match = parse_etags(request.META.get('HTTP_IF_NONE_MATCH', ''))
+    if etag in if_none_match or '*' in if_none_match:
+        response = HttpResponseNotModified()
+    elif getattr(settings, 'FIRMWARE_SENDFILE_HEADER', None):
+        # The front-end server sends the file (and handles Range itself)
+        response = HttpResponse(content_type='application/octet-stream')
+        response[settings.FIRMWARE_SENDFILE_HEADER] = (
+            getattr(settings, 'FIRMWARE_SENDFILE_PREFIX', '/protected/') + name
+        )
+    else:
+        size = default_storage.size(name)
+        byte_range = None
+        if_range = request.META.get('HTTP_IF_RANGE')
+        if if_range is None or if_range == etag:
+            try:
+                byte_range = parse_range(request.META.get('HTTP_RANGE'), size)
+            except ValueError:
+                response = HttpResponse(status=416)
+                response['Content-Range'] = f'bytes */{size}'
+                return response
+        file = default_storage.open(name, 'rb')
+        if byte_range is None:
+            response = FileResponse(file, content_type='application/octet-stream')
+        else:
+            start, end = byte_range
+            response = FileResponse(
+                RangeFile(file, start, end - start + 1),
+                status=206, content_type='application/octet-stream'
+            )
+            response['Content-Length'] = end - start + 1
+            response['Content-Range'] = f'bytes {start}-{end}/{size}'
+    for header, value in headers.items():
+        response[header] = value
+    return response
@@ -0,0 +1,505 @@
+"""Segmented append-only write-ahead log in front of the ingestion writer.
+
+``on_message`` appends each record to the WAL and returns. It never waits
+for the database, so a locked or slow database can't stall paho's network
+loop or lose messages. Records are framed as::
+
+    <payload length:u32> <crc32:u32> <sequence:u64> <JSON payload>
+
+and appended to segment files named after their first sequence number
+(``00000000000000000001.wal``). A new segment starts once the current one
+reaches ``INGEST_WAL_SEGMENT_BYTES``.
+
+A sync thread group-commits the appends: every ``INGEST_WAL_SYNC_INTERVAL``
+it flushes and fsyncs whatever has been written since the last sync, so one
+fsync covers every message that arrived in the window. With
+``INGEST_WAL_SYNC_WAIT`` the appender also waits for that fsync. That makes
+an acknowledged message survive a power loss, at the cost of up to one
+sync interval per call.
+
+Each consumer worker (see :mod:`dashboard.consumer`) has its own WAL
+directory. A replayer thread reads the synced frames in batches and applies them with
+:func:`~dashboard.ingestion.persist_batch`. After each applied batch it
+writes a checkpoint (segment, offset, sequence). Segments that are fully
+applied are deleted. A batch that fails with an error that can pass (a
+locked or unreachable database) is retried with backoff and nothing is
+dropped. A batch that fails any other way (``IntegrityError``,
+``DataError``, a record ``persist_batch`` can't handle) is split in halves
+until the bad records are isolated. Those records are
+appended to the ``quarantine`` file in the WAL directory, in the same frame
+format, and counted in the stats. The rest are applied and the checkpoint
+moves past them, so one bad record can't stall the shard.
+:meth:`WriteAheadLog.replay_pending` applies everything behind the
+checkpoint synchronously, and it runs at startup before the MQTT
+subscription is made. A torn frame at the end of the last segment (a crash
+mid-write) is truncated when the log is opened.
+"""
+import json
+import os
+import struct
+import threading
+import time
+import zlib
+from datetime import datetime
+
+from django.conf import settings
+from django.db import InterfaceError, OperationalError, close_old_connections
+
+from .database import db_writer
+from .ingestion import persist_batch
+from .timing import StageTimer
+
+try:
+    import fcntl
+except ImportError:  # Windows: no advisory lock, one process per WAL directory
+    fcntl = None
+
+FRAME = struct.Struct('>IIQ')
+SEGMENT_SUFFIX = '.wal'
+CHECKPOINT_FILE = 'checkpoint'
+LOCK_FILE = 'LOCK'
+QUARANTINE_FILE = 'quarantine'
+MAX_RETRY_DELAY = 30.0
+# Errors a retry can get past; any other failure is blamed on the records
+TRANSIENT_ERRORS = (OperationalError, InterfaceError)
+
+
+def encode_record(record):
+    payload = dict(record, timestamp=record['timestamp'].isoformat())
+    return json.dumps(payload, separators=(',', ':')).encode()
+
+
+def decode_record(payload):
+    record = json.loads(payload)
+    record['timestamp'] = datetime.fromisoformat(record['timestamp'])
+    return record
+
+
+def segment_name(first_seq):
+    return f"{first_seq:020d}{SEGMENT_SUFFIX}"
+
+
+def read_frames(handle, limit=None):
+    """Yield ``(seq, payload, end_offset)`` for the valid frames after the
+    handle's position, stopping at ``limit``, a torn frame or EOF"""
+    offset = handle.tell()
+    while limit is None or offset < limit:
+        header = handle.read(FRAME.size)
+        if len(header) < FRAME.size:
+            return
+        length, crc, seq = FRAME.unpack(header)
+        payload = handle.read(length)
+        if len(payload) < length or zlib.crc32(payload) != crc:
+            return
+        offset += FRAME.size + length
+        yield seq, payload, offset
+
+
+class WriteAheadLog:
+    """Durable on-disk buffer between MQTT callbacks and the database"""
+
+    def __init__(self, directory, segment_bytes=16 * 1024 * 1024, sync_interval=0.01,
+                 sync_wait=False, batch_size=500, flush_interval=1.0, apply=None):
+        self.directory = str(directory)
+        self.segment_bytes = segment_bytes
+        self.sync_interval = sync_interval
+        self.sync_wait = sync_wait
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.apply = apply
+
+        self._lock = threading.Lock()
+        self._written = threading.Condition(self._lock)
+        self._synced = threading.Condition(self._lock)
+        self._lock_handle = None
+        self._file = None
+        self._segments = []
+        self._segment_size = 0
+        self._next_seq = 1
+        self._written_seq = 0
+        self._synced_seq = 0
+        self._synced_position = (None, 0)
+        self._checkpoint = (None, 0, 0)
+        self._reader = None
+        self._threads = []
+        self._started_at = time.monotonic()
+        self._caught_up_at = time.monotonic()
+
+        self.persist_timer = StageTimer()
+        self._appended = 0
+        self._appended_bytes = 0
+        self._fsyncs = 0
+        self._last_fsync = 0.0
+        self._max_fsync = 0.0
+        self._applied = 0
+        self._batches = 0
+        self._failed_batches = 0
+        self._quarantined = 0
+        self._recovered = 0
+        self._recovery_time = 0.0
+        self._truncated_bytes = 0
+
+    @classmethod
+    def from_settings(cls, name=None):
+        """WAL in ``INGEST_WAL_DIR``, or in its ``name`` subdirectory"""
+        directory = getattr(settings, 'INGEST_WAL_DIR', settings.BASE_DIR / 'wal')
+        return cls(
+            directory=os.path.join(directory, name) if name else directory,
+            segment_bytes=getattr(settings, 'INGEST_WAL_SEGMENT_BYTES', 16 * 1024 * 1024),
+            sync_interval=getattr(settings, 'INGEST_WAL_SYNC_INTERVAL', 0.01),
+            sync_wait=getattr(settings, 'INGEST_WAL_SYNC_WAIT', False),
+            batch_size=getattr(settings, 'INGEST_BATCH_SIZE', 500),
+            flush_interval=getattr(settings, 'INGEST_FLUSH_INTERVAL', 1.0),
+            apply=persist_batch,
+        )
+
+    @property
+    def is_open(self):
+        return self._file is not None
+
+    # ---------- Opening and recovery ----------
+
+    def open(self):
+        """Open the log for appending; returns False if another process holds it"""
+        with self._lock:
+            if self._file is not None:
+                return True
+            os.makedirs(self.directory, exist_ok=True)
+            self._lock_handle = open(os.path.join(self.directory, LOCK_FILE), 'a')
+            if fcntl is not None:
+                try:
+                    fcntl.flock(self._lock_handle, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except OSError:
+                    self._lock_handle.close()
+                    self._lock_handle = None
+                    return False
+
+            self._segments = sorted(
+                int(name[:-len(SEGMENT_SUFFIX)]) for name in os.listdir(self.directory)
+                if name.endswith(SEGMENT_SUFFIX)
+            )
+            self._checkpoint = self._load_checkpoint()
+            last_seq = self._checkpoint[2]
+            if self._segments:
+                # Find the end of the last complete frame, dropping a torn tail
+                path = self._path(self._segments[-1])
+                last_seq = max(last_seq, self._segments[-1] - 1)
+                end = 0
+                with open(path, 'rb') as handle:
+                    for seq, _, end in read_frames(handle):
+                        last_seq = max(last_seq, seq)
+                size = os.path.getsize(path)
+                if size > end:
+                    self._truncated_bytes += size - end
+                    with open(path, 'r+b') as handle:
+                        handle.truncate(end)
+                        os.fsync(handle.fileno())
+                    print(f"⚠️ Truncated {size - end} torn bytes from WAL segment {path}")
+                self._file = open(path, 'ab')
+                self._segment_size = end
+            else:
+                self._segments.append(last_seq + 1)
+                self._file = open(self._path(last_seq + 1), 'ab')
+                self._segment_size = 0
+            self._next_seq = last_seq + 1
+            self._written_seq = self._synced_seq = last_seq
+            self._synced_position = (self._segments[-1], self._segment_size)
+            if self._checkpoint[0] not in self._segments:
+                self._checkpoint = (self._segments[0], 0, self._checkpoint[2])
+            return True
+
+    def _path(self, first_seq):
+        return os.path.join(self.directory, segment_name(first_seq))
+
+    def _load_checkpoint(self):
+        try:
+            with open(os.path.join(self.directory, CHECKPOINT_FILE)) as handle:
+                data = json.load(handle)
+            return data['segment'], data['offset'], data['seq']
+        except FileNotFoundError:
+            return None, 0, 0
+
+    def _save_checkpoint(self, segment, offset, seq):
+        path = os.path.join(self.directory, CHECKPOINT_FILE)
+        with open(path + '.tmp', 'w') as handle:
+            json.dump({'segment': segment, 'offset': offset, 'seq': seq}, handle)
+            handle.flush()
+            os.fsync(handle.fileno())
+        os.replace(path + '.tmp', path)
+
+    # ---------- Appending ----------
+
+    def append(self, record):
+        """Append a record; returns its sequence number.
+
+        Returns once the frame is handed to the OS, or once it is fsynced
+        when ``sync_wait`` is set.
+        """
+        payload = encode_record(record)
+        crc = zlib.crc32(payload)
+        with self._lock:
+            seq = self._next_seq
+            self._next_seq += 1
+            if self._segment_size >= self.segment_bytes:
+                self._roll(seq)
+            data = FRAME.pack(len(payload), crc, seq) + payload
+            self._file.write(data)
+            self._segment_size += len(data)
+            self._written_seq = seq
+            self._appended += 1
+            self._appended_bytes += len(data)
+            self._written.notify()
+            if self.sync_wait:
+                self._synced.wait_for(lambda: self._synced_seq >= seq)
+        return seq
+
+    def _roll(self, first_seq):
+        """Seal the current segment and start a new one (lock held)"""
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._file.close()
+        self._synced_seq = self._written_seq
+        self._segments.append(first_seq)
+        self._file = open(self._path(first_seq), 'ab')
+        self._segment_size = 0
+        self._synced_position = (first_seq, 0)
+        self._synced.notify_all()
+
+    def sync(self):
+        """Flush and fsync everything appended so far (one group commit)"""
+        with self._lock:
+            if self._synced_seq >= self._written_seq:
+                return 0
+            self._file.flush()
+            # fsync a duplicate descriptor outside the lock so appends carry
+            # on meanwhile; a roll may close the original
+            fd = os.dup(self._file.fileno())
+            seq = self._written_seq
+            position = (self._segments[-1], self._segment_size)
+            group = seq - self._synced_seq
+        started = time.monotonic()
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        elapsed = time.monotonic() - started
+        with self._lock:
+            self._fsyncs += 1
+            self._last_fsync = elapsed
+            self._max_fsync = max(self._max_fsync, elapsed)
+            if seq > self._synced_seq:
+                self._synced_seq = seq
+                if position[0] == self._segments[-1]:
+                    self._synced_position = position
+            self._synced.notify_all()
+        return group
+
+    def _run_sync(self):
+        while True:
+            with self._lock:
+                self._written.wait_for(lambda: self._written_seq > self._synced_seq)
+            # Let the window fill so one fsync covers the whole group
+            time.sleep(self.sync_interval)
+            try:
+                self.sync()
+            except Exception as e:
+                print(f"❌ WAL fsync failed: {e}")
+                time.sleep(1)
+
+    # ---------- Replay ----------
+
+    def _read_batch(self):
+        """Read up to ``batch_size`` synced records after the checkpoint.
+
+        Returns ``(records, frames, checkpoint)``: ``frames`` holds each
+        record's ``(seq, payload, position after it)`` and checkpoint is the
+        position after the last record read.
+        """
+        with self._lock:
+            segment, offset, seq = self._checkpoint
+            synced_segment, synced_offset = self._synced_position
+            segments = list(self._segments)
+
+        records = []
+        frames = []
+        while len(records) < self.batch_size:
+            sealed = segment != synced_segment
+            limit = None if sealed else synced_offset
+            if self._reader is None or self._reader[0] != segment:
+                if self._reader is not None:
+                    self._reader[1].close()
+                self._reader = (segment, open(self._path(segment), 'rb'))
+            handle = self._reader[1]
+            handle.seek(offset)
+            for seq, payload, offset in read_frames(handle, limit):
+                records.append(decode_record(payload))
+                frames.append((seq, payload, (segment, offset, seq)))
+                if len(records) >= self.batch_size:
+                    break
+            else:
+                # Reached the synced end; sealed segments continue in the next one
+                later = [first for first in segments if first > segment]
+                if sealed and later:
+                    segment, offset = later[0], 0
+                    continue
+            break
+        return records, frames, (segment, offset, seq)
+
+    def _apply_next(self):
+        """Apply one batch; returns the number of records read"""
+        records, frames, checkpoint = self._read_batch()
+        if not records:
+            return 0
+        close_old_connections()
+        started = time.perf_counter()
+        try:
+            db_writer.run(self.apply, records)
+        except Exception as e:
+            if isinstance(e, TRANSIENT_ERRORS):
+                raise
+            print(f"⚠️ WAL batch rejected, isolating bad records: {e}")
+            self._apply_split(records, frames)
+        else:
+            self._advance(checkpoint, len(records))
+        self.persist_timer.add(time.perf_counter() - started, len(records))
+        with self._lock:
+            self._batches += 1
+        return len(records)
+
+    def _apply_split(self, records, frames):
+        """Apply a rejected batch in halves, quarantining records that fail alone.
+
+        The checkpoint follows each applied or quarantined part, so a
+        transient error part way through doesn't apply a part twice.
+        """
+        try:
+            db_writer.run(self.apply, records)
+        except Exception as e:
+            if isinstance(e, TRANSIENT_ERRORS):
+                raise
+            if len(records) > 1:
+                middle = len(records) // 2
+                self._apply_split(records[:middle], frames[:middle])
+                self._apply_split(records[middle:], frames[middle:])
+                return
+            self._quarantine(frames[0], e)
+            self._advance(frames[0][2], 0)
+            return
+        self._advance(frames[-1][2], len(records))
+
+    def _quarantine(self, frame, error):
+        """Append a rejected record to the quarantine file"""
+        seq, payload, _ = frame
+        with open(os.path.join(self.directory, QUARANTINE_FILE), 'ab') as handle:
+            handle.write(FRAME.pack(len(payload), zlib.crc32(payload), seq) + payload)
+            handle.flush()
+            os.fsync(handle.fileno())
+        with self._lock:
+            self._quarantined += 1
+        print(f"⚠️ Quarantined WAL record {seq}: {error}")
+
+    def _advance(self, checkpoint, applied):
+        """Save the checkpoint and delete segments behind it"""
+        self._save_checkpoint(*checkpoint)
+        with self._lock:
+            self._checkpoint = checkpoint
+            self._applied += applied
+            if checkpoint[2] >= self._synced_seq:
+                self._caught_up_at = time.monotonic()
+            finished = [first for first in self._segments[:-1] if first < checkpoint[0]]
+            self._segments = [first for first in self._segments if first not in finished]
+        for first in finished:
+            os.remove(self._path(first))
+
+    def replay_pending(self):
+        """Apply every record behind the checkpoint; returns how many"""
+        started = time.monotonic()
+        self.sync()
+        replayed = 0
+        while True:
+            applied = self._apply_next()
+            if not applied:
+                break
+            replayed += applied
+        with self._lock:
+            self._recovered += replayed
+            self._recovery_time += time.monotonic() - started
+        if replayed:
+            print(f"♻️ Replayed {replayed} messages from the WAL")
+        return replayed
+
+    def _run_replay(self):
+        delay = self.flush_interval
+        while True:
+            with self._lock:
+                self._synced.wait_for(
+                    lambda: self._synced_seq - self._checkpoint[2] >= self.batch_size,
+                    timeout=self.flush_interval
+                )
+            try:
+                while self._apply_next():
+                    pass
+                delay = self.flush_interval
+            except Exception as e:
+                with self._lock:
+                    self._failed_batches += 1
+                print(f"❌ WAL replay failed, retrying in {delay:.1f}s: {e}")
+                time.sleep(delay)
+                delay = min(delay * 2, MAX_RETRY_DELAY)
+
+    def close(self):
+        """Sync, close the files and release the directory.
+
+        For logs whose threads were never started (tools and tests).
+        """
+        self.sync()
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+            if self._reader is not None:
+                self._reader[1].close()
+                self._reader = None
+            if self._lock_handle is not None:
+                self._lock_handle.close()
+                self._lock_handle = None
+
+    def start(self):
+        """Start the sync and replay threads (idempotent)"""
+        if any(thread.is_alive() for thread in self._threads):
+            return
+        self._threads = [
+            threading.Thread(target=self._run_sync, name='wal-sync', daemon=True),
+            threading.Thread(target=self._run_replay, name='wal-replay', daemon=True),
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    def stats(self):
+        with self._lock:
+            uptime = time.monotonic() - self._started_at
+            lag = self._written_seq - self._checkpoint[2]
+            return {
+                'open': self._file is not None,
+                'segments': len(self._segments),
+                'segment_bytes': self.segment_bytes,
+                'appended': self._appended,
+                'appended_bytes': self._appended_bytes,
+                'append_rate': round(self._appended / uptime, 3) if uptime else 0,
+                'written_seq': self._written_seq,
+                'synced_seq': self._synced_seq,
+                'applied_seq': self._checkpoint[2],
+                'fsyncs': self._fsyncs,
+                'avg_group_size': round(self._appended / self._fsyncs, 3) if self._fsyncs else 0,
+                'last_fsync_ms': round(self._last_fsync * 1000, 3),
+                'max_fsync_ms': round(self._max_fsync * 1000, 3),
+                'applied': self._applied,
+                'batches': self._batches,
+                'failed_batches': self._failed_batches,
+                'quarantined': self._quarantined,
+                'replay_lag': lag,
+                'replay_lag_seconds': round(time.monotonic() - self._caught_up_at, 3) if lag else 0,
+                'recovered': self._recovered,
+                'recovery_seconds': round(self._recovery_time, 3),
+                'truncated_bytes': self._truncated_bytes,
+            }
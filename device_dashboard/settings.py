@@ -19,6 +19,89 @@ MQTT_BROKER_HOST = 'localhost'
 MQTT_BROKER_PORT = 1883
 MQTT_TOPIC = 'devices/#'  # This will subscribe to all topics
 
+# Web processes warm the device registry and connect to the broker for events from the
+# consumer workers: True, False or 'auto' (WSGI/ASGI servers and runserver, not other
+# management commands such as test or Celery workers; see dashboard/apps.py)
+WEB_SERVICES = 'auto'
+
+# Consumer workers (manage.py run_consumer); web processes never subscribe to device topics
+CONSUMER_WORKERS = 1
+CONSUMER_MODE = 'hash'  # or 'shared' ($share/<MQTT_SHARE_GROUP>/devices/#)
+MQTT_SHARE_GROUP = 'dashboard'
+EVENT_FORWARD_INTERVAL = 0.2  # seconds between event batches sent to web processes
+CONSUMER_STATS_INTERVAL = 5.0  # seconds between consumer stats reports
+
+# Decode stage: 'inline' on paho's network thread, or 'pool' (process pool)
+DECODE_MODE = 'inline'
+DECODE_WORKERS = 2
+DECODE_BATCH_SIZE = 200
+DECODE_FLUSH_INTERVAL = 0.005  # seconds before a partial batch is sent to the pool
+DECODE_MAX_INFLIGHT = 8  # batches in the pool before the network thread waits
+
+# Ingestion pipeline: on_message enqueues, a flusher writes in batches
+INGEST_QUEUE_MAXSIZE = 10000
+INGEST_BATCH_SIZE = 500
+INGEST_FLUSH_INTERVAL = 1.0  # seconds
+INGEST_BACKPRESSURE = 'drop_oldest'  # or 'block'
+INGEST_BLOCK_TIMEOUT = 5.0  # seconds to wait for room with 'block'
+INGEST_WAL_ENABLED = True  # append messages to a local write-ahead log before the database
+INGEST_WAL_DIR = BASE_DIR / 'wal'
+INGEST_WAL_SEGMENT_BYTES = 16 * 1024 * 1024
+INGEST_WAL_SYNC_INTERVAL = 0.01  # seconds per group commit (fsync)
+INGEST_WAL_SYNC_WAIT = False  # wait for the fsync before acknowledging a message
+HEARTBEAT_FLUSH_INTERVAL = 5.0  # seconds between coalesced last_seen/status writes
+
+# Device presence: seconds without a message before online -> idle -> offline
+DEVICE_IDLE_AFTER = 120
+DEVICE_OFFLINE_AFTER = 300
+# Per device_type overrides, e.g. {'BMF': {'idle_after': 60, 'offline_after': 180}}
+DEVICE_TYPE_THRESHOLDS = {}
+PRESENCE_TICK = 1.0  # seconds; upper bound on how late a transition fires
+STATUS_SWEEP_INTERVAL = 300  # seconds between reconciliation sweeps
+FLEET_RECONCILE_INTERVAL = 60  # seconds between fleet counter checks against the database
+
+# Live updates (/api/events/ Server-Sent Events stream)
+EVENT_HISTORY = 1000  # events kept for Last-Event-ID resume
+EVENT_SUBSCRIBER_QUEUE = 500  # events a client may fall behind before it is dropped
+EVENT_KEEPALIVE = 15  # seconds
+EVENT_RETRY_MS = 3000
+
+# Log retention (manage.py prune_device_logs / dashboard.tasks.prune_device_logs)
+LOG_RETENTION_DAYS = 30  # raw DeviceLog rows; hourly/daily rollups are kept
+RECENT_LOGS_LIMIT = 50  # log entries shown on the dashboard
+EXPORT_CHUNK_SIZE = 2000  # rows fetched and rendered per chunk by log exports
+IMPORT_BATCH_SIZE = 10000  # rows per transaction in manage.py import_logs
+
+# Recent messages list (/get_recent_messages/), served from memory
+MAX_RECENT_MESSAGES = 200
+RECENT_MESSAGES_BACKEND = 'memory'  # or 'database': shared through the RecentMessage table
+RECENT_MESSAGES_FLUSH_INTERVAL = 1.0  # seconds between writes with the database backend
+
+# Firmware downloads (dashboard/firmware.py). Delta patches need bsdiff4 installed.
+FIRMWARE_DELTA_PATCHES = True
+# e.g. 'X-Accel-Redirect' (nginx) or 'X-Sendfile' (Apache) to let the web server send blobs;
+# FIRMWARE_SENDFILE_PREFIX + 'firmware/blobs/...' must map to the media directory there
+FIRMWARE_SENDFILE_HEADER = None
+FIRMWARE_SENDFILE_PREFIX = '/protected/'
+# Seconds before a web process reloads its firmware manifest even without a change event
+FIRMWARE_MANIFEST_TTL = 300
+# Uploaded firmware folders are zipped in the background (dashboard/packaging.py)
+FIRMWARE_ZIP_LEVEL = 6  # 0 (store) to 9 (smallest)
+FIRMWARE_PACKAGE_WORKERS = None  # compression threads; None = one per core
+
+# Fleet commands (/api/commands/, dashboard/fleet.py)
+FLEET_COMMAND_TOPIC = 'check/{device_id}'  # per-device topic; {device_type} is also available
+FLEET_COMMAND_RATE = 500  # messages per second per web process, across all commands
+FLEET_COMMAND_BATCH_SIZE = 100
+FLEET_COMMAND_QOS = 1  # default; a command can ask for 0, 1 or 2
+FLEET_COMMAND_ACK_TIMEOUT = 60  # seconds after the last message before a command times out
+
+# Device queries (/api/device/<id>/query/, /api/queries/, dashboard/pending.py)
+QUERY_TIMEOUT = 10  # seconds before an unanswered query times out
+QUERY_RESULT_TTL = 300  # seconds answered and timed out queries stay available
+QUERY_MAX_WAIT = 30  # longest ?wait= a request may block for
+QUERY_MAX_BATCH = 1000  # devices per /api/queries/ call
+
 # Application definition
 INSTALLED_APPS = [
     'django.contrib.admin',
@@ -27,7 +110,7 @@ INSTALLED_APPS = [
     'django.contrib.sessions',
     'django.contrib.messages',
     'django.contrib.staticfiles',
-    'dashboard',
+    'dashboard.apps.DashboardConfig',
 ]
 
 MIDDLEWARE = [
@@ -67,6 +150,40 @@ DATABASES = {
     }
 }
 
+# PostgreSQL instead of SQLite: set POSTGRES_DB (plus POSTGRES_USER, POSTGRES_PASSWORD,
+# POSTGRES_HOST and POSTGRES_PORT as needed). Requires psycopg2 (pip install psycopg2-binary)
+if os.environ.get('POSTGRES_DB'):
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.postgresql',
+            'NAME': os.environ['POSTGRES_DB'],
+            'USER': os.environ.get('POSTGRES_USER', 'postgres'),
+            'PASSWORD': os.environ.get('POSTGRES_PASSWORD', ''),
+            'HOST': os.environ.get('POSTGRES_HOST', 'localhost'),
+            'PORT': os.environ.get('POSTGRES_PORT', '5432'),
+            # Keep connections open across requests and ingestion batches (seconds)
+            'CONN_MAX_AGE': int(os.environ.get('POSTGRES_CONN_MAX_AGE', 60)),
+        }
+    }
+
+# Applied to every new SQLite connection (see dashboard/database.py)
+SQLITE_PRAGMAS = {
+    'journal_mode': 'WAL',     # readers and the writer don't block each other
+    'synchronous': 'NORMAL',   # fsync at checkpoints only; safe with WAL
+    'busy_timeout': 5000,      # ms to wait for the write lock before failing
+    'mmap_size': 268435456,    # 256 MB of the file memory-mapped for reads
+    'cache_size': -65536,      # 64 MB page cache per connection
+}
+# Serialise background writes through one writer thread: 'auto' (SQLite only), True or False
+DATABASE_WRITER = 'auto'
+
+# Bulk log inserts and heartbeat updates (dashboard/storage.py): 'auto' picks 'postgresql'
+# (COPY, UPDATE ... FROM VALUES), 'sqlite' (UPDATE ... FROM) or 'default' by database
+INGEST_STORAGE = 'auto'
+# Log payload storage: 'json' (data column), or 'msgpack' / 'cbor' for the compact binary
+# data_packed column (needs msgpack / cbor2 installed; see dashboard/payloads.py)
+LOG_PAYLOAD_ENCODING = 'json'
+
 AUTH_PASSWORD_VALIDATORS = [
     {
         'NAME': 'django.contrib.auth.password_validation.UserAttributeSimilarityValidator',
@@ -93,59 +210,3 @@ STATICFILES_DIRS = [
 ]
 
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
-
-# MQTT Client Setup
-try:
-    import paho.mqtt.client as mqtt
-    import json
-    from django.utils import timezone
-    
-    def process_mqtt_message(topic, message):
-        try:
-            data = json.loads(message)
-            device_id = topic.split('/')[-1]
-            
-            from dashboard.models import Device, DeviceLog
-            device, created = Device.objects.get_or_create(device_id=device_id)
-            device.status = True
-            device.last_seen = timezone.now()
-            device.save()
-            
-            DeviceLog.objects.create(
-                device=device,
-                data=data
-            )
-        except Exception as e:
-            print(f"Error processing MQTT message: {e}")
-
-    def on_connect(client, userdata, flags, rc):
-        print("Connected with result code " + str(rc))
-        client.subscribe(MQTT_TOPIC)
-
-    def on_message(client, userdata, msg):
-        process_mqtt_message(msg.topic, msg.payload.decode())
-
-    client = mqtt.Client()
-    client.on_connect = on_connect
-    client.on_message = on_message
-
-    try:
-        client.connect(MQTT_BROKER_HOST, MQTT_BROKER_PORT, 60)
-        client.loop_start()
-    except Exception as e:
-        print(f"Could not connect to MQTT broker: {e}")
-except ImportError:
-    print("MQTT not available. Install paho-mqtt for MQTT functionality.")
-except Exception as e:
-    print(f"Error initializing MQTT: {e}")
-
-# Application definition
-INSTALLED_APPS = [
-    'django.contrib.admin',
-    'django.contrib.auth',
-    'django.contrib.contenttypes',
-    'django.contrib.sessions',
-    'django.contrib.messages',
-    'django.contrib.staticfiles',
-    'dashboard.apps.DashboardConfig',
-]